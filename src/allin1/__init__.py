@@ -1,6 +1,50 @@
-from .analyze import analyze
-from .visualize import visualize
-from .sonify import sonify
-from .typings import AnalysisResult
-from .config import HARMONIX_LABELS
-from .utils import load_result
+import importlib
+import sys
+import types
+
+from typing import TYPE_CHECKING
+
+# The public names and the modules defining them. They are imported on first access, so that `import allin1`
+# and reading results with `load_result` do not load PyTorch, madmom, Demucs or matplotlib.
+_LAZY_ATTRIBUTES = {
+  'analyze': '.analyze',
+  'visualize': '.visualize',
+  'sonify': '.sonify',
+  'AnalysisResult': '.typings',
+  'HARMONIX_LABELS': '.config',
+  'load_result': '.utils',
+  'load_results': '.utils',
+}
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+if TYPE_CHECKING:
+  from .analyze import analyze
+  from .visualize import visualize
+  from .sonify import sonify
+  from .typings import AnalysisResult
+  from .config import HARMONIX_LABELS
+  from .utils import load_result, load_results
+
+
+def __getattr__(name: str):
+  if name in _LAZY_ATTRIBUTES:
+    module = importlib.import_module(_LAZY_ATTRIBUTES[name], __name__)
+    return getattr(module, name)
+  raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+  return sorted({*globals(), *__all__})
+
+
+class _Package(types.ModuleType):
+  def __setattr__(self, name: str, value):
+    # Importing the submodules `analyze`, `visualize` and `sonify` binds them to the package,
+    # where the functions of the same names are expected instead.
+    if isinstance(value, types.ModuleType) and _LAZY_ATTRIBUTES.get(name) == f'.{name}':
+      value = getattr(value, name)
+    super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _Package
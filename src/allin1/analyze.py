@@ -1,20 +1,34 @@
+import numpy as np
 import torch
 
-from typing import List, Union
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
 from tqdm import tqdm
-from .demix import demix
-from .spectrogram import extract_spectrograms
+from .demix import demix, demix_track, get_separator
+from .spectrogram import (
+  extract_spectrograms,
+  extract_spectrogram,
+  extract_spectrogram_from_stems,
+  SpectrogramFrontend,
+)
 from .models import load_pretrained_model
-from .visualize import visualize as _visualize
-from .sonify import sonify as _sonify
+from .pipeline import Stage, run_pipeline
+from .cache import ContentCache, load_cached_spectrogram, load_cached_result, save_cached_result
+from .profiling import Callback, JsonLinesWriter, Profiler, measure
+from .store import ResultStore, ResultStoreWriter
+from .index import INDEX_NAME, ResultIndex
 from .helpers import (
-  run_inference,
+  run_batched_inference,
+  forward_chunked,
+  postprocess_logits,
   expand_paths,
+  select_shard,
   check_paths,
+  check_unique_names,
   rmdir_if_empty,
   save_results,
 )
-from .utils import mkpath, load_result
+from .utils import mkpath, load_results
 from .typings import AnalysisResult, PathLike
 
 
@@ -32,6 +46,18 @@ def analyze(
   keep_byproducts: bool = False,
   overwrite: bool = False,
   multiprocess: bool = True,
+  pipeline: bool = False,
+  pipeline_workers: Optional[Dict[str, int]] = None,
+  batch_size: int = 1,
+  chunk_duration: Optional[float] = None,
+  cache_dir: Optional[PathLike] = None,
+  cache_size: Optional[float] = None,
+  callbacks: Optional[List[Callback]] = None,
+  metrics_file: Optional[PathLike] = None,
+  store_dir: Optional[PathLike] = None,
+  index: bool = False,
+  load_existing: bool = True,
+  shard: Optional[Tuple[int, int]] = None,
 ) -> Union[AnalysisResult, List[AnalysisResult]]:
   """
   Analyzes the provided audio files and returns the analysis results.
@@ -62,16 +88,71 @@ def analyze(
   spec_dir : PathLike, optional
       Path to the directory where the spectrograms will be saved. Default is './spec'.
   keep_byproducts : bool, optional
-      Whether to keep the source-separated audio and spectrograms or not. Default is False.
+      Whether to keep the source-separated audio and spectrograms or not. Default is False. If False, the stems and
+      spectrograms are passed to the model in memory and nothing is written to ``demix_dir`` and ``spec_dir``.
   overwrite : bool, optional
       Whether to overwrite the existing analysis results or not. Default is False.
   multiprocess : bool, optional
       Whether to use multiprocessing for spectrogram extraction, visualization, and sonification. Default is True.
+  pipeline : bool, optional
+      Whether to run source separation, spectrogram extraction, inference, postprocessing, and saving as
+      overlapping stages, so that each track moves through the stages on its own and the first results are
+      available while the rest of the batch is still being demixed. Default is False.
+  pipeline_workers : Dict[str, int], optional
+      Number of worker threads per stage in the pipelined mode, keyed by one of 'demix', 'spectrogram',
+      'inference', 'postprocess', and 'save'. Unspecified stages use the defaults in ``PIPELINE_WORKERS``.
+  batch_size : int, optional
+      Maximum number of tracks per forward pass. With the PyTorch attention backend (``NATTEN_API=torch``),
+      tracks of similar length are zero-padded to the longest one in the batch and the padding is masked,
+      so the results are the same as with a batch size of 1. The NATTEN kernels cannot mask the padding,
+      so with the other backends only tracks with the same number of frames are batched.
+      Larger batches are faster, especially on CPU. Not used in the pipelined mode. Default is 1.
+  chunk_duration : float, optional
+      If given, tracks longer than this many seconds are processed in overlapping windows of this duration,
+      which bounds the memory usage of the inference for very long tracks. The windows overlap by twice the
+      receptive field of the model (about 82 seconds for the pre-trained models), and only the frames that a
+      window sees with their full context are kept, so the outputs are the same as without chunking up to floating
+      point errors. The duration must therefore be longer than the overlap, i.e. than about 165 seconds.
+      By default, each track is processed at once.
+  cache_dir : PathLike, optional
+      Path to a content-addressed cache of stems, spectrograms and analysis results (see ``ContentCache``).
+      Entries are keyed by the hash of the audio content and the versions of the model and the processing,
+      so the same directory can be shared by several jobs, and duplicate tracks are only analyzed once.
+      With a cache, whether a track is already analyzed is decided by its content instead of the name of its
+      result in ``out_dir``, and the byproducts kept in ``demix_dir`` and ``spec_dir`` are recomputed for the
+      tracks missing from the cache. Stems and spectrograms are only cached without ``keep_byproducts``.
+      By default, nothing is cached.
+  cache_size : float, optional
+      Maximum size of the cache in gigabytes. The least recently used entries are deleted beyond it.
+      By default, the cache grows without bound.
+  callbacks : List[Callable[[StageMetrics], None]], optional
+      Functions called with the ``allin1.profiling.StageMetrics`` (wall time, CPU time and peak memory) of every
+      stage of every track: 'demix', 'spectrogram', 'inference', 'metrical', 'functional' and 'save'.
+      They may be called from several threads in the pipelined mode, but never concurrently.
+  metrics_file : PathLike, optional
+      Path to a JSON-lines file to which the metrics of every stage are appended.
+  store_dir : PathLike, optional
+      Path to a columnar store of results (see ``allin1.store.ResultStore``) to which the new results are appended.
+      They are also saved to ``out_dir`` unless it is None, which is what ``--store`` on the command line does
+      instead. Tracks already in the store are loaded from it instead of being analyzed again, unless
+      ``overwrite`` is True. By default, no store is used.
+  index : bool, optional
+      Whether to add the results saved to ``out_dir`` to a SQLite index of the directory, ``out_dir/index.sqlite``
+      (see ``allin1.index.ResultIndex``), which can be searched with ``allin1 query``. Default is False.
+  load_existing : bool, optional
+      Whether to load the results of the tracks that are already analyzed in ``out_dir`` or ``store_dir``.
+      If False, only the new results (including the ones found in the cache) are returned, visualized
+      and sonified. Default is True.
+  shard : Tuple[int, int], optional
+      ``(i, n)`` to only analyze the ``i``-th of ``n`` shards of the tracks (``0 <= i < n``), e.g. on one of ``n``
+      machines given the same tracks. The tracks are sorted by path and dealt out in turn. To share the tracks
+      dynamically between machines instead, see ``allin1.jobs.run_worker``. By default, all tracks are analyzed.
 
   Returns
   -------
   Union[AnalysisResult, List[AnalysisResult]]
-      Analysis results for the provided audio files.
+      Analysis results for the provided audio files. Without ``load_existing``, a single path that is already
+      analyzed returns None.
   """
 
   # Clean up the arguments.
@@ -81,83 +162,206 @@ def analyze(
     paths = [paths]
   if not paths:
     raise ValueError('At least one path must be specified.')
+  if batch_size < 1:
+    raise ValueError(f'batch_size must be a positive integer, got {batch_size}.')
+  if chunk_duration is not None and chunk_duration <= 0:
+    raise ValueError(f'chunk_duration must be positive, got {chunk_duration}.')
+  if index and out_dir is None:
+    raise ValueError('index requires out_dir, since the index points to the result files saved there.')
+  model_name = model
   paths = [mkpath(p) for p in paths]
-  paths = expand_paths(paths)
+  paths = select_shard(expand_paths(paths), shard)
+  if shard is not None:
+    print(f'=> Analyzing shard {shard[0]}/{shard[1]} of {len(paths)} tracks.')
   check_paths(paths)
+  check_unique_names(paths)
   demix_dir = mkpath(demix_dir)
   spec_dir = mkpath(spec_dir)
 
+  profiler = None
+  if callbacks or metrics_file is not None:
+    profiler = Profiler(callbacks or [])
+    if metrics_file is not None:
+      profiler.callbacks.append(JsonLinesWriter(metrics_file))
+
+  cache = None
+  if cache_dir is not None:
+    cache = ContentCache(cache_dir, max_size=None if cache_size is None else int(cache_size * 1e9))
+
   # Check if the results are already computed.
-  if out_dir is None or overwrite:
+  # With a cache, this is decided by the content of the tracks below rather than by the names of the results,
+  # which may belong to another file with the same name, or to the track before it was re-encoded.
+  if out_dir is None or overwrite or cache is not None:
     todo_paths = paths
     exist_paths = []
   else:
-    out_paths = [mkpath(out_dir) / path.with_suffix('.json').name for path in paths]
-    todo_paths = [path for path, out_path in zip(paths, out_paths) if not out_path.exists()]
-    exist_paths = [out_path for path, out_path in zip(paths, out_paths) if out_path.exists()]
+    out_dir = mkpath(out_dir)
+    out_paths = [out_dir / path.with_suffix('.json').name for path in paths]
+    exists = [out_path.exists() for out_path in out_paths]
+    todo_paths = [path for path, exist in zip(paths, exists) if not exist]
+    exist_paths = [out_path for out_path, exist in zip(out_paths, exists) if exist]
 
-  print(f'=> Found {len(exist_paths)} tracks already analyzed and {len(todo_paths)} tracks to analyze.')
-  if exist_paths:
-    print(f'=> To re-analyze, please use --overwrite option.')
+    print(f'=> Found {len(exist_paths)} tracks already analyzed and {len(todo_paths)} tracks to analyze.')
+    if exist_paths:
+      print(f'=> To re-analyze, please use --overwrite option.')
 
   # Load the results for the tracks that are already analyzed.
   results = []
-  if exist_paths:
-    results += [
-      load_result(
-        exist_path,
-        load_activations=include_activations,
-        load_embeddings=include_embeddings,
+  if exist_paths and load_existing:
+    results += load_results(
+      exist_paths,
+      load_activations=include_activations,
+      load_embeddings=include_embeddings,
+      progress=True,
+    )
+
+  result_index = None
+  if index and out_dir is not None:
+    result_index = ResultIndex(mkpath(out_dir) / INDEX_NAME)
+
+  store_writer = None
+  if store_dir is not None:
+    store = ResultStore(store_dir)
+    store_writer = store.writer()
+    if not overwrite:
+      stored_paths = [path for path in todo_paths if path in store]
+      if load_existing:
+        results += [
+          store.get(path, load_activations=include_activations, load_embeddings=include_embeddings)
+          for path in stored_paths
+        ]
+      todo_paths = [path for path in todo_paths if path not in store]
+      print(f'=> Found {len(stored_paths)} tracks in the store and {len(todo_paths)} tracks to analyze.')
+
+  # Reuse the results of tracks with the same content that were analyzed before, possibly under another name.
+  if cache is not None and todo_paths and not overwrite:
+    cached_paths = set()
+    for path in tqdm(todo_paths, desc='Looking up the cache'):
+      result = load_cached_result(
+        cache, path, model_name, chunk_duration, include_activations, include_embeddings,
       )
-      for exist_path in tqdm(exist_paths, desc='Loading existing results')
-    ]
+      if result is not None:
+        if out_dir is not None:
+          save_results(result, out_dir, result_index)
+        if store_writer is not None:
+          store_writer.add(result)
+        results.append(result)
+        cached_paths.add(path)
+    todo_paths = [path for path in todo_paths if path not in cached_paths]
+    print(f'=> Found {len(cached_paths)} tracks in the cache and {len(todo_paths)} tracks to analyze.')
 
   # Analyze the tracks that are not analyzed yet.
-  if todo_paths:
-    # Run HTDemucs for source separation only for the tracks that are not analyzed yet.
-    demix_paths = demix(todo_paths, demix_dir, 'cpu')
+  demix_paths, spec_paths = [], []
+  if todo_paths and pipeline:
+    demix_paths, spec_paths, new_results = _analyze_pipelined(
+      paths=todo_paths,
+      out_dir=out_dir,
+      model=model,
+      device=device,
+      include_activations=include_activations,
+      include_embeddings=include_embeddings,
+      demix_dir=demix_dir,
+      spec_dir=spec_dir,
+      keep_byproducts=keep_byproducts,
+      overwrite=overwrite,
+      workers=pipeline_workers,
+      chunk_duration=chunk_duration,
+      cache=cache,
+      profiler=profiler,
+      store_writer=store_writer,
+      result_index=result_index,
+    )
+    results += new_results
+  elif todo_paths:
+    if keep_byproducts:
+      # Run HTDemucs for source separation only for the tracks that are not analyzed yet.
+      # With a cache, the byproducts found by name may come from another file, so they are recomputed.
+      with measure(profiler, 'demix', todo_paths):
+        demix_paths = demix(todo_paths, demix_dir, 'cpu', overwrite=overwrite or cache is not None)
 
-    # Extract spectrograms for the tracks that are not analyzed yet.
-    spec_paths = extract_spectrograms(demix_paths, spec_dir, multiprocess, overwrite)
+      # Extract spectrograms for the tracks that are not analyzed yet.
+      with measure(profiler, 'spectrogram', todo_paths):
+        spec_paths = extract_spectrograms(demix_paths, spec_dir, multiprocess, overwrite or cache is not None)
+    else:
+      # The byproducts would be deleted right after the analysis anyway,
+      # so the stems and spectrograms are handed over in memory instead of going through the disk.
+      separator = get_separator('htdemucs', 'cpu')
+      frontend = SpectrogramFrontend()
 
     # Load the model.
     model = load_pretrained_model(
       model_name=model,
       device=device,
     )
+    chunk_size = None if chunk_duration is None else int(chunk_duration * model.cfg.fps)
+
+    def load_spec(i: int, path: Path):
+      if keep_byproducts:
+        return np.load(spec_paths[i])
+      if cache is not None:
+        return load_cached_spectrogram(cache, path, separator, frontend, profiler)
+      with measure(profiler, 'demix', [path]):
+        stems = separator.separate(path, clip='rescale')
+      with measure(profiler, 'spectrogram', [path]):
+        return extract_spectrogram_from_stems(stems, frontend, separator.samplerate)
 
     with torch.no_grad():
-      pbar = tqdm(zip(todo_paths, spec_paths), total=len(todo_paths))
-      for path, spec_path in pbar:
-        pbar.set_description(f'Analyzing {path.name}')
+      # Tracks are grouped by length within windows of a few batches,
+      # so that only one window of spectrograms is held in memory at a time.
+      window_size = batch_size if batch_size == 1 else batch_size * BATCH_WINDOW
+      pbar = tqdm(total=len(todo_paths))
+      for start in range(0, len(todo_paths), window_size):
+        window_paths = todo_paths[start:start + window_size]
+        pbar.set_description(f'Analyzing {window_paths[0].name}')
 
-        result = run_inference(
-          path=path,
-          spec_path=spec_path,
+        specs = [load_spec(start + j, path) for j, path in enumerate(window_paths)]
+        window_results = run_batched_inference(
+          paths=window_paths,
+          specs=specs,
           model=model,
           device=device,
           include_activations=include_activations,
           include_embeddings=include_embeddings,
+          batch_size=batch_size,
+          chunk_size=chunk_size,
+          profiler=profiler,
         )
 
-        # Save the result right after the inference.
-        # Checkpointing is always important for this kind of long-running tasks...
-        # for my mental health...
-        if out_dir is not None:
-          save_results(result, out_dir)
+        for result in window_results:
+          # Save the result right after the inference.
+          # Checkpointing is always important for this kind of long-running tasks...
+          # for my mental health...
+          with measure(profiler, 'save', [result.path]):
+            if out_dir is not None:
+              save_results(result, out_dir, result_index)
+            if store_writer is not None:
+              store_writer.add(result)
+            if cache is not None:
+              save_cached_result(cache, result, model_name, chunk_duration)
 
-        results.append(result)
+          results.append(result)
+        pbar.update(len(window_paths))
+      pbar.close()
+
+  if store_writer is not None:
+    store_writer.flush()
+  if result_index is not None:
+    result_index.close()
 
   # Sort the results by the original order of the tracks.
-  results = sorted(results, key=lambda result: paths.index(result.path))
+  order = {path: i for i, path in enumerate(paths)}
+  results.sort(key=lambda result: order[result.path])
 
+  # Visualization and sonification need matplotlib and Demucs, which are only imported when used.
   if visualize:
+    from .visualize import visualize as _visualize
     if visualize is True:
       visualize = './viz'
     _visualize(results, out_dir=visualize, multiprocess=multiprocess)
     print(f'=> Plots are successfully saved to {visualize}')
 
   if sonify:
+    from .sonify import sonify as _sonify
     if sonify is True:
       sonify = './sonif'
     _sonify(results, out_dir=sonify, multiprocess=multiprocess)
@@ -176,5 +380,126 @@ def analyze(
     rmdir_if_empty(spec_dir)
 
   if not return_list:
-    return results[0]
+    return results[0] if results else None
   return results
+
+
+# Number of batches whose tracks are sorted by length together in the batched inference.
+BATCH_WINDOW = 4
+
+PIPELINE_WORKERS = {
+  'demix': 1,
+  'spectrogram': 2,
+  'inference': 1,
+  'postprocess': 2,
+  'save': 1,
+}
+
+
+def _analyze_pipelined(
+  paths: List[Path],
+  out_dir: Optional[PathLike],
+  model: str,
+  device: str,
+  include_activations: bool,
+  include_embeddings: bool,
+  demix_dir: Path,
+  spec_dir: Path,
+  keep_byproducts: bool,
+  overwrite: bool,
+  workers: Optional[Dict[str, int]] = None,
+  chunk_duration: Optional[float] = None,
+  cache: Optional[ContentCache] = None,
+  profiler: Optional[Profiler] = None,
+  store_writer: Optional[ResultStoreWriter] = None,
+  result_index: Optional[ResultIndex] = None,
+):
+  workers = {**PIPELINE_WORKERS, **(workers or {})}
+  unknown = set(workers) - set(PIPELINE_WORKERS)
+  if unknown:
+    raise ValueError(f'Unknown pipeline stages: {sorted(unknown)} (expected some of {list(PIPELINE_WORKERS)})')
+
+  if keep_byproducts:
+    demix_paths = [demix_dir / 'htdemucs' / path.stem for path in paths]
+    spec_paths = [spec_dir / f'{demix_path.name}.npy' for demix_path in demix_paths]
+  else:
+    # Stems and spectrograms are passed between the stages in memory.
+    demix_paths, spec_paths = [], []
+    separator = get_separator('htdemucs', 'cpu')
+
+  model_name = model
+  model = load_pretrained_model(
+    model_name=model,
+    device=device,
+  )
+  chunk_size = None if chunk_duration is None else int(chunk_duration * model.cfg.fps)
+
+  # The frontend keeps no state between calls, so the spectrogram workers share it.
+  frontend = SpectrogramFrontend()
+
+  # With a cache, the byproducts found by name may come from another file, so they are recomputed.
+  refresh = overwrite or cache is not None
+
+  def demix_stage(path: Path):
+    if not keep_byproducts and cache is not None:
+      # The spectrogram is looked up here, so that cached tracks are not separated at all.
+      return path, load_cached_spectrogram(cache, path, separator, frontend, profiler)
+    with measure(profiler, 'demix', [path]):
+      if not keep_byproducts:
+        return path, separator.separate(path, clip='rescale')
+      return path, demix_track(path, demix_dir, 'cpu', overwrite=refresh)
+
+  def spectrogram_stage(job):
+    path, demixed = job
+    if isinstance(demixed, np.ndarray):
+      return path, demixed
+    with measure(profiler, 'spectrogram', [path]):
+      if not keep_byproducts:
+        return path, extract_spectrogram_from_stems(demixed, frontend, separator.samplerate)
+      spec_path = extract_spectrogram(demixed, spec_dir, frontend, refresh)
+      return path, np.load(spec_path)
+
+  @torch.no_grad()
+  def inference_stage(job):
+    path, spec = job
+    spec = torch.from_numpy(spec).unsqueeze(0).to(device)
+    with measure(profiler, 'inference', [path]):
+      return path, forward_chunked(model, spec, chunk_size)
+
+  @torch.no_grad()
+  def postprocess_stage(job):
+    path, logits = job
+    return postprocess_logits(
+      path=path,
+      logits=logits,
+      cfg=model.cfg,
+      include_activations=include_activations,
+      include_embeddings=include_embeddings,
+      profiler=profiler,
+    )
+
+  def save_stage(result: AnalysisResult):
+    with measure(profiler, 'save', [result.path]):
+      if out_dir is not None:
+        save_results(result, out_dir, result_index)
+      if store_writer is not None:
+        store_writer.add(result)
+      if cache is not None:
+        save_cached_result(cache, result, model_name, chunk_duration)
+    return result
+
+  stages = [
+    Stage('demix', demix_stage, workers['demix']),
+    Stage('spectrogram', spectrogram_stage, workers['spectrogram']),
+    Stage('inference', inference_stage, workers['inference']),
+    Stage('postprocess', postprocess_stage, workers['postprocess']),
+    Stage('save', save_stage, workers['save']),
+  ]
+
+  results = []
+  pbar = tqdm(run_pipeline(paths, stages), total=len(paths), desc='Analyzing (pipelined)')
+  for _, result in pbar:
+    pbar.set_postfix_str(result.path.name)
+    results.append(result)
+
+  return demix_paths, spec_paths, results
@@ -0,0 +1,317 @@
+"""Benchmarks every stage of the analysis on synthetic audio with randomly initialized models.
+
+Nothing is downloaded, so the benchmark also runs offline. The stems are generated instead of separated,
+and the models have the architecture of the pre-trained ones but random weights, which does not change
+their speed. Run ``allin1-bench --help`` for the options.
+"""
+
+import argparse
+import json
+import platform
+import tempfile
+import numpy as np
+import torch
+
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+from numpy.typing import NDArray
+from omegaconf import OmegaConf
+from .__about__ import __version__
+from .config import Config, HarmonixConfig
+from .helpers import compute_activations, forward_chunked, save_result
+from .models.allinone import AllInOne
+from .models.ensemble import Ensemble, default_fused
+from .postprocessing import (
+  postprocess_functional_structure,
+  postprocess_metrical_structure,
+  estimate_tempo_from_beats,
+)
+from .profiling import Profiler, StageMetrics
+from .spectrogram import STEMS, SpectrogramFrontend, extract_spectrogram_from_stems
+from .typings import AllInOneOutput, AnalysisResult
+from .utils import load_result
+
+BENCHMARK_STAGES = ['spectrogram', 'fold', 'ensemble', 'metrical', 'functional', 'save', 'load']
+
+
+@dataclass
+class BenchmarkResult:
+  """The best of the repeated measurements of a stage on audio of ``duration`` seconds."""
+  duration: float
+  stage: str
+  wall_time: float
+  cpu_time: float
+  # Audio seconds processed per wall-clock second.
+  throughput: float
+  peak_rss: Optional[int]
+  peak_rss_increase: Optional[int]
+  # Peak memory allocated by PyTorch on the GPU during the stage, if it runs on one.
+  peak_cuda_memory: Optional[int] = None
+
+
+def synthetic_stems(
+  duration: float,
+  sample_rate: int = 44100,
+  bpm: float = 120.,
+  seed: int = 0,
+  block_duration: float = 60.,
+) -> Dict[str, NDArray]:
+  """
+  Returns mono int16 stems of ``duration`` seconds with a steady beat, a chord progression that changes
+  every bar and a new progression every eight bars, so that every stage has events to work with.
+  The audio is generated in blocks of ``block_duration`` seconds to bound the memory usage of long durations.
+  """
+  rng = np.random.default_rng(seed)
+  beat_period = 60 / bpm
+  bar_period = 4 * beat_period
+  num_samples = int(duration * sample_rate)
+  num_bars = int(np.ceil(duration / bar_period)) + 1
+  # A random progression of roots (in semitones) per section of eight bars.
+  progressions = rng.integers(0, 12, size=(num_bars // 8 + 1, 8))
+  roots = progressions.reshape(-1)[:num_bars]
+  melody = rng.integers(0, 12, size=4 * num_bars)
+
+  stems = {stem: np.empty(num_samples, dtype=np.int16) for stem in STEMS}
+  block_size = int(block_duration * sample_rate)
+  for start in range(0, num_samples, block_size):
+    t = np.arange(start, min(start + block_size, num_samples)) / sample_rate
+    beat_phase = (t % beat_period).astype(np.float32)
+    bar = (t // bar_period).astype(np.int64)
+    beat = (t // beat_period).astype(np.int64)
+    root = 55 * 2 ** (roots[bar] / 12)
+
+    drums = (
+      np.sin(2 * np.pi * 60 * beat_phase) * np.exp(-10 * beat_phase)
+      + 0.3 * rng.standard_normal(len(t), dtype=np.float32) * np.exp(-40 * beat_phase)
+    )
+    bass = np.sin(2 * np.pi * root * t) * np.exp(-3 * beat_phase)
+    other = sum(np.sin(2 * np.pi * root * 4 * 2 ** (interval / 12) * t) for interval in [0, 4, 7]) / 3
+    vibrato = 0.5 * np.sin(2 * np.pi * 5 * t)
+    vocals = np.sin(2 * np.pi * 440 * 2 ** (melody[beat] / 12) * t + vibrato) * (beat_phase < 0.8 * beat_period)
+
+    for stem, wav in zip(STEMS, [bass, drums, other, vocals]):
+      stems[stem][start:start + len(t)] = (0.5 * np.clip(wav, -1, 1) * (2 ** 15 - 1)).astype(np.int16)
+  return stems
+
+
+def synthetic_logits(outputs: AllInOneOutput, cfg: Config, bpm: float = 120., seed: int = 0) -> AllInOneOutput:
+  """
+  Returns logits that peak on the beats, downbeats and sections of ``synthetic_stems``, with some noise,
+  and the embeddings of ``outputs``.
+  """
+  rng = np.random.default_rng(seed)
+  num_frames = outputs.logits_beat.shape[-1]
+  beat = np.arange(0, num_frames, 60 / bpm * cfg.fps)
+  num_beats = len(beat)
+  frames = np.arange(num_frames)
+
+  def peaks(times: NDArray) -> NDArray:
+    i = np.clip(np.searchsorted(times, frames), 1, len(times) - 1)
+    distance = np.minimum(np.abs(frames - times[i - 1]), np.abs(frames - times[i]))
+    probs = 0.9 * np.exp(-0.5 * (distance / 1.5) ** 2) + rng.uniform(0, 0.05, num_frames)
+    return np.log(probs / (1 - probs))
+
+  # The logits of a section are raised for its label, which changes every 32 beats (eight bars).
+  labels = rng.integers(2, cfg.data.num_labels, size=num_beats // 32 + 1)
+  logits_function = rng.normal(0, 0.5, size=(cfg.data.num_labels, num_frames))
+  logits_function[labels[np.minimum(frames // (32 * 60 / bpm * cfg.fps), len(labels) - 1).astype(int)], frames] += 3
+
+  def tensor(x: NDArray) -> torch.Tensor:
+    return torch.from_numpy(x[None].astype(np.float32)).to(outputs.logits_beat.device)
+
+  return AllInOneOutput(
+    logits_beat=tensor(peaks(beat)),
+    logits_downbeat=tensor(peaks(beat[::4])),
+    logits_section=tensor(peaks(beat[::32])),
+    logits_function=tensor(logits_function),
+    embeddings=outputs.embeddings,
+  )
+
+
+def make_models(num_folds: int, cfg: Optional[Config] = None, device: str = 'cpu', seed: int = 0) -> List[AllInOne]:
+  """Returns ``num_folds`` models with the architecture of the pre-trained ones (or of ``cfg``) and random weights."""
+  if cfg is None:
+    cfg = OmegaConf.structured(Config(data=HarmonixConfig()))
+    cfg.best_threshold_beat = cfg.threshold_beat
+    cfg.best_threshold_downbeat = cfg.threshold_downbeat
+  torch.manual_seed(seed)
+  return [AllInOne(cfg).to(device).eval() for _ in range(num_folds)]
+
+
+def run_benchmark(
+  durations: Sequence[float],
+  num_folds: int = 8,
+  device: str = 'cpu',
+  repeats: int = 1,
+  chunk_duration: Optional[float] = None,
+  include_activations: bool = False,
+  include_embeddings: bool = False,
+  cfg: Optional[Config] = None,
+  seed: int = 0,
+) -> List[BenchmarkResult]:
+  """
+  Runs every stage in isolation on synthetic audio of each of ``durations`` seconds, and returns
+  the fastest of ``repeats`` runs of each stage. 'fold' is the forward pass of a single model,
+  'ensemble' the forward pass of ``num_folds`` models, and 'save' and 'load' write and read the result as JSON.
+  Every stage runs once on a short clip first, so that one-time initializations are not measured.
+  """
+  models = make_models(num_folds, cfg, device, seed)
+  ensemble = Ensemble(models, fused=default_fused(device)).to(device).eval()
+  frontend = SpectrogramFrontend()
+
+  _run_stages(5., models[0], ensemble, frontend, Profiler(), device, None, include_activations,
+              include_embeddings, seed)
+
+  results = []
+  for duration in durations:
+    metrics: List[StageMetrics] = []
+    cuda_peaks: List[Optional[int]] = []
+
+    def collect(m: StageMetrics):
+      metrics.append(m)
+      cuda_peaks.append(torch.cuda.max_memory_allocated() if torch.device(device).type == 'cuda' else None)
+      if torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+
+    profiler = Profiler([collect])
+    for _ in range(repeats):
+      _run_stages(duration, models[0], ensemble, frontend, profiler, device, chunk_duration, include_activations,
+                  include_embeddings, seed)
+
+    for stage in BENCHMARK_STAGES:
+      measured = [(m, peak) for m, peak in zip(metrics, cuda_peaks) if m.stage == stage]
+      best, peak = min(measured, key=lambda x: x[0].wall_time)
+      results.append(BenchmarkResult(
+        duration=duration,
+        stage=stage,
+        wall_time=best.wall_time,
+        cpu_time=best.cpu_time,
+        throughput=duration / best.wall_time,
+        peak_rss=best.peak_rss,
+        peak_rss_increase=best.peak_rss_increase,
+        peak_cuda_memory=peak,
+      ))
+  return results
+
+
+@torch.no_grad()
+def _run_stages(
+  duration: float,
+  model: AllInOne,
+  ensemble: Ensemble,
+  frontend: SpectrogramFrontend,
+  profiler: Profiler,
+  device: str,
+  chunk_duration: Optional[float],
+  include_activations: bool,
+  include_embeddings: bool,
+  seed: int,
+):
+  name = f'synthetic-{duration:g}s.wav'
+  paths = [name]
+  cfg = ensemble.cfg
+  chunk_size = None if chunk_duration is None else int(chunk_duration * cfg.fps)
+  stems = synthetic_stems(duration, frontend.sample_rate, seed=seed)
+  if torch.device(device).type == 'cuda':
+    torch.cuda.reset_peak_memory_stats()
+
+  with profiler.stage('spectrogram', paths):
+    spec = extract_spectrogram_from_stems(stems, frontend, frontend.sample_rate)
+  del stems
+  spec = torch.from_numpy(spec).unsqueeze(0).to(device)
+
+  with profiler.stage('fold', paths):
+    forward_chunked(model, spec, chunk_size)
+  with profiler.stage('ensemble', paths):
+    outputs = forward_chunked(ensemble, spec, chunk_size)
+  # The outputs of random models have hardly any peaks, which would make the postprocessing unrealistically fast.
+  logits = synthetic_logits(outputs, cfg, seed=seed)
+  with profiler.stage('metrical', paths):
+    metrical_structure = postprocess_metrical_structure(logits, cfg)
+  with profiler.stage('functional', paths):
+    functional_structure = postprocess_functional_structure(logits, cfg)
+
+  bpm = estimate_tempo_from_beats(metrical_structure['beats'])
+  result = AnalysisResult(path=Path(name), bpm=bpm, segments=functional_structure, **metrical_structure)
+  if include_activations:
+    result.activations = compute_activations(logits)
+  if include_embeddings:
+    result.embeddings = logits.embeddings[0].cpu().numpy()
+  with tempfile.TemporaryDirectory() as out_dir:
+    out_path = Path(out_dir) / Path(name).with_suffix('.json')
+    with profiler.stage('save', paths):
+      save_result(result, out_path)
+    with profiler.stage('load', paths):
+      load_result(out_path, load_activations=include_activations, load_embeddings=include_embeddings)
+
+
+def format_results(results: List[BenchmarkResult]) -> str:
+  lines = [f'{"duration":>9} {"stage":<12} {"wall (s)":>10} {"cpu (s)":>10} {"audio s/s":>10} {"peak RSS (MB)":>14}']
+  for r in results:
+    peak_rss = '-' if r.peak_rss is None else f'{r.peak_rss / 2 ** 20:.0f}'
+    lines.append(
+      f'{r.duration:>8g}s {r.stage:<12} {r.wall_time:>10.3f} {r.cpu_time:>10.3f} {r.throughput:>10.1f} {peak_rss:>14}'
+    )
+  return '\n'.join(lines)
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('-t', '--durations', type=float, nargs='+', default=[30, 300],
+                      help='Durations of the synthetic tracks in seconds, e.g. 30 to 3600 (default: 30 300)')
+  parser.add_argument('-f', '--folds', type=int, default=8,
+                      help='Number of models in the ensemble (default: 8, like harmonix-all)')
+  parser.add_argument('-d', '--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                      help='Device to use (default: cuda if available else cpu)')
+  parser.add_argument('-r', '--repeats', type=int, default=1,
+                      help='Number of runs per duration, of which the fastest is reported (default: 1)')
+  parser.add_argument('--chunk-duration', type=float, default=None,
+                      help='Run the models over overlapping windows of this many seconds (default: whole tracks)')
+  parser.add_argument('-a', '--activ', action='store_true',
+                      help='Save and load the activations with the results (default: False)')
+  parser.add_argument('-e', '--embed', action='store_true',
+                      help='Save and load the embeddings with the results (default: False)')
+  parser.add_argument('--threads', type=int, default=None,
+                      help='Number of threads used by PyTorch (default: PyTorch default)')
+  parser.add_argument('--seed', type=int, default=0,
+                      help='Seed of the synthetic audio and the model weights (default: 0)')
+  parser.add_argument('-o', '--output', type=Path, default=None,
+                      help='Path to a JSON-lines file to which the results are appended (default: none)')
+  return parser
+
+
+def main():
+  parser = make_parser()
+  args = parser.parse_args()
+  if args.repeats < 1:
+    parser.error('--repeats must be at least 1.')
+  if args.threads is not None:
+    torch.set_num_threads(args.threads)
+
+  print(
+    f'=> allin1 {__version__}, torch {torch.__version__}, python {platform.python_version()}, '
+    f'device {args.device}, {torch.get_num_threads()} threads'
+  )
+  results = run_benchmark(
+    durations=args.durations,
+    num_folds=args.folds,
+    device=args.device,
+    repeats=args.repeats,
+    chunk_duration=args.chunk_duration,
+    include_activations=args.activ,
+    include_embeddings=args.embed,
+    seed=args.seed,
+  )
+  print(format_results(results))
+
+  if args.output is not None:
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, 'a') as f:
+      for result in results:
+        f.write(json.dumps(asdict(result)) + '\n')
+    print(f'=> Results are appended to {args.output}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,247 @@
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+import numpy as np
+
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from numpy.typing import NDArray
+from .__about__ import __version__
+from .demix import Separator
+from .helpers import save_result
+from .profiling import Profiler, measure
+from .spectrogram import STEMS, SpectrogramFrontend, extract_spectrogram_from_stems, _to_int16
+from .typings import AnalysisResult, PathLike
+from .utils import mkpath
+
+_TMP_PREFIX = '.tmp-'
+
+
+class ContentCache:
+  """
+  Content-addressed store for stems, spectrograms and analysis results.
+
+  Entries are keyed by the hash of the audio content and the versions of whatever produced them
+  (see ``make_key``), so files with the same name never collide and re-encoded files are recomputed.
+  Entries are written to a temporary path and renamed into place, which makes the cache safe to share
+  between concurrent jobs and machines on a shared filesystem. Reading an entry refreshes its modification
+  time, and once the cache grows above ``max_size`` bytes the least recently used entries are deleted.
+  """
+
+  def __init__(self, root: PathLike, max_size: Optional[int] = None):
+    self.root = mkpath(root)
+    self.max_size = max_size
+    self._hashes: Dict[Tuple[Path, int, int], str] = {}
+    self._lock = threading.Lock()
+    # Running estimate of the cache size, so that the cache is only scanned when it might be too large.
+    self._size: Optional[int] = None
+
+  def audio_hash(self, path: PathLike) -> str:
+    """Returns the SHA-256 of the file content, memoized by path, size and modification time."""
+    path = mkpath(path)
+    stat = path.stat()
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    if memo_key not in self._hashes:
+      digest = hashlib.sha256()
+      with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+          digest.update(block)
+      self._hashes[memo_key] = digest.hexdigest()
+    return self._hashes[memo_key]
+
+  def entry_path(self, kind: str, key: str, suffix: str = '') -> Path:
+    return self.root / kind / key[:2] / f'{key}{suffix}'
+
+  def get(self, kind: str, key: str, suffix: str = '') -> Optional[Path]:
+    """Returns the path of an entry if it exists, and marks it as recently used."""
+    path = self.entry_path(kind, key, suffix)
+    try:
+      os.utime(path)
+    except FileNotFoundError:
+      return None
+    return path
+
+  def put(self, kind: str, key: str, write: Callable[[Path], None], suffix: str = '') -> Path:
+    """
+    Creates an entry with ``write(path)``, which may write a file or a directory at ``path``.
+    An existing entry with the same key is replaced.
+    """
+    path = self.entry_path(kind, key, suffix)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'{_TMP_PREFIX}{uuid.uuid4().hex}-{path.name}')
+    try:
+      write(tmp_path)
+      size = _size(tmp_path)
+      if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+      try:
+        os.replace(tmp_path, path)
+      except OSError:
+        if not path.is_dir():
+          raise
+        # Another job has just written the same directory entry.
+    finally:
+      _remove(tmp_path)
+
+    if self.max_size is not None:
+      with self._lock:
+        self._size = self.size() if self._size is None else self._size + size
+        evict = self._size > self.max_size
+      if evict:
+        self.evict(self.max_size)
+    return path
+
+  def entries(self) -> List[Tuple[Path, int, float]]:
+    """Returns the (path, size in bytes, last use) of every entry."""
+    entries = []
+    for shard in self.root.glob('*/*'):
+      for path in shard.iterdir():
+        if path.name.startswith(_TMP_PREFIX):
+          continue
+        try:
+          entries.append((path, _size(path), path.stat().st_mtime))
+        except FileNotFoundError:
+          continue  # Evicted by another process.
+    return entries
+
+  def size(self) -> int:
+    return sum(size for _, size, _ in self.entries())
+
+  def evict(self, max_size: int):
+    """Deletes the least recently used entries until the cache holds at most ``max_size`` bytes."""
+    with self._lock:
+      entries = sorted(self.entries(), key=lambda entry: entry[2])
+      total = sum(size for _, size, _ in entries)
+      for path, size, _ in entries:
+        if total <= max_size:
+          break
+        _remove(path)
+        total -= size
+      self._size = total
+
+
+def _size(path: Path) -> int:
+  if path.is_dir():
+    return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+  return path.stat().st_size
+
+
+def _remove(path: Path):
+  if path.is_dir():
+    shutil.rmtree(path, ignore_errors=True)
+  else:
+    path.unlink(missing_ok=True)
+
+
+def make_key(audio_hash: str, *versions) -> str:
+  """Returns the key of an entry derived from the given audio with the given versions of the producers."""
+  return hashlib.sha256('\0'.join([audio_hash, *map(str, versions)]).encode()).hexdigest()
+
+
+def stems_version(separator: Separator) -> tuple:
+  return 'stems', separator.model_name, separator.shifts, separator.overlap, separator.split
+
+
+def spectrogram_version(separator: Separator, frontend: SpectrogramFrontend) -> tuple:
+  return (
+    *stems_version(separator),
+    'spec', frontend.sample_rate, frontend.frame_size, frontend.hop_size,
+    frontend.num_bands, frontend.fmin, frontend.fmax,
+  )
+
+
+def result_version(model_name: str, chunk_duration: Optional[float]) -> tuple:
+  # Chunked inference stitches the outputs of windows of chunk_duration seconds, so it is part of the key.
+  return 'result', __version__, model_name, chunk_duration
+
+
+def load_cached_spectrogram(
+  cache: ContentCache,
+  path: Path,
+  separator: Separator,
+  frontend: SpectrogramFrontend,
+  profiler: Optional[Profiler] = None,
+) -> NDArray:
+  """
+  Returns the spectrogram of a track from the cache, or computes it from the cached stems,
+  or from scratch. The missing stems and spectrogram are added to the cache.
+  Only the stages that actually run are measured by ``profiler``.
+  """
+  audio_hash = cache.audio_hash(path)
+  spec_key = make_key(audio_hash, *spectrogram_version(separator, frontend))
+  spec_path = cache.get('spec', spec_key, '.npy')
+  if spec_path is not None:
+    return np.load(spec_path)
+
+  stems_key = make_key(audio_hash, *stems_version(separator))
+  stems_path = cache.get('stems', stems_key, '.npz')
+  if stems_path is not None:
+    with np.load(stems_path) as data:
+      stems = {stem: data[stem] for stem in STEMS}
+  else:
+    with measure(profiler, 'demix', [path]):
+      # The spectrogram quantizes the stems to int16 anyway, so they are stored as such.
+      stems = {stem: _to_int16(wav) for stem, wav in separator.separate(path, clip='rescale').items()}
+      cache.put('stems', stems_key, lambda p: _save_npz(p, stems), '.npz')
+
+  with measure(profiler, 'spectrogram', [path]):
+    spec = extract_spectrogram_from_stems(stems, frontend, separator.samplerate)
+    cache.put('spec', spec_key, lambda p: _save_npy(p, spec), '.npy')
+  return spec
+
+
+def load_cached_result(
+  cache: ContentCache,
+  path: Path,
+  model_name: str,
+  chunk_duration: Optional[float],
+  include_activations: bool,
+  include_embeddings: bool,
+) -> Optional[AnalysisResult]:
+  """Returns the cached result of a track, or None if it is missing or lacks the requested activations."""
+  key = make_key(cache.audio_hash(path), *result_version(model_name, chunk_duration))
+  entry = cache.get('results', key)
+  if entry is None:
+    return None
+  if include_activations and not (entry / 'result.activ.npz').is_file():
+    return None
+  if include_embeddings and not (entry / 'result.embed.npy').is_file():
+    return None
+
+  try:
+    result = AnalysisResult.from_json(
+      entry / 'result.json',
+      load_activations=include_activations,
+      load_embeddings=include_embeddings,
+    )
+  except FileNotFoundError:
+    return None  # Evicted by another process.
+  result.path = path
+  return result
+
+
+def save_cached_result(
+  cache: ContentCache,
+  result: AnalysisResult,
+  model_name: str,
+  chunk_duration: Optional[float],
+):
+  key = make_key(cache.audio_hash(result.path), *result_version(model_name, chunk_duration))
+
+  def write(entry: Path):
+    entry.mkdir()
+    save_result(result, entry / 'result.json')
+
+  cache.put('results', key, write)
+
+
+def _save_npy(path: Path, array: NDArray):
+  with open(path, 'wb') as f:
+    np.save(f, array)
+
+
+def _save_npz(path: Path, arrays: Dict[str, NDArray]):
+  with open(path, 'wb') as f:
+    np.savez(f, **arrays)
@@ -1,14 +1,14 @@
 import argparse
-import torch
+import importlib
+import sys
 
 from pathlib import Path
-from .analyze import analyze
 
 
 def make_parser():
   cwd = Path.cwd()
   parser = argparse.ArgumentParser()
-  parser.add_argument('paths', nargs='+', type=Path, default=[], help='Path to tracks')
+  parser.add_argument('paths', nargs='*', type=Path, default=[], help='Path to tracks')
   parser.add_argument('-o', '--out-dir', type=Path, default=cwd / './struct',
                       help='Path to a directory to store analysis results (default: ./struct)')
   parser.add_argument('-v', '--visualize', action='store_true', default=False,
@@ -25,7 +25,7 @@ def make_parser():
                       help='Save frame-level embeddings (default: False)')
   parser.add_argument('-m', '--model', type=str, default='harmonix-all',
                       help='Name of the pretrained model to use (default: harmonix-all)')
-  parser.add_argument('-d', '--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+  parser.add_argument('-d', '--device', type=str, default=None,
                       help='Device to use (default: cuda if available else cpu)')
   parser.add_argument('-k', '--keep-byproducts', action='store_true',
                       help='Keep demixed audio files and spectrograms (default: False)')
@@ -37,26 +37,94 @@ def make_parser():
                       help='Overwrite existing files (default: False)')
   parser.add_argument('--no-multiprocess', action='store_true', default=False,
                       help='Disable multiprocessing (default: False)')
+  parser.add_argument('-b', '--batch-size', type=int, default=1,
+                      help='Maximum number of tracks per forward pass, grouped by similar length and masked with '
+                           'NATTEN_API=torch, or of equal length with the NATTEN kernels (default: 1)')
+  parser.add_argument('--pipeline', action='store_true', default=False,
+                      help='Overlap demixing, spectrogram extraction, inference and saving across tracks '
+                           '(default: False)')
+  parser.add_argument('--chunk-duration', type=float, default=None,
+                      help='Process tracks longer than this many seconds in overlapping windows to bound the memory '
+                           'usage. Must be more than about 165 seconds, twice the receptive field of the model '
+                           '(default: process each track at once)')
+  parser.add_argument('--cache-dir', type=Path, default=None,
+                      help='Path to a content-addressed cache of stems, spectrograms and results, keyed by the '
+                           'audio content, which can be shared by several jobs (default: no cache)')
+  parser.add_argument('--cache-size', type=float, default=None,
+                      help='Maximum size of the cache in gigabytes, beyond which the least recently used entries '
+                           'are deleted (default: unlimited)')
+  parser.add_argument('--metrics-file', type=Path, default=None,
+                      help='Append the wall time, CPU time and peak memory of every stage of every track to this '
+                           'JSON-lines file (default: no metrics)')
+  parser.add_argument('--store', type=Path, default=None,
+                      help='Append the results to a columnar store in this directory instead of writing one JSON '
+                           'file per track to --out-dir, and skip the tracks already in it. Cannot be combined with '
+                           '--index (default: no store)')
+  parser.add_argument('--index', action='store_true', default=False,
+                      help='Maintain a SQLite index of the results in --out-dir, which can be searched with '
+                           '`allin1 query` (default: False)')
+  parser.add_argument('--shard', type=parse_shard, default=None, metavar='I/N',
+                      help='Only analyze the I-th of N shards of the tracks (0 <= I < N), e.g. on one of N machines '
+                           'given the same tracks (default: all tracks)')
+  parser.add_argument('--manifest', type=Path, default=None,
+                      help='Text file listing tracks to analyze, one per line, in addition to the paths. The tracks '
+                           'are claimed through lock files in --out-dir, so that several workers sharing it analyze '
+                           'each track once, and resume where they stopped (default: no manifest)')
+  parser.add_argument('--claim-size', type=int, default=None,
+                      help='Number of tracks claimed at once with --manifest (default: --batch-size)')
+  parser.add_argument('--worker-id', type=str, default=None,
+                      help='Name of this worker in the status of the tracks with --manifest (default: host-pid)')
+  parser.add_argument('--stale-after', type=float, default=3600.,
+                      help='Seconds without a heartbeat after which the claims of workers on other machines are '
+                           'taken over with --manifest. Claims of crashed workers on this machine are taken over '
+                           'right away (default: 3600)')
+  parser.add_argument('--retry-failed', action='store_true', default=False,
+                      help='Retry the tracks that failed before with --manifest (default: False)')
 
   return parser
 
 
+def parse_shard(value: str):
+  try:
+    index, count = (int(v) for v in value.split('/'))
+  except ValueError:
+    raise argparse.ArgumentTypeError(f'expected I/N, got {value!r}')
+  if not 0 <= index < count:
+    raise argparse.ArgumentTypeError(f'expected 0 <= I < N, got {value!r}')
+  return index, count
+
+
+# Subcommands and the modules of their `main` functions.
+SUBCOMMANDS = {
+  'serve': '.server',
+  'query': '.index',
+}
+
+
 def main():
+  if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+    subcommand = importlib.import_module(SUBCOMMANDS[sys.argv[1]], __package__)
+    return subcommand.main(sys.argv[2:])
+
   parser = make_parser()
   args = parser.parse_args()
 
-  if not args.paths:
-    raise ValueError('At least one path must be specified.')
+  if not args.paths and args.manifest is None:
+    raise ValueError('At least one path or a manifest must be specified.')
 
   assert args.out_dir is not None, 'Output directory must be specified with --out-dir'
+  if args.store is not None and args.index:
+    parser.error('--index indexes the JSON files in --out-dir, which are not written with --store')
+
+  # Imported after parsing the arguments, so that `allin1 -h` and argument errors do not wait for PyTorch.
+  import torch
+  from .analyze import analyze
 
-  analyze(
-    paths=args.paths,
-    out_dir=args.out_dir,
+  kwargs = dict(
     visualize=args.viz_dir if args.visualize else False,
     sonify=args.sonif_dir if args.sonify else False,
     model=args.model,
-    device=args.device,
+    device=args.device or ('cuda' if torch.cuda.is_available() else 'cpu'),
     include_activations=args.activ,
     include_embeddings=args.embed,
     demix_dir=args.demix_dir,
@@ -64,9 +132,42 @@ def main():
     keep_byproducts=args.keep_byproducts,
     overwrite=args.overwrite,
     multiprocess=not args.no_multiprocess,
+    pipeline=args.pipeline,
+    batch_size=args.batch_size,
+    chunk_duration=args.chunk_duration,
+    cache_dir=args.cache_dir,
+    cache_size=args.cache_size,
+    metrics_file=args.metrics_file,
+    store_dir=args.store,
+    index=args.index,
+    shard=args.shard,
   )
 
-  print(f'=> Analysis results are successfully saved to {args.out_dir}')
+  if args.manifest is not None:
+    from .jobs import read_manifest, run_worker
+
+    # The statuses of the tracks are kept with their results, so they are saved to --out-dir even with --store.
+    counts = run_worker(
+      paths=read_manifest(args.manifest) + args.paths,
+      out_dir=args.out_dir,
+      claim_size=args.claim_size or args.batch_size,
+      worker_id=args.worker_id,
+      stale_after=args.stale_after,
+      retry_failed=args.retry_failed,
+      **kwargs,
+    )
+    print(f'=> Analyzed {counts["done"]} tracks, failed {counts["failed"]}, '
+          f'and skipped {counts["skipped"]} finished or claimed by other workers.')
+  else:
+    analyze(
+      paths=args.paths,
+      out_dir=None if args.store is not None else args.out_dir,
+      # The results of the tracks analyzed before are only needed to visualize or sonify them.
+      load_existing=args.visualize or args.sonify,
+      **kwargs,
+    )
+
+  print(f'=> Analysis results are successfully saved to {args.store or args.out_dir}')
 
 
 if __name__ == '__main__':
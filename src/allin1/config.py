@@ -35,6 +35,7 @@ class DataConfig:
   duration_max: float
 
   demucs_model: str = 'htdemucs'
+  path_target_dir: Optional[str] = None  # Precomputed targets written by allin1-preprocess, if any.
 
 
 @dataclass
@@ -51,6 +52,7 @@ class HarmonixConfig(DataConfig):
   path_feature_dir: str = './data/harmonix/features/'
   path_no_demixed_feature_dir: str = './data/harmonix/features_no_demixed/'
   path_metadata: str = './data/harmonix/metadata.csv'
+  path_target_dir: Optional[str] = './data/harmonix/targets/'
 
   duration_min: int = 76
   duration_max: int = 660
@@ -94,6 +96,11 @@ class Config:
   # Training configurations -----------------------------------------------
   segment_size: Optional[float] = 300
   batch_size: int = 1
+  # Validation and test tracks are not segmented, and are batched with tracks of similar length.
+  # The model does not mask the padding of shorter tracks, so their metrics depend on the batching above 1.
+  eval_batch_size: int = 1
+  # Number of training batches whose tracks are sorted by length together before batching.
+  bucket_pool_batches: int = 50
 
   optimizer: str = 'radam'
   sched: Optional[str] = 'plateau'
@@ -1,41 +1,150 @@
-import sys
-import subprocess
+import threading
 import torch
 
 from pathlib import Path
-from typing import List, Union
+from typing import Dict, List, Optional, Union
+from tqdm import tqdm
+from demucs.apply import apply_model
+from demucs.audio import prevent_clip, save_audio
+from demucs.pretrained import get_model
+from demucs.separate import load_track
+from .typings import PathLike
 
 
-def demix(paths: List[Path], demix_dir: Path, device: Union[str, torch.device]):
+class Separator:
+  """
+  Keeps a Demucs model resident in memory and separates tracks on demand.
+
+  The separation follows ``python -m demucs.separate`` with its default options, so the stems written by
+  ``separate_to_dir`` are the same as the ones the CLI would write, without paying for the interpreter start-up,
+  the torch import and the weight loading on every call.
+  """
+
+  def __init__(
+    self,
+    model_name: str = 'htdemucs',
+    device: Union[str, torch.device] = 'cpu',
+    shifts: int = 1,
+    overlap: float = 0.25,
+    split: bool = True,
+  ):
+    self.model_name = model_name
+    self.device = device
+    self.shifts = shifts
+    self.overlap = overlap
+    self.split = split
+
+    self.model = get_model(name=model_name)
+    self.model.cpu()
+    self.model.eval()
+
+  @property
+  def sources(self) -> List[str]:
+    return list(self.model.sources)
+
+  @property
+  def samplerate(self) -> int:
+    return self.model.samplerate
+
+  def separate_tensor(self, wav: torch.Tensor, clip: Optional[str] = None) -> Dict[str, torch.Tensor]:
+    """
+    Separates a waveform with shape (channels, samples) at ``self.samplerate`` into its sources.
+    If ``clip`` is given (e.g. 'rescale'), the sources are clipped the same way ``save_audio`` would do.
+    """
+    ref = wav.mean(0)
+    wav = (wav - ref.mean()) / ref.std()
+    with torch.no_grad():
+      sources = apply_model(
+        self.model,
+        wav[None],
+        device=self.device,
+        shifts=self.shifts,
+        split=self.split,
+        overlap=self.overlap,
+        progress=False,
+      )[0]
+    sources = sources * ref.std() + ref.mean()
+    if clip is not None:
+      sources = [prevent_clip(source, mode=clip) for source in sources]
+    return dict(zip(self.sources, sources))
+
+  def separate(self, path: PathLike, clip: Optional[str] = None) -> Dict[str, torch.Tensor]:
+    """Separates an audio file into its sources."""
+    wav = load_track(Path(path), self.model.audio_channels, self.samplerate)
+    return self.separate_tensor(wav, clip=clip)
+
+  def separate_to_dir(self, path: PathLike, out_dir: Path) -> Path:
+    """Separates an audio file and saves the sources as ``out_dir/<source>.wav``."""
+    sources = self.separate(path)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for name, source in sources.items():
+      save_audio(
+        source,
+        str(out_dir / f'{name}.wav'),
+        samplerate=self.samplerate,
+        clip='rescale',
+        as_float=False,
+        bits_per_sample=16,
+      )
+    return out_dir
+
+
+_SEPARATORS: Dict[tuple, Separator] = {}
+_SEPARATORS_LOCK = threading.Lock()
+
+
+def get_separator(model_name: str = 'htdemucs', device: Union[str, torch.device] = 'cpu') -> Separator:
+  """Returns a process-wide separator, loading the model only on the first call."""
+  key = (model_name, str(device))
+  with _SEPARATORS_LOCK:
+    if key not in _SEPARATORS:
+      _SEPARATORS[key] = Separator(model_name=model_name, device=device)
+    return _SEPARATORS[key]
+
+
+def demix(
+  paths: List[Path],
+  demix_dir: Path,
+  device: Union[str, torch.device],
+  separator: Optional[Separator] = None,
+  overwrite: bool = False,
+):
   """Demixes the audio file into its sources."""
   todos = []
   demix_paths = []
   for path in paths:
     out_dir = demix_dir / 'htdemucs' / path.stem
     demix_paths.append(out_dir)
-    if out_dir.is_dir():
-      if (
-        (out_dir / 'bass.wav').is_file() and
-        (out_dir / 'drums.wav').is_file() and
-        (out_dir / 'other.wav').is_file() and
-        (out_dir / 'vocals.wav').is_file()
-      ):
-        continue
-    todos.append(path)
+    if overwrite or not is_demixed(out_dir):
+      todos.append(path)
 
   existing = len(paths) - len(todos)
   print(f'=> Found {existing} tracks already demixed, {len(todos)} to demix.')
 
   if todos:
-    subprocess.run(
-      [
-        sys.executable, '-m', 'demucs.separate',
-        '--out', demix_dir.as_posix(),
-        '--name', 'htdemucs',
-        '--device', str(device),
-        *[path.as_posix() for path in todos],
-      ],
-      check=True,
-    )
+    if separator is None:
+      separator = get_separator('htdemucs', device)
+    for path in tqdm(todos, desc='Demixing', disable=len(todos) == 1):
+      separator.separate_to_dir(path, demix_dir / 'htdemucs' / path.stem)
 
   return demix_paths
+
+
+def demix_track(
+  path: Path,
+  demix_dir: Path,
+  device: Union[str, torch.device],
+  separator: Optional[Separator] = None,
+  overwrite: bool = False,
+) -> Path:
+  """Demixes a single audio file like ``demix``, without reporting progress, e.g. for the pipelined mode."""
+  out_dir = demix_dir / 'htdemucs' / path.stem
+  if overwrite or not is_demixed(out_dir):
+    if separator is None:
+      separator = get_separator('htdemucs', device)
+    separator.separate_to_dir(path, out_dir)
+  return out_dir
+
+
+def is_demixed(out_dir: Path) -> bool:
+  return all((out_dir / f'{source}.wav').is_file() for source in ['bass', 'drums', 'other', 'vocals'])
@@ -5,33 +5,236 @@ import torch
 from dataclasses import asdict
 from pathlib import Path
 from glob import glob
-from typing import List, Union
+from typing import List, Optional, Tuple, Union
+from numpy.typing import NDArray
 from .utils import mkpath, compact_json_number_array
-from .typings import AllInOneOutput, AnalysisResult, PathLike
+from .config import Config
+from .models.dinat import PADDING_MASK
+from .models.utils import get_receptive_field
+from .typings import AllInOneOutput, AnalysisResult, PathLike, Segment
+from .profiling import Profiler, measure
+from .index import ResultIndex, open_index
 from .postprocessing import (
   postprocess_metrical_structure,
+  postprocess_metrical_structures,
   postprocess_functional_structure,
+  postprocess_functional_structures,
   estimate_tempo_from_beats,
 )
 
 
 def run_inference(
   path: Path,
-  spec_path: Path,
+  spec_path: Optional[Path],
   model: torch.nn.Module,
   device: str,
   include_activations: bool,
   include_embeddings: bool,
+  spec: Optional[NDArray] = None,
+  profiler: Optional[Profiler] = None,
 ) -> AnalysisResult:
-  spec = np.load(spec_path)
-  print(f"Loaded spectrogram from {spec_path}, shape: {spec.shape}, dtype: {spec.dtype}")
+  """Runs the model on a spectrogram, either given in memory with ``spec`` or loaded from ``spec_path``."""
+  if spec is None:
+    spec = np.load(spec_path)
   spec = torch.from_numpy(spec).unsqueeze(0).to(device)
-  print(f"Spectrogram tensor on device {device}, shape: {spec.shape}, dtype: {spec.dtype}")
 
-  logits = model(spec)
+  with measure(profiler, 'inference', [path]):
+    logits = model(spec)
 
-  metrical_structure = postprocess_metrical_structure(logits, model.cfg)
-  functional_structure = postprocess_functional_structure(logits, model.cfg)
+  return postprocess_logits(
+    path=path,
+    logits=logits,
+    cfg=model.cfg,
+    include_activations=include_activations,
+    include_embeddings=include_embeddings,
+    profiler=profiler,
+  )
+
+
+def run_batched_inference(
+  paths: List[Path],
+  specs: List[NDArray],
+  model: torch.nn.Module,
+  device: str,
+  include_activations: bool,
+  include_embeddings: bool,
+  batch_size: int,
+  chunk_size: Optional[int] = None,
+  chunk_overlap: Optional[int] = None,
+  profiler: Optional[Profiler] = None,
+) -> List[AnalysisResult]:
+  """
+  Runs the model on several spectrograms at once. With the PyTorch attention backend (``NATTEN_API=torch``),
+  tracks of similar length are grouped into batches of up to ``batch_size`` tracks, zero-padded to the longest
+  one and masked, so that the results are the same as running each track alone. The NATTEN kernels cannot mask
+  the padding, so with the other backends only tracks of exactly equal length are batched.
+  Batches longer than ``chunk_size`` frames are processed in overlapping windows (see ``forward_chunked``).
+  The results are returned in the order of ``paths``. The inference, the beat decoding and the segmentation
+  of each batch are measured once for all of its tracks.
+  """
+  lengths = [spec.shape[1] for spec in specs]
+  results = [None] * len(paths)
+  for batch in group_by_length(lengths, batch_size, equal=not PADDING_MASK):
+    batch_lengths = [lengths[i] for i in batch]
+    max_T = max(batch_lengths)
+    batch_spec = np.stack([
+      np.pad(specs[i], ((0, 0), (0, max_T - lengths[i]), (0, 0)), 'constant')
+      for i in batch
+    ])
+    batch_spec = torch.from_numpy(batch_spec).to(device)
+    batch_paths = [paths[i] for i in batch]
+    # Batches without padding need no mask, and also run on the backends that cannot mask.
+    padded_lengths = None if min(batch_lengths) == max_T else batch_lengths
+
+    with measure(profiler, 'inference', batch_paths):
+      batch_logits = forward_chunked(model, batch_spec, chunk_size, chunk_overlap, padded_lengths)
+
+    batch_outputs = split_outputs(batch_logits, batch_lengths)
+    with measure(profiler, 'metrical', batch_paths):
+      metrical_structures = postprocess_metrical_structures(batch_outputs, model.cfg)
+    with measure(profiler, 'functional', batch_paths):
+      functional_structures = postprocess_functional_structures(batch_outputs, model.cfg)
+    for i, logits, metrical_structure, functional_structure in zip(
+      batch, batch_outputs, metrical_structures, functional_structures,
+    ):
+      results[i] = postprocess_logits(
+        path=paths[i],
+        logits=logits,
+        cfg=model.cfg,
+        include_activations=include_activations,
+        include_embeddings=include_embeddings,
+        metrical_structure=metrical_structure,
+        functional_structure=functional_structure,
+        profiler=profiler,
+      )
+
+  return results
+
+
+def forward_chunked(
+  model: torch.nn.Module,
+  spec: torch.Tensor,
+  chunk_size: Optional[int] = None,
+  overlap: Optional[int] = None,
+  lengths: Optional[List[int]] = None,
+) -> AllInOneOutput:
+  """
+  Runs the model over windows of ``chunk_size`` frames and stitches their outputs together,
+  so that the peak memory is bounded by the window size instead of the track duration.
+
+  The frames within the receptive field of the model from an inner edge of a window lack part of their context,
+  so their outputs are discarded. Windows overlap by ``overlap`` frames, by default twice the receptive field,
+  so that every frame is seen with its full context by a window. Any overlap beyond that is cross-faded,
+  and the outputs match the ones of the whole spectrogram up to floating point errors.
+  If ``chunk_size`` is None or the spectrogram is not longer than it, the model runs on the whole spectrogram.
+  ``lengths`` are the numbers of valid frames of the tracks of a zero-padded batch, passed on to the model
+  for each window, or None if nothing is padded.
+  """
+  N, K, T, F = spec.shape
+
+  def run(start: int, end: int):
+    if lengths is None:
+      return model(spec[:, :, start:end])
+    # A track that ends within the window is seen with its true end, like in the whole spectrogram.
+    return model(spec[:, :, start:end], lengths=[min(max(length - start, 1), end - start) for length in lengths])
+
+  if chunk_size is None or T <= chunk_size:
+    return run(0, T)
+
+  margin = get_receptive_field(model.cfg)
+  if overlap is None:
+    overlap = 2 * margin
+  if not 2 * margin <= overlap < chunk_size:
+    raise ValueError(
+      f'The chunk overlap ({overlap} frames) must be at least twice the receptive field of the model '
+      f'({margin} frames) and less than the chunk size ({chunk_size} frames).'
+    )
+
+  hop = chunk_size - overlap
+  starts = list(range(0, T - chunk_size, hop)) + [T - chunk_size]
+  # Weights rising from 0 in the margin to 1 over the cross-faded frames.
+  fade = overlap - 2 * margin
+  ramp = ((torch.arange(chunk_size, device=spec.device) - margin + 1) / (fade + 1)).clamp(0, 1)
+
+  fields = ['logits_beat', 'logits_downbeat', 'logits_section', 'logits_function', 'embeddings']
+  sums, weight_sum = {}, torch.zeros(T, device=spec.device)
+  for start in starts:
+    end = start + chunk_size
+    chunk_output = run(start, end)
+
+    weight = torch.ones(chunk_size, device=spec.device)
+    if start > 0:
+      weight = torch.minimum(weight, ramp)
+    if end < T:
+      weight = torch.minimum(weight, ramp.flip(0))
+    weight_sum[start:end] += weight
+
+    for field in fields:
+      value = getattr(chunk_output, field)
+      # Logits have time on the last axis, embeddings have shape (N, K, T, C, ...).
+      time_axis = 2 if field == 'embeddings' else value.dim() - 1
+      if field not in sums:
+        sums[field] = value.new_zeros(value.shape[:time_axis] + (T,) + value.shape[time_axis + 1:])
+      shape = [1] * value.dim()
+      shape[time_axis] = chunk_size
+      sums[field].narrow(time_axis, start, chunk_size).add_(value * weight.view(shape))
+
+  outputs = {}
+  for field, value in sums.items():
+    time_axis = 2 if field == 'embeddings' else value.dim() - 1
+    shape = [1] * value.dim()
+    shape[time_axis] = T
+    outputs[field] = value / weight_sum.view(shape)
+
+  return AllInOneOutput(**outputs)
+
+
+def group_by_length(lengths: List[int], batch_size: int, equal: bool = False) -> List[List[int]]:
+  """
+  Groups indices of ``lengths`` into batches of up to ``batch_size`` items of similar length, shortest first.
+  With ``equal``, only items of exactly equal length share a batch.
+  """
+  groups = {}
+  for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+    groups.setdefault(lengths[i] if equal else None, []).append(i)
+  return [group[i:i + batch_size] for group in groups.values() for i in range(0, len(group), batch_size)]
+
+
+def split_outputs(logits: AllInOneOutput, lengths: List[int]) -> List[AllInOneOutput]:
+  """Splits batched outputs into per-track outputs with a batch size of 1 and ``lengths`` frames."""
+  outputs = []
+  for i, T in enumerate(lengths):
+    outputs.append(AllInOneOutput(
+      logits_beat=logits.logits_beat[i:i + 1, :T],
+      logits_downbeat=logits.logits_downbeat[i:i + 1, :T],
+      logits_section=logits.logits_section[i:i + 1, :T],
+      logits_function=logits.logits_function[i:i + 1, :, :T],
+      embeddings=logits.embeddings[i:i + 1, :, :T],
+    ))
+  return outputs
+
+
+def postprocess_logits(
+  path: Path,
+  logits: AllInOneOutput,
+  cfg: Config,
+  include_activations: bool,
+  include_embeddings: bool,
+  metrical_structure: Optional[dict] = None,
+  functional_structure: Optional[List[Segment]] = None,
+  profiler: Optional[Profiler] = None,
+) -> AnalysisResult:
+  """
+  Converts the outputs of the model into an ``AnalysisResult``.
+  ``metrical_structure`` and ``functional_structure`` can be given if the beats and segments were already found,
+  e.g. with other tracks at once.
+  """
+  if metrical_structure is None:
+    with measure(profiler, 'metrical', [path]):
+      metrical_structure = postprocess_metrical_structure(logits, cfg)
+  if functional_structure is None:
+    with measure(profiler, 'functional', [path]):
+      functional_structure = postprocess_functional_structure(logits, cfg)
   bpm = estimate_tempo_from_beats(metrical_structure['beats'])
 
   result = AnalysisResult(
@@ -78,6 +281,16 @@ def expand_paths(paths: List[Path]):
   return sorted(expanded_paths)
 
 
+def select_shard(paths: List[Path], shard: Optional[Tuple[int, int]]) -> List[Path]:
+  """Returns the ``i``-th of ``n`` shards of ``paths`` for ``shard=(i, n)``, or all paths if ``shard`` is None."""
+  if shard is None:
+    return paths
+  index, count = shard
+  if not 0 <= index < count:
+    raise ValueError(f'shard must be (i, n) with 0 <= i < n, got {shard}.')
+  return paths[index::count]
+
+
 def check_paths(paths: List[Path]):
   missing_files = []
   for path in paths:
@@ -87,6 +300,19 @@ def check_paths(paths: List[Path]):
     raise FileNotFoundError(f'Could not find the following files: {missing_files}')
 
 
+def check_unique_names(paths: List[Path]):
+  """Raises if two tracks have the same name, since their results and byproducts are named after them."""
+  by_name = {}
+  for path in paths:
+    by_name.setdefault(path.stem, []).append(str(path))
+  duplicates = {name: group for name, group in by_name.items() if len(group) > 1}
+  if duplicates:
+    raise ValueError(
+      f'The following tracks have the same name and would overwrite each other\'s results: {duplicates}. '
+      f'Analyze them into separate output directories.'
+    )
+
+
 def rmdir_if_empty(path: Path):
   try:
     path.rmdir()
@@ -97,25 +323,41 @@ def rmdir_if_empty(path: Path):
 def save_results(
   results: Union[AnalysisResult, List[AnalysisResult]],
   out_dir: PathLike,
+  index: Union[None, PathLike, ResultIndex] = None,
 ):
+  """
+  Saves results as JSON to ``out_dir``. If ``index`` is given, as a ``ResultIndex`` or the path of one,
+  the results and the locations of their files are also added to it.
+  """
   if not isinstance(results, list):
     results = [results]
 
   out_dir = mkpath(out_dir)
   out_dir.mkdir(parents=True, exist_ok=True)
-  for result in results:
-    out_path = out_dir / result.path.with_suffix('.json').name
-    result = asdict(result)
-    result['path'] = str(result['path'])
-
-    activations = result.pop('activations')
-    if activations is not None:
-      np.savez(str(out_path.with_suffix('.activ.npz')), **activations)
-
-    embeddings = result.pop('embeddings')
-    if embeddings is not None:
-      np.save(str(out_path.with_suffix('.embed.npy')), embeddings)
-
-    json_str = json.dumps(result, indent=2)
-    json_str = compact_json_number_array(json_str)
-    out_path.with_suffix('.json').write_text(json_str)
+  out_paths = [out_dir / result.path.with_suffix('.json').name for result in results]
+  for result, out_path in zip(results, out_paths):
+    save_result(result, out_path)
+
+  if index is not None:
+    result_index = open_index(index)
+    result_index.add(results, out_paths)
+    if result_index is not index:
+      result_index.close()
+
+
+def save_result(result: AnalysisResult, out_path: Path):
+  """Saves a result as JSON to ``out_path``, with its activations and embeddings next to it if present."""
+  result = asdict(result)
+  result['path'] = str(result['path'])
+
+  activations = result.pop('activations')
+  if activations is not None:
+    np.savez(str(out_path.with_suffix('.activ.npz')), **activations)
+
+  embeddings = result.pop('embeddings')
+  if embeddings is not None:
+    np.save(str(out_path.with_suffix('.embed.npy')), embeddings)
+
+  json_str = json.dumps(result, indent=2)
+  json_str = compact_json_number_array(json_str)
+  out_path.with_suffix('.json').write_text(json_str)
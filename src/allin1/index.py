@@ -0,0 +1,221 @@
+"""
+SQLite index of analysis results, for catalogue queries without reading the result files.
+
+The index holds one row per track, with its scalars and the locations of its files, and one row per segment.
+``save_results(..., index=...)`` keeps it up to date, and ``allin1 query`` searches it, e.g.::
+
+  allin1 query --bpm 120 128 --label chorus --min-label-duration 30
+"""
+
+import argparse
+import json
+import sqlite3
+import threading
+
+from pathlib import Path
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+from .typings import AnalysisResult, PathLike
+
+# Name of the index in the output directory of ``analyze``.
+INDEX_NAME = 'index.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+  id INTEGER PRIMARY KEY,
+  path TEXT NOT NULL UNIQUE,
+  result_path TEXT,
+  activations_path TEXT,
+  embeddings_path TEXT,
+  bpm REAL,
+  duration REAL,
+  num_beats INTEGER,
+  num_downbeats INTEGER,
+  num_segments INTEGER
+);
+CREATE TABLE IF NOT EXISTS segments (
+  track_id INTEGER NOT NULL REFERENCES tracks(id) ON DELETE CASCADE,
+  idx INTEGER NOT NULL,
+  start REAL NOT NULL,
+  end REAL NOT NULL,
+  duration REAL NOT NULL,
+  label TEXT NOT NULL,
+  PRIMARY KEY (track_id, idx)
+);
+CREATE INDEX IF NOT EXISTS tracks_bpm ON tracks(bpm);
+CREATE INDEX IF NOT EXISTS tracks_duration ON tracks(duration);
+CREATE INDEX IF NOT EXISTS segments_label ON segments(label, duration);
+"""
+
+
+class ResultIndex:
+  """
+  SQLite index of analysis results in ``path``, created if it does not exist.
+  It can be shared by the threads of a process, and by several processes through SQLite's file locking.
+  """
+
+  def __init__(self, path: PathLike):
+    self.path = Path(path)
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+    self._connection.execute('PRAGMA foreign_keys = ON')
+    self._lock = threading.Lock()
+    with self._lock, self._connection:
+      self._connection.executescript(SCHEMA)
+
+  def close(self):
+    self._connection.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def __len__(self) -> int:
+    return self.execute('SELECT COUNT(*) FROM tracks')[0][0]
+
+  def add(self, results: Iterable[AnalysisResult], result_paths: Optional[Iterable[Optional[PathLike]]] = None):
+    """
+    Adds or replaces the rows of results. ``result_paths`` are the JSON files of the results, next to which
+    their activations and embeddings are looked up.
+    """
+    results = list(results)
+    result_paths = [None] * len(results) if result_paths is None else list(result_paths)
+    with self._lock, self._connection:
+      for result, result_path in zip(results, result_paths):
+        self._connection.execute('DELETE FROM tracks WHERE path = ?', (str(result.path),))
+        track_id = self._connection.execute(
+          'INSERT INTO tracks (path, result_path, activations_path, embeddings_path, bpm, duration, num_beats, '
+          'num_downbeats, num_segments) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+          (
+            str(result.path),
+            *_file_locations(result_path),
+            result.bpm,
+            result.segments[-1].end if result.segments else None,
+            len(result.beats),
+            len(result.downbeats),
+            len(result.segments),
+          ),
+        ).lastrowid
+        self._connection.executemany(
+          'INSERT INTO segments (track_id, idx, start, end, duration, label) VALUES (?, ?, ?, ?, ?, ?)',
+          [
+            (track_id, i, float(segment.start), float(segment.end), float(segment.end - segment.start), segment.label)
+            for i, segment in enumerate(result.segments)
+          ],
+        )
+
+  def remove(self, paths: Iterable[PathLike]):
+    with self._lock, self._connection:
+      self._connection.executemany('DELETE FROM tracks WHERE path = ?', [(str(path),) for path in paths])
+
+  def query(
+    self,
+    bpm: Optional[Tuple[float, float]] = None,
+    duration: Optional[Tuple[float, float]] = None,
+    label: Optional[str] = None,
+    min_label_duration: Optional[float] = None,
+    limit: Optional[int] = None,
+  ) -> List[Path]:
+    """
+    Returns the paths of the tracks with a bpm and a duration within the given inclusive ranges, that have
+    a segment labeled ``label`` lasting at least ``min_label_duration`` seconds (of any label if ``label`` is None),
+    sorted by path.
+    """
+    conditions, params = [], []
+    if bpm is not None:
+      conditions.append('bpm BETWEEN ? AND ?')
+      params += bpm
+    if duration is not None:
+      conditions.append('duration BETWEEN ? AND ?')
+      params += duration
+    if label is not None or min_label_duration is not None:
+      # An uncorrelated subquery, so that the matching segments are looked up once for all tracks.
+      segment_conditions = ['1']
+      if label is not None:
+        segment_conditions.append('label = ?')
+        params.append(label)
+      if min_label_duration is not None:
+        segment_conditions.append('duration >= ?')
+        params.append(min_label_duration)
+      conditions.append(f'id IN (SELECT track_id FROM segments WHERE {" AND ".join(segment_conditions)})')
+
+    sql = 'SELECT path FROM tracks'
+    if conditions:
+      sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY path'
+    if limit is not None:
+      sql += ' LIMIT ?'
+      params.append(limit)
+    return [Path(path) for path, in self.execute(sql, params)]
+
+  def execute(self, sql: str, params: Sequence = ()) -> List[tuple]:
+    """Runs any SQL statement on the index and returns the rows, e.g. for queries ``query`` does not cover."""
+    with self._lock, self._connection:
+      return self._connection.execute(sql, params).fetchall()
+
+  def reindex(self, out_dir: PathLike):
+    """Adds the results saved in ``out_dir`` as JSON, e.g. by a version of ``analyze`` without the index."""
+    result_paths = sorted(Path(out_dir).glob('*.json'))
+    self.add((AnalysisResult.from_json(path, False, False) for path in result_paths), result_paths)
+
+
+def open_index(index: Union[None, PathLike, ResultIndex]) -> Optional[ResultIndex]:
+  if index is None or isinstance(index, ResultIndex):
+    return index
+  return ResultIndex(index)
+
+
+def _file_locations(result_path: Optional[PathLike]) -> Tuple[Optional[str], ...]:
+  if result_path is None:
+    return None, None, None
+  result_path = Path(result_path)
+  activations_path = result_path.with_suffix('.activ.npz')
+  embeddings_path = result_path.with_suffix('.embed.npy')
+  return (
+    str(result_path),
+    str(activations_path) if activations_path.is_file() else None,
+    str(embeddings_path) if embeddings_path.is_file() else None,
+  )
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(prog='allin1 query', description='Searches the index of analysis results.')
+  parser.add_argument('-i', '--index', type=Path, default=Path.cwd() / 'struct' / INDEX_NAME,
+                      help=f'Path to the index (default: ./struct/{INDEX_NAME})')
+  parser.add_argument('--bpm', type=float, nargs=2, metavar=('MIN', 'MAX'), default=None,
+                      help='Range of the bpm (default: any)')
+  parser.add_argument('--duration', type=float, nargs=2, metavar=('MIN', 'MAX'), default=None,
+                      help='Range of the duration of the tracks in seconds (default: any)')
+  parser.add_argument('--label', type=str, default=None,
+                      help='Label of a segment the tracks must have, e.g. chorus (default: any)')
+  parser.add_argument('--min-label-duration', type=float, default=None,
+                      help='Minimum duration in seconds of the segment given by --label (default: any)')
+  parser.add_argument('--limit', type=int, default=None,
+                      help='Maximum number of tracks to print (default: all)')
+  parser.add_argument('--json', action='store_true',
+                      help='Print the rows of the tracks as JSON lines instead of their paths (default: False)')
+  parser.add_argument('--reindex', action='store_true',
+                      help='Index the JSON results in the directory of the index first (default: False)')
+  return parser
+
+
+def main(argv: Optional[List[str]] = None):
+  args = make_parser().parse_args(argv)
+  if not args.index.is_file() and not args.reindex:
+    raise FileNotFoundError(f'No index at {args.index}. Run allin1 with --index, or add --reindex.')
+
+  with ResultIndex(args.index) as index:
+    if args.reindex:
+      index.reindex(args.index.parent)
+    paths = index.query(args.bpm, args.duration, args.label, args.min_label_duration, args.limit)
+    if not args.json:
+      for path in paths:
+        print(path)
+      return
+
+    columns = ['path', 'result_path', 'activations_path', 'embeddings_path', 'bpm', 'duration',
+               'num_beats', 'num_downbeats', 'num_segments']
+    for path in paths:
+      row, = index.execute(f'SELECT {", ".join(columns)} FROM tracks WHERE path = ?', (str(path),))
+      print(json.dumps(dict(zip(columns, row))))
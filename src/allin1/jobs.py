@@ -0,0 +1,272 @@
+"""
+Coordination of several workers analyzing the same tracks, e.g. on several machines sharing ``out_dir`` over NFS.
+
+Every worker goes through the same list of tracks and claims the ones that are neither finished nor claimed by
+creating a lock file in ``out_dir/.jobs`` with ``O_CREAT | O_EXCL``, which is atomic on local file systems and NFS.
+The status and the timings of every track are written next to the locks when it is finished, so that a worker
+restarted after a crash skips the finished tracks. Workers refresh the modification time of their locks while they
+analyze the tracks. Locks of crashed workers are taken over once they are stale: right away if the worker ran on
+the same machine, and once they were not refreshed for ``stale_after`` seconds otherwise.
+"""
+
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from .analyze import analyze
+from .helpers import check_unique_names, expand_paths, select_shard
+from .profiling import StageMetrics
+from .typings import PathLike
+from .utils import mkpath
+
+# Directory of the locks and the statuses of the tracks in the output directory.
+JOBS_DIR = '.jobs'
+
+
+class JobBoard:
+  """Locks and statuses of the tracks analyzed into ``out_dir``, keyed by their resolved paths."""
+
+  def __init__(self, out_dir: PathLike, worker_id: Optional[str] = None, stale_after: float = 3600.):
+    self.dir = mkpath(out_dir) / JOBS_DIR
+    self.dir.mkdir(parents=True, exist_ok=True)
+    self.host = socket.gethostname()
+    self.worker_id = worker_id or f'{self.host}-{os.getpid()}'
+    self.stale_after = stale_after
+
+  def lock_path(self, path: Path) -> Path:
+    return self.dir / f'{self.key(path)}.lock'
+
+  def status_path(self, path: Path) -> Path:
+    return self.dir / f'{self.key(path)}.json'
+
+  @staticmethod
+  def key(path: Path) -> str:
+    # Tracks with the same name in different directories get different locks. The name is kept for debugging.
+    return f'{path.stem}-{hashlib.sha1(str(path.resolve()).encode()).hexdigest()[:16]}'
+
+  def status(self, path: Path) -> Optional[dict]:
+    """Returns the status recorded by ``finish``, or None if the track was never finished."""
+    try:
+      return json.loads(self.status_path(path).read_text())
+    except FileNotFoundError:
+      return None
+
+  def is_claimed(self, path: Path) -> bool:
+    return self.lock_path(path).exists()
+
+  def claim(self, path: Path) -> bool:
+    """Returns whether this worker claimed the track, taking over the lock of a crashed worker if needed."""
+    lock_path = self.lock_path(path)
+    for _ in range(2):
+      try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+      except FileExistsError:
+        if not self._break_stale_lock(lock_path):
+          return False
+        continue
+      with os.fdopen(fd, 'w') as f:
+        json.dump(dict(worker=self.worker_id, host=self.host, pid=os.getpid(), claimed_at=time.time()), f)
+      return True
+    return False
+
+  def release(self, path: Path):
+    self.lock_path(path).unlink(missing_ok=True)
+
+  def touch(self, paths: List[Path]):
+    """Refreshes the modification time of the locks of ``paths``, so that they are not considered stale."""
+    for path in paths:
+      try:
+        os.utime(self.lock_path(path))
+      except FileNotFoundError:
+        pass
+
+  @contextmanager
+  def holding(self, paths: List[Path], interval: Optional[float] = None):
+    """Touches the locks of ``paths`` every ``interval`` seconds (``stale_after / 4`` by default) in the context."""
+    interval = self.stale_after / 4 if interval is None else interval
+    stop = threading.Event()
+
+    def heartbeat():
+      while not stop.wait(interval):
+        self.touch(paths)
+
+    thread = threading.Thread(target=heartbeat, name='job-heartbeat', daemon=True)
+    thread.start()
+    try:
+      yield
+    finally:
+      stop.set()
+      thread.join()
+
+  def finish(self, path: Path, status: str, **info):
+    """Records the status of a track, e.g. 'done' or 'failed', with any other information, and releases it."""
+    status_path = self.status_path(path)
+    tmp_path = status_path.with_name(f'.tmp-{uuid.uuid4().hex}-{status_path.name}')
+    tmp_path.write_text(json.dumps(dict(
+      path=str(path), status=status, worker=self.worker_id, finished_at=time.time(), **info,
+    )))
+    os.replace(tmp_path, status_path)
+    self.release(path)
+
+  def summary(self, paths: List[Path]) -> Dict[str, int]:
+    """Counts the tracks by status: 'done', 'failed', 'running' if claimed, or 'pending'."""
+    counts = Counter()
+    for path in paths:
+      status = self.status(path)
+      if status is not None:
+        counts[status['status']] += 1
+      else:
+        counts['running' if self.is_claimed(path) else 'pending'] += 1
+    return dict(counts)
+
+  def _break_stale_lock(self, lock_path: Path) -> bool:
+    """Removes the lock if it is stale, and returns whether the track can be claimed again."""
+    try:
+      age = time.time() - lock_path.stat().st_mtime
+      owner = json.loads(lock_path.read_text())
+    except FileNotFoundError:
+      # Released in the meantime.
+      return True
+    except ValueError:
+      # Still being written, unless its worker crashed right after creating it.
+      owner = None
+    if owner is not None and owner.get('host') == self.host:
+      stale = not _is_running(owner['pid'])
+    else:
+      stale = age > self.stale_after
+    if not stale:
+      return False
+    # Renamed first, so that only one of the workers finding the stale lock removes it.
+    # A worker that read the lock before it was taken over may still remove the new lock, in which case
+    # the track is analyzed twice, but never lost.
+    stale_path = lock_path.with_name(f'.stale-{uuid.uuid4().hex}-{lock_path.name}')
+    try:
+      os.rename(lock_path, stale_path)
+    except FileNotFoundError:
+      return True
+    stale_path.unlink()
+    return True
+
+
+def _is_running(pid: int) -> bool:
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    return True
+  return True
+
+
+def read_manifest(path: PathLike) -> List[Path]:
+  """Reads the paths of the tracks listed one per line in a text file, skipping empty lines and comments."""
+  lines = Path(path).read_text().splitlines()
+  return [Path(line.strip()) for line in lines if line.strip() and not line.lstrip().startswith('#')]
+
+
+def run_worker(
+  paths: List[PathLike],
+  out_dir: PathLike,
+  claim_size: int = 1,
+  worker_id: Optional[str] = None,
+  stale_after: float = 3600.,
+  retry_failed: bool = False,
+  shard: Optional[Tuple[int, int]] = None,
+  **kwargs,
+) -> Dict[str, int]:
+  """
+  Analyzes the tracks of ``paths`` that no other worker has finished or claimed, ``claim_size`` tracks at a time,
+  with ``analyze(..., **kwargs)``. Every worker sharing ``out_dir`` must be given the same tracks.
+  If the analysis of a claim fails, its tracks are analyzed again one by one, so that only the tracks that fail
+  alone are recorded as failed. Tracks whose analysis failed are skipped unless ``retry_failed`` is True.
+  Results already in ``out_dir`` without a status, e.g. from a run without workers, count as finished unless
+  ``overwrite`` is True. The claims make sure that only one worker analyzes a track, so ``overwrite`` and the
+  content cache are passed on to ``analyze`` as usual. ``shard`` restricts the tracks as in ``analyze``, and
+  ``load_existing`` is ignored.
+
+  Returns the number of tracks this worker analyzed ('done'), failed to analyze ('failed'), and skipped because
+  they were finished or claimed by another worker ('skipped').
+  """
+  if claim_size < 1:
+    raise ValueError(f'claim_size must be a positive integer, got {claim_size}.')
+  out_dir = mkpath(out_dir)
+  board = JobBoard(out_dir, worker_id, stale_after)
+  callbacks = kwargs.pop('callbacks', None) or []
+  overwrite = kwargs.pop('overwrite', False)
+  kwargs.pop('load_existing', None)
+
+  def is_finished(path: Path) -> bool:
+    status = board.status(path)
+    if status is not None:
+      return status['status'] == 'done' or not retry_failed
+    # An unfinished result of a crashed worker still has its lock.
+    return not overwrite and (out_dir / path.with_suffix('.json').name).exists() and not board.is_claimed(path)
+
+  counts = Counter(done=0, failed=0, skipped=0)
+
+  def process(batch: List[Path]):
+    unfinished = set(batch)
+    try:
+      with board.holding(batch):
+        run(batch, unfinished)
+    except BaseException:
+      for path in unfinished:
+        board.release(path)
+      raise
+
+  def run(batch: List[Path], unfinished: set):
+    stages = defaultdict(lambda: defaultdict(float))
+
+    def record(metrics: StageMetrics):
+      # The time of a stage that processed several tracks at once is split evenly between them.
+      for metrics_path in metrics.paths:
+        stages[str(metrics_path)][metrics.stage] += metrics.wall_time / len(metrics.paths)
+
+    started_at = time.time()
+    try:
+      analyze(
+        batch, out_dir=out_dir, overwrite=overwrite, load_existing=False, callbacks=[record, *callbacks], **kwargs,
+      )
+    except Exception as e:
+      if len(batch) > 1:
+        for path in batch:
+          run([path], unfinished)
+        return
+      board.finish(batch[0], 'failed', started_at=started_at, error=f'{type(e).__name__}: {e}')
+      unfinished.discard(batch[0])
+      counts['failed'] += 1
+      return
+    for path in batch:
+      board.finish(path, 'done', started_at=started_at, stages=dict(stages[str(path)]))
+      unfinished.discard(path)
+    counts['done'] += len(batch)
+
+  paths = select_shard(expand_paths([mkpath(path) for path in paths]), shard)
+  # The tracks of a claim are checked by analyze, but the results of all tracks share out_dir.
+  check_unique_names(paths)
+  batch = []
+  for path in paths:
+    if is_finished(path) or not board.claim(path):
+      counts['skipped'] += 1
+      continue
+    # Another worker may have finished the track between the check and the claim.
+    if is_finished(path):
+      board.release(path)
+      counts['skipped'] += 1
+      continue
+    batch.append(path)
+    if len(batch) == claim_size:
+      process(batch)
+      batch = []
+  if batch:
+    process(batch)
+
+  return dict(counts)
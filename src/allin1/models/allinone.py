@@ -1,8 +1,8 @@
 import torch
 import torch.nn as nn
 
-from typing import Optional
-from .dinat import DinatLayer1d, DinatLayer2d
+from typing import Optional, Sequence
+from .dinat import DinatLayer1d, DinatLayer2d, mask_padding
 from .utils import get_activation_function
 from ..config import Config
 from ..typings import AllInOneOutput
@@ -36,6 +36,7 @@ class AllInOne(nn.Module):
     self,
     inputs: torch.FloatTensor,
     output_attentions: Optional[bool] = None,
+    lengths: Optional[Sequence[int]] = None,
   ):
     # N: batch size
     # K: instrument
@@ -43,14 +44,19 @@ class AllInOne(nn.Module):
     # T: time
     # F: frequency
     # x has shape of: N, K, T, F
+    # lengths: the number of valid frames of each track of a zero-padded batch. The padded frames are then
+    # masked, so that the outputs of a track are the same as without padding (needs NATTEN_API=torch).
     N, K, T, F = inputs.shape
 
+    if lengths is not None:
+      lengths = [length for length in lengths for _ in range(K)]
     inputs = inputs.reshape(-1, 1, T, F)  # N x K, C=1, T, F=81
-    frame_embed = self.embeddings(inputs)  # NK, T, C=16
+    frame_embed = self.embeddings(inputs, lengths)  # NK, T, C=16
 
     encoder_outputs = self.encoder(
       frame_embed,
       output_attentions=output_attentions,
+      lengths=lengths,
     )
     hidden_state_levels = encoder_outputs[0]
 
@@ -77,7 +83,7 @@ class AllInOneEncoder(nn.Module):
     super().__init__()
     self.cfg = cfg
 
-    drop_path_rates = [x.item() for x in torch.linspace(0, cfg.drop_path, depth)]
+    drop_path_rates = [x.item() for x in torch.linspace(0, cfg.drop_path, depth, device='cpu')]
     dilations = [
       min(cfg.dilation_factor ** i, cfg.dilation_max)
       for i in range(depth)
@@ -97,17 +103,19 @@ class AllInOneEncoder(nn.Module):
     self,
     frame_embed: torch.FloatTensor,
     output_attentions: Optional[bool] = None,
+    lengths: Optional[Sequence[int]] = None,
   ):
     # N: batch size
     # K: instrument
     # T: time
     # C: channel
     # x has shape of: NK, T, C=16
+    # lengths has NK items
 
     hidden_state_levels = []
     hidden_states = frame_embed
     for i, layer in enumerate(self.layers):
-      layer_outputs = layer(hidden_states, output_attentions)
+      layer_outputs = layer(hidden_states, output_attentions, lengths)
       hidden_states = layer_outputs[0]
       hidden_state_levels.append(hidden_states)
 
@@ -158,24 +166,26 @@ class AllInOneBlock(nn.Module):
     self,
     hidden_states: torch.FloatTensor,
     output_attentions: Optional[bool] = None,
+    lengths: Optional[Sequence[int]] = None,
   ):
     # N: batch size
     # K: instrument
     # T: time
     # C: channel
     # x has shape of: NK, T, C=16
+    # lengths has NK items
     NK, T, C = hidden_states.shape
     N, K = NK // self.cfg.data.num_instruments, self.cfg.data.num_instruments
 
-    timelayer_outputs = self.timelayer(hidden_states, output_attentions)
+    timelayer_outputs = self.timelayer(hidden_states, output_attentions, lengths)
     hidden_states = timelayer_outputs[0]
     if self.cfg.instrument_attention:
       hidden_states = hidden_states.reshape(N, K, T, C)
-      instlayer_outputs = self.instlayer(hidden_states, output_attentions)
+      instlayer_outputs = self.instlayer(hidden_states, output_attentions, None if lengths is None else lengths[::K])
       hidden_states = instlayer_outputs[0]
       hidden_states = hidden_states.reshape(NK, T, C)
     else:
-      instlayer_outputs = self.instlayer(hidden_states, output_attentions)
+      instlayer_outputs = self.instlayer(hidden_states, output_attentions, lengths)
       hidden_states = instlayer_outputs[0]
 
     outputs = (hidden_states,)
@@ -210,13 +220,16 @@ class AllInOneEmbeddings(nn.Module):
     self.norm = nn.LayerNorm(cfg.dim_embed)
     self.dropout = nn.Dropout(cfg.drop_conv)
 
-  def forward(self, x: torch.FloatTensor):
+  def forward(self, x: torch.FloatTensor, lengths: Optional[Sequence[int]] = None):
     # NK: batch x inst
     # C: channel
     # T: time
     # F: frequency
     # x has shape of: NK, C=1, T, F
     # x = x.unsqueeze(1)  # NK, C=1, T, F=81
+    # The convolutions along time must see zeros beyond the length of each item, like their own zero-padding.
+    if lengths is not None:
+      x = mask_padding(x, lengths, dim=2)
     x = self.conv0(x)  # NK, C=16, T, F=79
     x = self.pool0(x)  # NK, C=16, T, F=26
     x = self.act_fn(x)
@@ -227,6 +240,8 @@ class AllInOneEmbeddings(nn.Module):
     x = self.act_fn(x)
     x = self.drop1(x)
 
+    if lengths is not None:
+      x = mask_padding(x, lengths, dim=2)
     x = self.conv2(x)  # NK, C=16, T, F=3
     x = self.pool2(x)  # NK, C=16, T, F=1
     x = self.act_fn(x)
@@ -7,21 +7,68 @@ import math
 import torch
 import os
 from abc import ABC,  abstractmethod
-from typing import Optional, Tuple, Callable
+from typing import Optional, Sequence, Tuple, Callable
 
 # --- API Agnostic Imports ---
 # Use an environment variable to switch between APIs. Default to MPS.
+# "torch" selects the pure PyTorch implementation, which has the same signature as the MPS one.
 NATTEN_API = os.environ.get("NATTEN_API", "mps")
 
 if NATTEN_API == "mps":
     from natten import natten1d, natten2d
+elif NATTEN_API == "torch":
+    from .natten_torch import natten1d, natten2d
 else: # cpu/cuda
     from natten.functional import natten1dav, natten1dqkrpb, natten2dav, natten2dqkrpb
 
+# Only the PyTorch implementation can shift the attention windows at the end of each item of a padded batch.
+# The NATTEN kernels shift them at the end of the padded tensor, so padding would change the outputs.
+PADDING_MASK = NATTEN_API == "torch"
+
 from ..config import Config
 from .utils import *
 
 
+class _UnbatchedKernel(torch.autograd.Function):
+  """
+  Runs a neighborhood attention kernel that has no batching rule under ``torch.func.vmap``
+  by calling it on each slice of the vmapped dimension. Used by the fused ensemble.
+  """
+
+  @staticmethod
+  def forward(kernel, *args):
+    return kernel(*args)
+
+  @staticmethod
+  def setup_context(ctx, inputs, output):
+    pass
+
+  @staticmethod
+  def vmap(info, in_dims, kernel, *args):
+    outputs = []
+    for i in range(info.batch_size):
+      sliced = [arg if dim is None else arg.select(dim, i) for arg, dim in zip(args, in_dims[1:])]
+      outputs.append(_UnbatchedKernel.apply(kernel, *sliced))
+    return torch.stack(outputs), 0
+
+
+def mask_padding(hidden_states: torch.Tensor, lengths: Sequence[int], dim: int) -> torch.Tensor:
+  """Zeroes the positions of each item beyond its length along ``dim``, like the zero-padding of a single item."""
+  shape = [1] * hidden_states.dim()
+  shape[0], shape[dim] = len(lengths), hidden_states.shape[dim]
+  positions = torch.arange(hidden_states.shape[dim], device=hidden_states.device)
+  mask = positions < torch.tensor(lengths, device=hidden_states.device)[:, None]
+  return hidden_states * mask.view(shape).to(hidden_states.dtype)
+
+
+def call_kernel(kernel: Callable, *args):
+  # The wrapper has no backward pass, so it is only used when gradients are not needed.
+  # The PyTorch implementation is made of regular operators and can be vmapped as is.
+  if torch.is_grad_enabled() or NATTEN_API == "torch":
+    return kernel(*args)
+  return _UnbatchedKernel.apply(kernel, *args)
+
+
 # Copied from transformers.models.beit.modeling_beit.drop_path
 def drop_path(input, drop_prob=0.0, training=False, scale_by_keep=True):
   """
@@ -92,16 +139,21 @@ class _NeighborhoodAttentionNd(ABC, nn.Module):
     hidden_states: torch.Tensor,
     output_attentions: Optional[bool] = False,
     original_dims: Optional[Tuple[int, ...]] = None,
+    lengths: Optional[Sequence[int]] = None,
   ) -> Tuple[torch.Tensor]:
+    if lengths is not None and not PADDING_MASK:
+      raise ValueError(f'Padded batches with lengths need NATTEN_API=torch, not {NATTEN_API}.')
+
     query_layer = self.transpose_for_scores(self.query(hidden_states))
     key_layer = self.transpose_for_scores(self.key(hidden_states))
     value_layer = self.transpose_for_scores(self.value(hidden_states))
     
     query_layer = query_layer / math.sqrt(self.attention_head_size)
     
-    if NATTEN_API == "mps":
-        # MPS Backend Path
-        context_layer = self.natten(
+    if NATTEN_API in ("mps", "torch"):
+        # MPS / PyTorch Backend Path
+        context_layer = call_kernel(
+            self.natten,
             query_layer,
             key_layer,
             value_layer,
@@ -109,14 +161,17 @@ class _NeighborhoodAttentionNd(ABC, nn.Module):
             self.kernel_size,
             self.dilation,
             *original_dims,
+            *([] if lengths is None else [tuple(lengths)]),
         )
         outputs = (context_layer, None) if output_attentions else (context_layer,)
     else:
         # CPU/CUDA Backend Path (Original Logic)
-        attention_scores = self.nattendqkrpb(query_layer, key_layer, self.rpb, self.kernel_size, self.dilation)
+        attention_scores = call_kernel(
+            self.nattendqkrpb, query_layer, key_layer, self.rpb, self.kernel_size, self.dilation
+        )
         attention_probs = nn.functional.softmax(attention_scores, dim=-1)
         attention_probs = self.dropout(attention_probs)
-        context_layer = self.nattendav(attention_probs, value_layer, self.kernel_size, self.dilation)
+        context_layer = call_kernel(self.nattendav, attention_probs, value_layer, self.kernel_size, self.dilation)
         
         if len(context_layer.shape) > 4:  # 2D
             context_layer = context_layer.permute(0, 2, 3, 1, 4).contiguous()
@@ -152,7 +207,7 @@ class NeighborhoodAttention1d(_NeighborhoodAttentionNd):
       torch.zeros(num_heads, (2 * self.kernel_size - 1)),
       requires_grad=True,
     )
-    if NATTEN_API == "mps":
+    if NATTEN_API in ("mps", "torch"):
         self.natten = natten1d
     else:
         self.nattendqkrpb = natten1dqkrpb
@@ -173,7 +228,7 @@ class NeighborhoodAttention2d(_NeighborhoodAttentionNd):
       torch.zeros(num_heads, (2 * self.kernel_size - 1), (2 * self.kernel_size - 1)),
       requires_grad=True,
     )
-    if NATTEN_API == "mps":
+    if NATTEN_API in ("mps", "torch"):
         self.natten = natten2d
     else:
         self.nattendqkrpb = natten2dqkrpb
@@ -207,8 +262,9 @@ class _NeighborhoodAttentionModuleNd(ABC, nn.Module):
     hidden_states: torch.Tensor,
     output_attentions: Optional[bool] = False,
     original_dims: Optional[Tuple[int, ...]] = None,
+    lengths: Optional[Sequence[int]] = None,
   ) -> Tuple[torch.Tensor]:
-    self_outputs = self.self(hidden_states, output_attentions, original_dims)
+    self_outputs = self.self(hidden_states, output_attentions, original_dims, lengths)
     attention_output = self.output(self_outputs[0])
     outputs = (attention_output,) + self_outputs[1:]
     return outputs
@@ -290,7 +346,9 @@ class _DinatLayerNd(ABC, nn.Module):
     self,
     hidden_states: torch.Tensor,
     output_attentions: Optional[bool] = False,
+    lengths: Optional[Sequence[int]] = None,
   ) -> Tuple[torch.Tensor, torch.Tensor]:
+    # lengths: the number of valid frames of each item of a zero-padded batch, or None if nothing is padded.
     if len(hidden_states.shape) > 3:
       is_2d = True
       N, K, T, C = hidden_states.size()
@@ -307,6 +365,10 @@ class _DinatLayerNd(ABC, nn.Module):
       hidden_states, pad_values = self.maybe_pad(hidden_states, K, T)
     else:
       hidden_states, pad_values = self.maybe_pad(hidden_states, T)
+    if lengths is not None:
+      # Alone, an item would be padded with zeros up to the window size, like in maybe_pad.
+      hidden_states = mask_padding(hidden_states, lengths, dim=2 if is_2d else 1)
+      lengths = [max(length, self.window_size) for length in lengths]
     
     attention_inputs = hidden_states
     hidden_states_list = []
@@ -317,7 +379,8 @@ class _DinatLayerNd(ABC, nn.Module):
       attention_output = attention(
           attention_inputs, 
           output_attentions=output_attentions,
-          original_dims=original_dims
+          original_dims=original_dims,
+          lengths=lengths,
       )[0]
       
       # Un-pad if necessary
@@ -1,13 +1,26 @@
+import copy
+import warnings
 import torch
 import torch.nn as nn
 
-from typing import List
+from typing import List, Optional, Sequence
+from torch.func import functional_call, stack_module_state, vmap
 from .allinone import AllInOne
+from .dinat import NATTEN_API
 from ..typings import AllInOneOutput
 
 
+def default_fused(device) -> bool:
+  """
+  Whether to fuse the folds of an ensemble by default. Running them in one batched forward pays off where kernel
+  launches dominate, i.e. not on CPU, and only with the PyTorch attention backend (``NATTEN_API=torch``):
+  the NATTEN kernels have no batching rule and still run once per fold.
+  """
+  return NATTEN_API == 'torch' and torch.device(device).type != 'cpu'
+
+
 class Ensemble(nn.Module):
-  def __init__(self, models: List[AllInOne]):
+  def __init__(self, models: List[AllInOne], fused: bool = False):
     super().__init__()
 
     cfg = models[0].cfg.copy()
@@ -16,9 +29,22 @@ class Ensemble(nn.Module):
 
     self.cfg = cfg
     self.models = models
+    self.fused = fused
+    self._stacked = None
+
+  def forward(self, x, lengths: Optional[Sequence[int]] = None):
+    if self.fused and not self.training and not torch.is_grad_enabled():
+      try:
+        return self.forward_fused(x, lengths)
+      except RuntimeError as e:
+        # Other errors, e.g. running out of memory on one batch, must not disable fusion for good, since
+        # the loaded models are shared by the whole process.
+        if isinstance(e, torch.cuda.OutOfMemoryError) or not _is_vmap_error(e):
+          raise
+        warnings.warn(f'Fused ensemble failed, running the models one after another instead: {e}')
+        self.fused = False
 
-  def forward(self, x):
-    outputs: List[AllInOneOutput] = [model(x) for model in self.models]
+    outputs: List[AllInOneOutput] = [model(x, lengths=lengths) for model in self.models]
     avg = AllInOneOutput(
       logits_beat=torch.stack([output.logits_beat for output in outputs], dim=0).mean(dim=0),
       logits_downbeat=torch.stack([output.logits_downbeat for output in outputs], dim=0).mean(dim=0),
@@ -28,3 +54,51 @@ class Ensemble(nn.Module):
     )
 
     return avg
+
+  def forward_fused(self, x, lengths: Optional[Sequence[int]] = None):
+    """
+    Runs all models in one forward pass over their parameters stacked along a leading model dimension,
+    so that each layer is a single batched operation instead of one small operation per model.
+    The parameters are the same as in the checkpoints, only stacked. The neighborhood attention is only fused
+    with ``NATTEN_API=torch``; the NATTEN kernels of the other backends are still called once per model.
+    """
+    params, buffers, base = self.stacked_state()
+
+    def run(params, buffers, x):
+      output = functional_call(base, (params, buffers), (x,), {'lengths': lengths})
+      return (
+        output.logits_beat,
+        output.logits_downbeat,
+        output.logits_section,
+        output.logits_function,
+        output.embeddings,
+      )
+
+    logits_beat, logits_downbeat, logits_section, logits_function, embeddings = vmap(
+      run, in_dims=(0, 0, None), randomness='same',
+    )(params, buffers, x)
+
+    return AllInOneOutput(
+      logits_beat=logits_beat.mean(dim=0),
+      logits_downbeat=logits_downbeat.mean(dim=0),
+      logits_section=logits_section.mean(dim=0),
+      logits_function=logits_function.mean(dim=0),
+      embeddings=embeddings.movedim(0, -1),
+    )
+
+  def stacked_state(self):
+    # Stack the parameters once, and again only if the models have been moved to another device or dtype.
+    reference = next(self.models[0].parameters())
+    key = (reference.device, reference.dtype)
+    if self._stacked is None or self._stacked[0] != key:
+      params, buffers = stack_module_state(self.models)
+      # The base model only provides the structure, its own parameters are never used.
+      base = copy.deepcopy(self.models[0]).to('meta')
+      self._stacked = (key, params, buffers, base)
+    return self._stacked[1:]
+
+
+def _is_vmap_error(error: RuntimeError) -> bool:
+  """Whether an error comes from an operator that ``torch.func.vmap`` does not support."""
+  message = str(error).lower()
+  return any(pattern in message for pattern in ['vmap', 'batching rule', 'batchedtensor', 'functorch'])
@@ -1,10 +1,15 @@
+import os
+import threading
+import uuid
 import torch
 
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional, Tuple
 from omegaconf import OmegaConf
-from huggingface_hub import hf_hub_download
+from huggingface_hub import hf_hub_download, try_to_load_from_cache
 from .allinone import AllInOne
-from .ensemble import Ensemble
+from .ensemble import Ensemble, default_fused
 from ..typings import PathLike
 
 NAME_TO_FILE = {
@@ -31,48 +36,134 @@ ENSEMBLE_MODELS = {
   ],
 }
 
+REPO_ID = 'taejunkim/allinone'
+
+# Where the converted checkpoints are stored if no cache_dir is given.
+MODEL_DIR = Path(os.environ.get('ALLIN1_MODEL_DIR', '~/.cache/allin1/models')).expanduser()
+
+# Models already loaded by this process, keyed by (name, device, dtype, fused).
+_models: Dict[Tuple[str, str, torch.dtype, Optional[bool]], torch.nn.Module] = {}
+_models_lock = threading.Lock()
+
 
 def load_pretrained_model(
   model_name: Optional[str] = None,
   cache_dir: Optional[PathLike] = None,
   device=None,
+  fused: Optional[bool] = None,
+  dtype: Optional[torch.dtype] = None,
+  use_cache: bool = True,
 ):
-  if model_name in ENSEMBLE_MODELS:
-    return load_ensemble_model(model_name, cache_dir, device)
-
-  model_name = model_name or list(NAME_TO_FILE.keys())[0]
-  assert model_name in NAME_TO_FILE, f'Unknown model name: {model_name} (expected one of {list(NAME_TO_FILE.keys())})'
+  """
+  Returns a pre-trained model, or an ensemble of them, in eval mode.
 
+  The checkpoints are downloaded from the Hugging Face Hub once and converted into memory-mappable files
+  (see ``convert_checkpoint``), after which the hub is not contacted anymore. Models are also kept in memory
+  for the lifetime of the process, so loading the same model on the same device with the same dtype again
+  returns the same instance unless ``use_cache`` is False. The returned models must therefore not be modified.
+  """
   if device is None:
     if torch.cuda.device_count():
       device = 'cuda'
     else:
       device = 'cpu'
+  dtype = dtype or torch.float32
 
-  filename = NAME_TO_FILE[model_name]
-  checkpoint_path = hf_hub_download(repo_id='taejunkim/allinone', filename=filename, cache_dir=cache_dir)
+  if model_name in ENSEMBLE_MODELS:
+    return load_ensemble_model(model_name, cache_dir, device, fused, dtype, use_cache)
 
-  checkpoint = torch.load(checkpoint_path, map_location=device)
-  config = OmegaConf.create(checkpoint['config'])
+  model_name = model_name or list(NAME_TO_FILE.keys())[0]
+  assert model_name in NAME_TO_FILE, f'Unknown model name: {model_name} (expected one of {list(NAME_TO_FILE.keys())})'
 
-  model = AllInOne(config).to(device)
-  model.load_state_dict(checkpoint['state_dict'])
-  model.eval()
+  def load():
+    state_path, config_path = convert_checkpoint(model_name, cache_dir)
+    config = OmegaConf.load(config_path)
+    # The parameters are replaced by the memory-mapped ones, so they are not initialized at all.
+    with torch.device('meta'):
+      model = AllInOne(config)
+    state_dict = torch.load(state_path, map_location='cpu', mmap=True, weights_only=True)
+    model.load_state_dict(state_dict, assign=True)
+    return model.to(device, dtype).eval()
 
-  return model
+  return _cached((model_name, str(device), dtype, None), load, use_cache)
 
 
 def load_ensemble_model(
   model_name: Optional[str] = None,
   cache_dir: Optional[PathLike] = None,
   device=None,
+  fused: Optional[bool] = None,
+  dtype: Optional[torch.dtype] = None,
+  use_cache: bool = True,
 ):
-  models = []
-  for model_name in ENSEMBLE_MODELS[model_name]:
-    model = load_pretrained_model(model_name, cache_dir, device)
-    models.append(model)
+  if fused is None:
+    fused = default_fused(device)
 
-  ensemble = Ensemble(models).to(device)
-  ensemble.eval()
+  def load():
+    fold_names = ENSEMBLE_MODELS[model_name]
+    # The folds are downloaded and read in parallel.
+    with ThreadPoolExecutor(len(fold_names)) as pool:
+      models = list(pool.map(
+        lambda fold_name: load_pretrained_model(fold_name, cache_dir, device, dtype=dtype, use_cache=use_cache),
+        fold_names,
+      ))
+    ensemble = Ensemble(models, fused=fused).to(device)
+    ensemble.eval()
+    return ensemble
 
-  return ensemble
+  return _cached((model_name, str(device), dtype or torch.float32, fused), load, use_cache)
+
+
+def convert_checkpoint(model_name: str, cache_dir: Optional[PathLike] = None) -> Tuple[Path, Path]:
+  """
+  Returns the paths of the state dict and the config of a pre-trained model, converted from its checkpoint.
+
+  The state dict is saved with ``torch.save`` so that it can be memory-mapped with ``torch.load(mmap=True)``,
+  and the config as YAML. Both are named after the checkpoint, which changes whenever the weights change,
+  and stored in ``cache_dir/allin1`` or ``MODEL_DIR``. The checkpoint is only looked up on the hub
+  if it has not been converted yet, and only downloaded if it is not in the hub cache.
+  """
+  filename = NAME_TO_FILE[model_name]
+  model_dir = Path(cache_dir).expanduser() / 'allin1' if cache_dir is not None else MODEL_DIR
+  state_path = model_dir / Path(filename).with_suffix('.pt')
+  config_path = model_dir / Path(filename).with_suffix('.yaml')
+  if state_path.is_file() and config_path.is_file():
+    return state_path, config_path
+
+  checkpoint_path = try_to_load_from_cache(repo_id=REPO_ID, filename=filename, cache_dir=cache_dir)
+  if not isinstance(checkpoint_path, str):
+    checkpoint_path = hf_hub_download(repo_id=REPO_ID, filename=filename, cache_dir=cache_dir)
+  checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+
+  # Written to temporary files and renamed, so that concurrent processes never read partial files.
+  model_dir.mkdir(parents=True, exist_ok=True)
+  for path, save in [
+    (config_path, lambda p: OmegaConf.save(OmegaConf.create(checkpoint['config']), p)),
+    (state_path, lambda p: torch.save(checkpoint['state_dict'], p)),
+  ]:
+    tmp_path = path.with_name(f'.tmp-{uuid.uuid4().hex}-{path.name}')
+    try:
+      save(tmp_path)
+      os.replace(tmp_path, path)
+    finally:
+      tmp_path.unlink(missing_ok=True)
+  return state_path, config_path
+
+
+def clear_model_cache():
+  """Forgets the models kept in memory by ``load_pretrained_model``."""
+  with _models_lock:
+    _models.clear()
+
+
+def _cached(key, load, use_cache: bool):
+  if not use_cache:
+    return load()
+  with _models_lock:
+    model = _models.get(key)
+  if model is None:
+    model = load()
+    with _models_lock:
+      # Another thread may have loaded the same model in the meantime.
+      model = _models.setdefault(key, model)
+  return model
@@ -0,0 +1,155 @@
+"""Pure PyTorch implementation of dilated neighborhood attention.
+
+Provides ``natten1d`` and ``natten2d`` with the same signature as the Metal extension in ``natten_mps``,
+so that the model can run on machines where neither the Metal nor the upstream NATTEN extensions are available.
+Select it with ``NATTEN_API=torch``.
+
+The neighborhoods follow the rules of NATTEN: each query attends to ``kernel_size`` keys taken every ``dilation``
+positions, the window is shifted inwards at the borders instead of being truncated, and positions are only mixed
+with others of the same residue modulo ``dilation``. The queries are expected to be scaled already.
+
+Both functions optionally take the ``lengths`` of the items of a zero-padded batch along the (last) sequence axis.
+Each item then attends as if the sequence ended at its own length, with the windows shifted inwards at that
+border, so that padding an item does not change its outputs.
+"""
+
+import torch
+
+from functools import lru_cache
+from typing import Optional, Sequence, Tuple
+
+
+@lru_cache(maxsize=64)
+def neighborhood_indices(
+  length: int,
+  kernel_size: int,
+  dilation: int,
+  device: torch.device,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+  """
+  Returns the key indices with shape (length, kernel_size) attended by each query,
+  and the corresponding indices into the relative positional biases.
+  Since the windows are only shifted at the borders, ``neighbors[:, 0] + dilation * arange(kernel_size)``
+  gives every row back, which is what ``dilated_windows`` relies on.
+  """
+  if length < kernel_size * dilation:
+    raise ValueError(
+      f'Length ({length}) must be at least kernel_size x dilation ({kernel_size} x {dilation}). '
+      f'Pad the inputs first.'
+    )
+  index = torch.arange(length)
+  group = index % dilation
+  group_length = (length - group + dilation - 1) // dilation
+  start = (index // dilation - kernel_size // 2).clamp(min=0)
+  start = torch.minimum(start, group_length - kernel_size)
+  neighbors = group[:, None] + dilation * (start[:, None] + torch.arange(kernel_size))
+  bias = (kernel_size - 1) + torch.div(neighbors - index[:, None], dilation, rounding_mode='floor')
+  return neighbors.to(device), bias.to(device)
+
+
+def padded_neighborhood_indices(
+  length: int,
+  lengths: Sequence[int],
+  kernel_size: int,
+  dilation: int,
+  device: torch.device,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+  """
+  Same as ``neighborhood_indices`` for each item of a batch padded to ``length``, with shape
+  (batch, length, kernel_size). The queries in the padding of an item reuse the neighbors of its last position.
+  """
+  neighbors, bias = [], []
+  for item_length in lengths:
+    item_neighbors, item_bias = neighborhood_indices(item_length, kernel_size, dilation, device)
+    padding = length - item_length
+    neighbors.append(torch.cat([item_neighbors, item_neighbors[-1:].expand(padding, -1)]))
+    bias.append(torch.cat([item_bias, item_bias[-1:].expand(padding, -1)]))
+  return torch.stack(neighbors), torch.stack(bias)
+
+
+def dilated_windows(x: torch.Tensor, dim: int, starts: torch.Tensor, kernel_size: int, dilation: int):
+  """
+  Returns the windows of ``kernel_size`` elements taken every ``dilation`` positions along ``dim``,
+  starting at ``starts``. The window elements are on a new last axis.
+  ``starts`` has shape (length,), or (batch, length) to take different windows for each item of the first axis.
+  """
+  windows = x.unfold(dim, (kernel_size - 1) * dilation + 1, 1)[..., ::dilation]
+  if starts.dim() == 1:
+    return windows.index_select(dim, starts)
+  shape = [1] * windows.dim()
+  shape[0], shape[dim] = starts.shape
+  index = starts.view(shape).expand(windows.shape[:dim] + starts.shape[1:] + windows.shape[dim + 1:])
+  return windows.gather(dim, index)
+
+
+def natten1d(
+  query: torch.Tensor,
+  key: torch.Tensor,
+  value: torch.Tensor,
+  rpb: torch.Tensor,
+  kernel_size: int,
+  dilation: int,
+  original_length: int,
+  lengths: Optional[Sequence[int]] = None,
+) -> torch.Tensor:
+  """
+  Inputs have shape (batch, heads, length, dim) and ``rpb`` has shape (heads, 2 * kernel_size - 1).
+  Returns the attention output with shape (batch, original_length, heads x dim).
+  """
+  B, H, L, D = query.shape
+  if lengths is None:
+    neighbors, bias = neighborhood_indices(L, kernel_size, dilation, query.device)
+    bias = rpb[:, bias]  # H, L, kernel
+  else:
+    neighbors, bias = padded_neighborhood_indices(L, lengths, kernel_size, dilation, query.device)
+    bias = rpb[:, bias].transpose(0, 1)  # B, H, L, kernel
+  starts = neighbors[..., 0]
+
+  keys = dilated_windows(key, 2, starts, kernel_size, dilation)  # B, H, L, D, kernel
+  scores = torch.matmul(query.unsqueeze(-2), keys).squeeze(-2)  # B, H, L, kernel
+  probs = (scores + bias).softmax(dim=-1)
+
+  values = dilated_windows(value, 2, starts, kernel_size, dilation)  # B, H, L, D, kernel
+  output = torch.matmul(values, probs.unsqueeze(-1)).squeeze(-1)  # B, H, L, D
+
+  output = output[:, :, :original_length].permute(0, 2, 1, 3)
+  return output.reshape(B, original_length, H * D)
+
+
+def natten2d(
+  query: torch.Tensor,
+  key: torch.Tensor,
+  value: torch.Tensor,
+  rpb: torch.Tensor,
+  kernel_size: int,
+  dilation: int,
+  original_height: int,
+  original_width: int,
+  lengths: Optional[Sequence[int]] = None,
+) -> torch.Tensor:
+  """
+  Inputs have shape (batch, heads, height, width, dim) and ``rpb`` has shape
+  (heads, 2 * kernel_size - 1, 2 * kernel_size - 1). ``lengths`` are along the width.
+  Returns the attention output with shape (batch, original_height, original_width, heads x dim).
+  """
+  B, H, X, Y, D = query.shape
+  neighbors_x, bias_x = neighborhood_indices(X, kernel_size, dilation, query.device)
+  if lengths is None:
+    neighbors_y, bias_y = neighborhood_indices(Y, kernel_size, dilation, query.device)
+    bias = rpb[:, bias_x[:, None, :, None], bias_y[None, :, None, :]].reshape(H, X, Y, -1)
+  else:
+    neighbors_y, bias_y = padded_neighborhood_indices(Y, lengths, kernel_size, dilation, query.device)
+    bias = rpb[:, bias_x[None, :, None, :, None], bias_y[:, None, :, None, :]]  # H, B, X, Y, kernel, kernel
+    bias = bias.reshape(H, B, X, Y, -1).transpose(0, 1)
+
+  def windows(x: torch.Tensor):
+    x = dilated_windows(x, 2, neighbors_x[:, 0], kernel_size, dilation)
+    x = dilated_windows(x, 3, neighbors_y[..., 0], kernel_size, dilation)
+    return x.reshape(B, H, X, Y, D, kernel_size * kernel_size)
+
+  scores = torch.matmul(query.unsqueeze(-2), windows(key)).squeeze(-2)  # B, H, X, Y, kernel x kernel
+  probs = (scores + bias).softmax(dim=-1)
+  output = torch.matmul(windows(value), probs.unsqueeze(-1)).squeeze(-1)  # B, H, X, Y, D
+
+  output = output[:, :, :original_height, :original_width].permute(0, 2, 3, 1, 4)
+  return output.reshape(B, original_height, original_width, H * D)
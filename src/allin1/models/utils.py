@@ -19,3 +19,19 @@ def get_activation_function(name: str):
     return activation_functions[name]
   else:
     raise ValueError(f"Unsupported activation function: {name}")
+
+
+def get_receptive_field(cfg) -> int:
+  """
+  Returns how many frames on each side of a frame can influence its output, following the dilated
+  neighborhood attention layers of the encoder and the convolutions of the embeddings.
+  """
+  # conv0 and conv2 of the embeddings have a kernel size of 3 along time.
+  frames = 2
+  for i in range(cfg.depth):
+    dilation = min(cfg.dilation_factor ** i, cfg.dilation_max)
+    if cfg.double_attention:
+      dilation *= 2
+    # Time attention, then instrument attention with a kernel size of 5 and no dilation.
+    frames += (cfg.kernel_size // 2) * dilation + 5 // 2
+  return frames
@@ -0,0 +1,115 @@
+import queue
+import threading
+
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+
+_DONE = object()
+
+
+@dataclass
+class Stage:
+  name: str
+  fn: Callable[[Any], Any]
+  num_workers: int = 1
+
+
+def run_pipeline(
+  items: Iterable[Any],
+  stages: List[Stage],
+  queue_size: int = 2,
+) -> Iterator[Tuple[int, Any]]:
+  """
+  Runs every item through the given stages, overlapping the stages across items.
+
+  Each stage owns a pool of worker threads and reads from a bounded queue filled by the previous stage,
+  so a slow stage applies back-pressure instead of letting intermediate results pile up in memory.
+  Yields ``(index, output)`` pairs of the last stage in completion order, where ``index`` is the position
+  of the item in ``items``. If any stage raises, the pipeline is stopped and the exception is re-raised.
+  """
+  if not stages:
+    raise ValueError('At least one stage must be specified.')
+
+  stop = threading.Event()
+  errors = []
+  queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+  def put(q: queue.Queue, item):
+    while not stop.is_set():
+      try:
+        q.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        continue
+
+  def get(q: queue.Queue):
+    while not stop.is_set():
+      try:
+        return q.get(timeout=0.1)
+      except queue.Empty:
+        continue
+    return _DONE
+
+  def feed():
+    try:
+      for index, item in enumerate(items):
+        if stop.is_set():
+          return
+        put(queues[0], (index, item))
+    except BaseException as e:
+      # Raised by the iterable itself, e.g. a generator.
+      errors.append(('input', e))
+      stop.set()
+      return
+    put(queues[0], _DONE)
+
+  def work(stage: Stage, q_in: queue.Queue, q_out: queue.Queue, remaining: List[int], lock: threading.Lock):
+    try:
+      while True:
+        job = get(q_in)
+        if job is _DONE:
+          # Let the other workers of this stage see the sentinel too.
+          put(q_in, _DONE)
+          break
+        index, item = job
+        put(q_out, (index, stage.fn(item)))
+    except BaseException as e:
+      errors.append((stage.name, e))
+      stop.set()
+    finally:
+      with lock:
+        remaining[0] -= 1
+        last_worker = remaining[0] == 0
+      if last_worker:
+        put(q_out, _DONE)
+
+  threads = [threading.Thread(target=feed, name='pipeline-feed', daemon=True)]
+  for i, stage in enumerate(stages):
+    num_workers = max(1, stage.num_workers)
+    remaining = [num_workers]
+    lock = threading.Lock()
+    for j in range(num_workers):
+      threads.append(threading.Thread(
+        target=work,
+        args=(stage, queues[i], queues[i + 1], remaining, lock),
+        name=f'pipeline-{stage.name}-{j}',
+        daemon=True,
+      ))
+
+  for thread in threads:
+    thread.start()
+
+  try:
+    while True:
+      job = get(queues[-1])
+      if job is _DONE:
+        break
+      yield job
+  finally:
+    stop.set()
+    for thread in threads:
+      thread.join()
+
+  if errors:
+    stage_name, error = errors[0]
+    raise RuntimeError(f'Pipeline stage "{stage_name}" failed: {error}') from error
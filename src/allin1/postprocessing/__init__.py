@@ -1,3 +1,4 @@
-from .metrical import postprocess_metrical_structure
-from .functional import postprocess_functional_structure
+from .metrical import postprocess_metrical_structure, postprocess_metrical_structures
+from .functional import postprocess_functional_structure, postprocess_functional_structures
 from .tempo import estimate_tempo_from_beats
+from .dbn import DBNDownBeatDecoder, get_downbeat_decoder
@@ -0,0 +1,299 @@
+import numpy as np
+
+from functools import lru_cache
+from typing import List, Sequence, Tuple
+from madmom.features.beats_hmm import (
+  BarStateSpace,
+  RNNDownBeatTrackingObservationModel,
+  exponential_transition,
+)
+
+
+class DBNDownBeatDecoder:
+  """
+  Drop-in replacement for madmom's ``DBNDownBeatTrackingProcessor`` that decodes several tracks at once.
+
+  The bar pointer models are the ones madmom builds, but decoding exploits their structure instead of running
+  madmom's generic sparse Viterbi over every state. Inside a beat, each state can only be reached from the
+  previous one, so the score of any state is the score of the first state of its beat some frames earlier
+  plus a sum of observation log densities, which is read from cumulative sums. The Viterbi recursion
+  therefore only tracks the first states of the beats (one per beat and tempo), and backpointers are only
+  kept for them. All bar lengths and tracks are decoded together with NumPy array operations.
+  Build it with ``get_downbeat_decoder`` to reuse the models across tracks.
+  """
+
+  def __init__(
+    self,
+    beats_per_bar: Sequence[int],
+    fps: float,
+    threshold: float = 0.05,
+    min_bpm: float = 55.,
+    max_bpm: float = 215.,
+    num_tempi: int = 60,
+    transition_lambda: float = 100,
+    observation_lambda: float = 16,
+    correct: bool = True,
+    chunk_size: int = 256,
+  ):
+    self.beats_per_bar = list(beats_per_bar)
+    self.fps = fps
+    self.threshold = threshold
+    self.correct = correct
+    self.observation_lambda = observation_lambda
+    self.chunk_size = chunk_size
+
+    min_interval = 60. * fps / max_bpm
+    max_interval = 60. * fps / min_bpm
+
+    # The states of all bar lengths are concatenated. A "slot" is one beat of one bar length,
+    # and each slot has one first state and one last state per tempo.
+    offsets, positions, pointers = [], [], []
+    first_states, intervals, num_beat_states, beat_types = [], [], [], []
+    prev_slots, log_init, log_transitions = [], [], []
+    offset = 0
+    for beats in self.beats_per_bar:
+      st = BarStateSpace(beats, min_interval, max_interval, num_tempi)
+      om = RNNDownBeatTrackingObservationModel(st, observation_lambda)
+      offsets.append((offset, offset + st.num_states))
+      positions.append(st.state_positions)
+      pointers.append(om.pointers.astype(np.int64))
+      for beat in range(beats):
+        from_states = st.last_states[beat - 1]
+        to_states = st.first_states[beat]
+        prob = exponential_transition(
+          st.state_intervals[from_states],
+          st.state_intervals[to_states],
+          transition_lambda,
+        )
+        with np.errstate(divide='ignore'):
+          log_transitions.append(np.log(prob).T)  # to, from
+        first_states.append(to_states + offset)
+        intervals.append(st.state_intervals[to_states])
+        # The first states of a beat observe a beat (a downbeat for the first beat), the others nothing.
+        num_beat_states.append([np.count_nonzero(om.pointers[f:f + i]) for f, i in zip(to_states, intervals[-1])])
+        beat_types.append(om.pointers[to_states[0]])
+        prev_slots.append(len(prev_slots) - beat + (beat - 1) % beats)
+        log_init.append(-np.log(st.num_states))
+      offset += st.num_states
+
+    self.offsets = offsets
+    self.state_positions = np.concatenate(positions)
+    self.pointers = np.concatenate(pointers)
+    self.num_states = offset
+
+    self.first_states = np.stack(first_states)  # slots, tempi
+    self.intervals = np.stack(intervals)  # slots, tempi
+    self.num_beat_states = np.array(num_beat_states)  # slots, tempi
+    self.beat_types = np.array(beat_types, dtype=np.int64)  # slots
+    self.prev_slots = np.array(prev_slots)  # slots
+    self.log_init = np.array(log_init)  # slots
+    self.log_transitions = np.stack(log_transitions)  # slots, tempi (to), tempi (from)
+
+    # Tempo changes are only allowed between close tempi, so the transitions into each first state
+    # come from a contiguous band of tempi. The bands are padded with impossible transitions.
+    possible = np.isfinite(self.log_transitions)
+    width = int(possible.sum(axis=-1).max())
+    lo = np.clip(possible.argmax(axis=-1), 0, num_tempi - width)
+    self.bands = lo[..., None] + np.arange(width)  # slots, tempi (to), band
+    self.band_log_transitions = np.take_along_axis(self.log_transitions, self.bands, axis=-1)
+
+    # For every state: its slot, tempo, and position within the beat.
+    self.state_slots = np.empty(self.num_states, dtype=np.int64)
+    self.state_tempi = np.empty(self.num_states, dtype=np.int64)
+    self.state_offsets = np.empty(self.num_states, dtype=np.int64)
+    for k, (firsts, lengths) in enumerate(zip(self.first_states, self.intervals)):
+      for q, (f, length) in enumerate(zip(firsts, lengths)):
+        self.state_slots[f:f + length] = k
+        self.state_tempi[f:f + length] = q
+        self.state_offsets[f:f + length] = np.arange(length)
+
+  def __call__(self, activations: np.ndarray) -> np.ndarray:
+    return self.decode([activations])[0]
+
+  def decode(self, activations: List[np.ndarray]) -> List[np.ndarray]:
+    """
+    Detects the beats and downbeats in several activation functions, each with shape (frames, 2) for the beat
+    and downbeat probabilities. Returns an array of (time, beat number) rows per track, like madmom.
+    """
+    results = [np.empty((0, 2))] * len(activations)
+    firsts, crops, todo = [], [], []
+    for i, act in enumerate(activations):
+      first = 0
+      if self.threshold:
+        idx = np.nonzero(act >= self.threshold)[0]
+        if idx.any():
+          first = max(first, np.min(idx))
+          last = min(len(act), np.max(idx) + 1)
+        else:
+          last = first
+        act = act[first:last]
+      if not act.any():
+        continue
+      firsts.append(first)
+      crops.append(act)
+      todo.append(i)
+
+    if not todo:
+      return results
+
+    paths = self.viterbi([self.log_densities(act) for act in crops])
+    for i, first, act, path in zip(todo, firsts, crops, paths):
+      results[i] = self.beats_from_path(path, act, first)
+    return results
+
+  def log_densities(self, observations: np.ndarray) -> np.ndarray:
+    log_densities = np.empty((len(observations), 3), dtype=np.float64)
+    with np.errstate(divide='ignore'):
+      log_densities[:, 0] = np.log((1. - np.sum(observations, axis=1)) / (self.observation_lambda - 1))
+      log_densities[:, 1] = np.log(observations[:, 0])
+      log_densities[:, 2] = np.log(observations[:, 1])
+    return log_densities
+
+  def scores(self, t, history, cum_densities, slots, tempi, offsets):
+    """
+    Returns the Viterbi scores at frame ``t`` of the states given by their slots, tempi, and offsets within
+    the beat, with shape (tracks, states). They are computed from the scores of the first states in ``history``,
+    a ring buffer with shape (tracks, frames x slots x tempi), and the cumulative log densities with shape
+    (tracks, (frames + 1) x 3).
+    """
+    K, Q = self.first_states.shape
+    start = t - offsets
+    ring = (np.maximum(start, 0) % (history.shape[1] // (K * Q))) * K * Q
+    base = np.where(start >= 0, history[:, ring + slots * Q + tempi], self.log_init[slots])
+    # The first frames of a beat observe the beat type of the slot, the following ones nothing.
+    num_beat_states = self.num_beat_states[slots, tempi]
+    beat_types = self.beat_types[slots]
+    lo_beat = np.maximum(start + 1, 0)
+    hi_beat = np.maximum(np.minimum(start + num_beat_states, t + 1), lo_beat)
+    lo_none = np.clip(start + num_beat_states, 0, t + 1)
+    with np.errstate(invalid='ignore'):
+      return (
+        base
+        + (cum_densities[:, hi_beat * 3 + beat_types] - cum_densities[:, lo_beat * 3 + beat_types])
+        + (cum_densities[:, [(t + 1) * 3]] - cum_densities[:, lo_none * 3])
+      )
+
+  def viterbi(self, log_densities: List[np.ndarray]) -> List[np.ndarray]:
+    """
+    Returns the best state path of each track, within the bar length with the highest log probability,
+    or an empty path if every path is impossible.
+    """
+    lengths = [len(d) for d in log_densities]
+    B, T = len(log_densities), max(lengths)
+    K, Q = self.first_states.shape
+    densities = np.zeros((B, T, 3))
+    for b, d in enumerate(log_densities):
+      densities[b, :len(d)] = d
+    cum_densities = np.zeros((B, T + 1, 3))
+    np.cumsum(densities, axis=1, out=cum_densities[:, 1:])
+    cum_densities = cum_densities.reshape(B, -1)
+
+    # Scores of the first states are kept for as long as they can reach the last states of their beat.
+    R = int(self.intervals.max())
+    history = np.empty((B, R * K * Q))
+    backpointers = np.empty((T, B, K, Q), dtype=np.uint8 if self.bands.shape[-1] <= 256 else np.int64)
+    # The last states of the beat before each slot, one per tempo.
+    last_slots = np.repeat(self.prev_slots, Q)
+    last_tempi = np.tile(np.arange(Q), K)
+    last_rows = last_slots * Q + last_tempi
+    last_intervals = self.intervals[last_slots, last_tempi]
+    last_num_beat_states = self.num_beat_states[last_slots, last_tempi]
+    last_types = self.beat_types[last_slots]
+    # Last states that can reach each first state, with shape (band, slots, tempi).
+    # The band comes before the states so that the reductions over it work on contiguous blocks.
+    band_sources = np.moveaxis(np.arange(K)[:, None, None] * Q + self.bands, -1, 0)
+    band_log_transitions = np.moveaxis(self.band_log_transitions, -1, 0)
+    candidates = np.empty((B,) + band_sources.shape)
+    first_types = self.beat_types
+
+    ends = {}
+    for b, length in enumerate(lengths):
+      ends.setdefault(length - 1, []).append(b)
+    finals = [None] * B
+
+    for t0 in range(0, T, self.chunk_size):
+      # Once every beat ending at t - 1 started at t - interval >= 0, the score of its last state is the score of
+      # its first state plus the log densities observed in between, which are computed for a chunk of frames at once.
+      frames = np.arange(t0, min(t0 + self.chunk_size, T))[:, None]
+      starts = frames - last_intervals
+      rows = (starts % R) * K * Q + last_rows
+      with np.errstate(invalid='ignore'):
+        observed = (
+          (cum_densities[:, (starts + last_num_beat_states) * 3 + last_types]
+           - cum_densities[:, (starts + 1) * 3 + last_types])
+          + (cum_densities[:, frames * 3] - cum_densities[:, (starts + last_num_beat_states) * 3])
+        )
+
+      for i, t in enumerate(frames[:, 0]):
+        # The first states are reached from the last states of the previous beat at frame t - 1.
+        if t == 0:
+          first = np.repeat(self.log_init[:, None] + densities[:, t, first_types][..., None], Q, axis=-1)
+        else:
+          if t >= R:
+            last = history[:, rows[i]] + observed[:, i]
+          else:
+            last = self.scores(t - 1, history, cum_densities, last_slots, last_tempi, last_intervals - 1)
+          np.take(last, band_sources, axis=1, out=candidates)
+          np.add(candidates, band_log_transitions, out=candidates)
+          backpointers[t] = candidates.argmax(axis=1)
+          first = candidates.max(axis=1) + densities[:, t, first_types][..., None]
+        history[:, (t % R) * K * Q:][:, :K * Q] = first.reshape(B, K * Q)
+        for b in ends.get(t, []):
+          finals[b] = self.scores(
+            t, history[b:b + 1], cum_densities[b:b + 1], self.state_slots, self.state_tempi, self.state_offsets,
+          )[0]
+
+    paths = []
+    for b in range(B):
+      scores = [finals[b][start:stop].max() for start, stop in self.offsets]
+      best = int(np.argmax(scores))
+      if np.isinf(scores[best]):
+        paths.append(np.empty(0, dtype=np.int64))
+        continue
+      start, stop = self.offsets[best]
+      state = start + int(np.argmax(finals[b][start:stop]))
+      slot, tempo, offset = self.state_slots[state], self.state_tempi[state], self.state_offsets[state]
+
+      # Walk back one beat at a time: within a beat, the path goes through consecutive states.
+      path = np.empty(lengths[b], dtype=np.int64)
+      t = lengths[b] - 1
+      while True:
+        begin = max(t - offset, 0)
+        path[begin:t + 1] = self.first_states[slot, tempo] + offset - (t - np.arange(begin, t + 1))
+        t -= offset
+        if t <= 0:
+          break
+        tempo = self.bands[slot, tempo, backpointers[t, b, slot, tempo]]
+        slot = self.prev_slots[slot]
+        offset = self.intervals[slot, tempo] - 1
+        t -= 1
+      paths.append(path)
+    return paths
+
+  def beats_from_path(self, path: np.ndarray, activations: np.ndarray, first: int) -> np.ndarray:
+    # Same as the end of DBNDownBeatTrackingProcessor.process.
+    if not len(path):
+      return np.empty((0, 2))
+    positions = self.state_positions[path]
+    beat_numbers = positions.astype(int) + 1
+    if self.correct:
+      beats = np.empty(0, dtype=np.int64)
+      beat_range = self.pointers[path] >= 1
+      idx = np.nonzero(np.diff(beat_range.astype(np.int64)))[0] + 1
+      if beat_range[0]:
+        idx = np.r_[0, idx]
+      if beat_range[-1]:
+        idx = np.r_[idx, beat_range.size]
+      if idx.any():
+        for left, right in idx.reshape((-1, 2)):
+          peak = np.argmax(activations[left:right]) // 2 + left
+          beats = np.hstack((beats, peak))
+    else:
+      beats = np.nonzero(np.diff(beat_numbers))[0] + 1
+    return np.vstack(((beats + first) / float(self.fps), beat_numbers[beats])).T
+
+
+@lru_cache(maxsize=8)
+def get_downbeat_decoder(beats_per_bar: Tuple[int, ...], fps: float, threshold: float) -> DBNDownBeatDecoder:
+  """Returns a decoder for the given settings, building the bar pointer models only on the first call."""
+  return DBNDownBeatDecoder(beats_per_bar=beats_per_bar, fps=fps, threshold=threshold)
@@ -1,19 +1,59 @@
 import numpy as np
 import torch
+import torch.nn.functional as F
+
+from typing import List
+from numpy.typing import NDArray
 from ..typings import AllInOneOutput, Segment
 from ..config import Config, HARMONIX_LABELS
-from .helpers import local_maxima, peak_picking, event_frames_to_time
+from .helpers import running_max, peak_picking, event_frames_to_time
 
 
 def postprocess_functional_structure(
   logits: AllInOneOutput,
   cfg: Config,
 ):
-  raw_prob_sections = torch.sigmoid(logits.logits_section[0])
-  raw_prob_functions = torch.softmax(logits.logits_function[0], dim=0)
-  prob_sections, _ = local_maxima(raw_prob_sections, filter_size=4 * cfg.min_hops_per_beat + 1)
-  prob_sections = prob_sections.cpu().numpy()
-  prob_functions = raw_prob_functions.cpu().numpy()
+  return postprocess_functional_structures([logits], cfg)[0]
+
+
+def postprocess_functional_structures(
+  logits_list: List[AllInOneOutput],
+  cfg: Config,
+) -> List[List[Segment]]:
+  """Finds the segments of several tracks at once. Each output must have a batch size of 1."""
+  lengths = np.array([logits.logits_section.shape[-1] for logits in logits_list])
+  max_T = lengths.max()
+  logits_section = torch.cat([
+    F.pad(logits.logits_section[:1], (0, max_T - logits.logits_section.shape[-1]))
+    for logits in logits_list
+  ])
+  logits_function = torch.cat([
+    F.pad(logits.logits_function[:1], (0, max_T - logits.logits_function.shape[-1]))
+    for logits in logits_list
+  ])
+  prob_sections = torch.sigmoid(logits_section).cpu().numpy()
+  prob_functions = torch.softmax(logits_function, dim=1).cpu().numpy()
+  return find_segments(prob_sections, prob_functions, lengths, cfg)
+
+
+def find_segments(
+  prob_sections: NDArray,
+  prob_functions: NDArray,
+  lengths: NDArray,
+  cfg: Config,
+) -> List[List[Segment]]:
+  """
+  Finds the segments of a batch of tracks from their boundary probabilities with shape (batch, frame) and
+  label probabilities with shape (batch, label, frame), zero-padded to the longest of ``lengths``.
+  """
+  batch_size, max_T = prob_sections.shape
+  valid = np.arange(max_T) < lengths[:, None]
+
+  # Keep only the maxima within two beats at the fastest tempo.
+  half_size = 2 * cfg.min_hops_per_beat
+  prob_sections = np.where(valid, prob_sections, -np.inf)
+  is_maximum = valid & (prob_sections == running_max(prob_sections, half_size, half_size))
+  prob_sections = np.where(is_maximum, prob_sections, 0).astype(np.float32)
 
   boundary_candidates = peak_picking(
     boundary_activation=prob_sections,
@@ -22,26 +62,29 @@ def postprocess_functional_structure(
   )
   boundary = boundary_candidates > 0.0
 
-  duration = len(prob_sections) * cfg.hop_size / cfg.sample_rate
-  pred_boundary_times = event_frames_to_time(boundary, cfg)
-  if pred_boundary_times[0] != 0:
-    pred_boundary_times = np.insert(pred_boundary_times, 0, 0)
-  if pred_boundary_times[-1] != duration:
-    pred_boundary_times = np.append(pred_boundary_times, duration)
-  pred_boundaries = np.stack([pred_boundary_times[:-1], pred_boundary_times[1:]]).T
-
-  pred_boundary_indices = np.flatnonzero(boundary)
-  pred_boundary_indices = pred_boundary_indices[pred_boundary_indices > 0]
-  prob_segment_function = np.split(prob_functions, pred_boundary_indices, axis=1)
-  pred_labels = [p.mean(axis=1).argmax().item() for p in prob_segment_function]
+  # Every track starts a segment at its first frame, and the segments of all tracks are laid out one after
+  # another, so that the label probabilities of all segments are summed in one pass.
+  starts = boundary.copy()
+  starts[:, 0] = True
+  starts = starts[valid]
+  segment_starts = np.flatnonzero(starts)
+  segment_lengths = np.diff(np.append(segment_starts, len(starts)))
+  prob_functions = prob_functions.transpose(1, 0, 2)[:, valid]
+  prob_segment_functions = np.add.reduceat(prob_functions, segment_starts, axis=1, dtype=np.float64)
+  pred_labels = (prob_segment_functions / segment_lengths).argmax(axis=0)
+  num_segments = boundary[:, 1:].sum(axis=1) + 1
+  pred_labels = np.split(pred_labels, np.cumsum(num_segments)[:-1])
 
   segments = []
-  for (start, end), label in zip(pred_boundaries, pred_labels):
-    segment = Segment(
-      start=start,
-      end=end,
-      label=HARMONIX_LABELS[label],
-    )
-    segments.append(segment)
+  for T, pred_boundary_times, track_labels in zip(lengths, event_frames_to_time(boundary, cfg), pred_labels):
+    duration = T * cfg.hop_size / cfg.sample_rate
+    if len(pred_boundary_times) == 0 or pred_boundary_times[0] != 0:
+      pred_boundary_times = np.insert(pred_boundary_times, 0, 0)
+    if pred_boundary_times[-1] != duration:
+      pred_boundary_times = np.append(pred_boundary_times, duration)
+    segments.append([
+      Segment(start=start, end=end, label=HARMONIX_LABELS[label])
+      for start, end, label in zip(pred_boundary_times[:-1], pred_boundary_times[1:], track_labels)
+    ])
 
   return segments
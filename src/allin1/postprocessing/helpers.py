@@ -5,7 +5,6 @@ import librosa
 from typing import Union
 from scipy.signal import argrelextrema
 from scipy.interpolate import interp1d
-from numpy.lib.stride_tricks import sliding_window_view
 from numpy.typing import NDArray
 from ..config import Config
 
@@ -172,28 +171,46 @@ def estimate_tempo_from_beats(pred_beat_times):
 
 
 def peak_picking(boundary_activation, window_past=12, window_future=6):
-  # Find local maxima using a sliding window
+  """
+  Returns the strength of the peaks of ``boundary_activation`` with shape (..., frame), and zero elsewhere.
+  A peak is the maximum of the ``window_past`` frames before and the ``window_future`` frames after it,
+  and its strength is its value minus the average of the means of these frames, with zeros past both ends.
+  """
   window_size = window_past + window_future
   assert window_size % 2 == 0, 'window_past + window_future must be even'
-  window_size += 1
-
-  # Pad boundary_activation
-  boundary_activation_padded = np.pad(boundary_activation, (window_past, window_future), mode='constant')
-  max_filter = sliding_window_view(boundary_activation_padded, window_size)
-  local_maxima = (boundary_activation == np.max(max_filter, axis=-1)) & (boundary_activation > 0)
-
-  # Compute strength values by subtracting the mean of the past and future windows
-  past_window_filter = sliding_window_view(boundary_activation_padded[:-(window_future + 1)], window_past)
-  future_window_filter = sliding_window_view(boundary_activation_padded[window_past + 1:], window_future)
-  past_mean = np.mean(past_window_filter, axis=-1)
-  future_mean = np.mean(future_window_filter, axis=-1)
+
+  local_maxima = (boundary_activation == running_max(boundary_activation, window_past, window_future, fill=0.))
+  local_maxima &= boundary_activation > 0
+
+  past_mean = running_mean(boundary_activation, -window_past, 0)
+  future_mean = running_mean(boundary_activation, 1, window_future + 1)
   strength_values = boundary_activation - ((past_mean + future_mean) / 2)
 
-  # Get boundary candidates and their corresponding strength values
-  boundary_candidates = np.flatnonzero(local_maxima)
-  strength_values = strength_values[boundary_candidates]
+  return np.where(local_maxima, strength_values, 0).astype(boundary_activation.dtype)
 
-  strength_activations = np.zeros_like(boundary_activation)
-  strength_activations[boundary_candidates] = strength_values
 
-  return strength_activations
+def running_max(arr: NDArray, before: int, after: int, fill=-np.inf) -> NDArray:
+  """
+  Returns the maximum of ``arr[..., t - before:t + after + 1]`` for every frame t, with ``arr`` padded with
+  ``fill`` on both sides. Uses the van Herk/Gil-Werman algorithm: the padded array is cut into blocks of the
+  window size, and every window is the union of a suffix of one block and a prefix of the next, so the cost
+  does not depend on the window size.
+  """
+  size = before + after + 1
+  T = arr.shape[-1]
+  num_blocks = -(-(T + size - 1) // size)
+  padded = np.full(arr.shape[:-1] + (num_blocks * size,), fill, dtype=arr.dtype)
+  padded[..., before:before + T] = arr
+  blocks = padded.reshape(arr.shape[:-1] + (num_blocks, size))
+  prefix_max = np.maximum.accumulate(blocks, axis=-1).reshape(padded.shape)
+  suffix_max = np.maximum.accumulate(blocks[..., ::-1], axis=-1)[..., ::-1].reshape(padded.shape)
+  return np.maximum(suffix_max[..., :T], prefix_max[..., size - 1:size - 1 + T])
+
+
+def running_mean(arr: NDArray, start: int, stop: int) -> NDArray:
+  """Returns the mean of ``arr[..., t + start:t + stop]`` for every frame t, with zeros past both ends."""
+  T = arr.shape[-1]
+  cumsum = np.zeros(arr.shape[:-1] + (T + 1,), dtype=np.float64)
+  np.cumsum(arr, axis=-1, out=cumsum[..., 1:])
+  t = np.arange(T)
+  return (cumsum[..., np.clip(t + stop, 0, T)] - cumsum[..., np.clip(t + start, 0, T)]) / (stop - start)
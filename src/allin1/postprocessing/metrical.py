@@ -1,6 +1,8 @@
+import numpy as np
 import torch
 
-from madmom.features.downbeats import DBNDownBeatTrackingProcessor
+from typing import List
+from .dbn import get_downbeat_decoder
 from ..typings import AllInOneOutput
 from ..config import Config
 
@@ -9,12 +11,20 @@ def postprocess_metrical_structure(
   logits: AllInOneOutput,
   cfg: Config,
 ):
-  postprocessor_downbeat = DBNDownBeatTrackingProcessor(
-    beats_per_bar=[3, 4],
-    threshold=cfg.best_threshold_downbeat,
-    fps=cfg.fps,
-  )
+  return postprocess_metrical_structures([logits], cfg)[0]
 
+
+def postprocess_metrical_structures(
+  logits_list: List[AllInOneOutput],
+  cfg: Config,
+):
+  """Decodes the beats and downbeats of several tracks at once. Each output must have a batch size of 1."""
+  decoder = get_downbeat_decoder((3, 4), cfg.fps, cfg.best_threshold_downbeat)
+  activations = [compute_downbeat_activations(logits) for logits in logits_list]
+  return [format_metrical_structure(pred) for pred in decoder.decode(activations)]
+
+
+def compute_downbeat_activations(logits: AllInOneOutput) -> np.ndarray:
   raw_prob_beats = torch.sigmoid(logits.logits_beat[0])
   raw_prob_downbeats = torch.sigmoid(logits.logits_downbeat[0])
 
@@ -33,14 +43,10 @@ def postprocess_metrical_structure(
   activations_combined /= activations_combined.sum(dim=-1, keepdim=True)
   activations_combined = activations_combined.cpu().numpy()
 
-  print(f"Activations combined shape: {activations_combined.shape}, dtype: {activations_combined.dtype}")
-  print(f"Activations combined (first 5 rows):\n{activations_combined[:5]}")
-
-  pred_downbeat_times = postprocessor_downbeat(activations_combined[:, :2])
+  return activations_combined[:, :2]
 
-  print(f"Predicted downbeat times shape: {pred_downbeat_times.shape}")
-  print(f"Predicted downbeat times (first 5 rows):\n{pred_downbeat_times[:5]}")
 
+def format_metrical_structure(pred_downbeat_times: np.ndarray):
   beats = pred_downbeat_times[:, 0]
   beat_positions = pred_downbeat_times[:, 1]
   downbeats = pred_downbeat_times[beat_positions == 1., 0]
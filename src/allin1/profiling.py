@@ -0,0 +1,109 @@
+import json
+import sys
+import threading
+import time
+import torch
+
+from contextlib import contextmanager, nullcontext
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Sequence
+from .typings import PathLike
+from .utils import mkpath
+
+try:
+  import resource
+except ImportError:  # Not available on Windows.
+  resource = None
+
+STAGES = ['demix', 'spectrogram', 'inference', 'metrical', 'functional', 'save']
+
+
+@dataclass
+class StageMetrics:
+  """
+  Resource usage of one stage of the analysis, where ``stage`` is one of ``STAGES``.
+
+  Stages that process several tracks at once (e.g. batched inference) are measured once for all of them,
+  so ``paths`` may hold more than one track. ``cpu_time`` is the CPU time of the whole process, which
+  includes the other stages running at the same time in the pipelined mode. ``peak_rss`` is the peak
+  resident set size of the process at the end of the stage, and ``peak_rss_increase`` how much the stage
+  raised it, both in bytes (None where unsupported).
+  """
+  stage: str
+  paths: List[str]
+  start_time: float
+  wall_time: float
+  cpu_time: float
+  peak_rss: Optional[int]
+  peak_rss_increase: Optional[int]
+
+
+Callback = Callable[[StageMetrics], None]
+
+
+class Profiler:
+  """Measures the stages of the analysis and passes the ``StageMetrics`` of each stage to the callbacks."""
+
+  def __init__(self, callbacks: Iterable[Callback] = ()):
+    self.callbacks = list(callbacks)
+    self._lock = threading.Lock()
+
+  @contextmanager
+  def stage(self, name: str, paths: Sequence[PathLike]):
+    start_time = time.time()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    start_rss = peak_rss()
+    yield
+    # CUDA kernels run asynchronously, so they are waited for to attribute their time to this stage.
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+      torch.cuda.synchronize()
+    end_rss = peak_rss()
+    self.emit(StageMetrics(
+      stage=name,
+      paths=[str(path) for path in paths],
+      start_time=start_time,
+      wall_time=time.perf_counter() - start_wall,
+      cpu_time=time.process_time() - start_cpu,
+      peak_rss=end_rss,
+      peak_rss_increase=None if end_rss is None else end_rss - start_rss,
+    ))
+
+  def emit(self, metrics: StageMetrics):
+    with self._lock:
+      for callback in self.callbacks:
+        callback(metrics)
+
+
+def measure(profiler: Optional[Profiler], name: str, paths: Sequence[PathLike]):
+  """Returns a context that measures a stage with ``profiler``, or does nothing if it is None."""
+  if profiler is None:
+    return nullcontext()
+  return profiler.stage(name, paths)
+
+
+class JsonLinesWriter:
+  """Callback that appends every ``StageMetrics`` as one line of JSON to a file."""
+
+  def __init__(self, path: PathLike):
+    self.path = mkpath(path)
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+
+  def __call__(self, metrics: StageMetrics):
+    with open(self.path, 'a') as f:
+      f.write(json.dumps(asdict(metrics)) + '\n')
+
+
+def load_metrics(path: PathLike) -> List[StageMetrics]:
+  """Loads the metrics written by ``JsonLinesWriter``."""
+  lines = Path(path).read_text().splitlines()
+  return [StageMetrics(**json.loads(line)) for line in lines if line]
+
+
+def peak_rss() -> Optional[int]:
+  """Returns the peak resident set size of the process in bytes, or None if it cannot be measured."""
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS bytes.
+  return peak if sys.platform == 'darwin' else peak * 1024
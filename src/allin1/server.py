@@ -0,0 +1,496 @@
+"""HTTP server that keeps the separator and the model resident and analyzes tracks on request.
+
+Endpoints:
+
+- ``GET /health`` returns ``{"status": "ok", "model": ...}``.
+- ``POST /analyze`` with a JSON body ``{"path": ...}`` analyzes a file readable by the server and returns
+  the result as JSON, in the same format as the files written by ``analyze``. With ``{"paths": [...]}``,
+  the results are streamed as JSON lines in the order they complete. ``include_activations`` and
+  ``include_embeddings`` can be set in the body.
+- ``POST /analyze?filename=song.mp3`` with any other content type analyzes the audio file in the body.
+  ``activations=1`` and ``embeddings=1`` can be added to the query.
+
+The spectrograms of concurrent requests are analyzed together in micro-batches (see ``MicroBatcher``).
+"""
+
+import argparse
+import http.client
+import json
+import queue
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import numpy as np
+import torch
+
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlencode, urlparse
+from numpy.typing import NDArray
+from .helpers import run_batched_inference
+from .spectrogram import SpectrogramFrontend, extract_spectrogram_from_stems
+from .typings import AnalysisResult, PathLike, Segment
+from .utils import mkpath
+
+
+class MicroBatcher:
+  """
+  Collects items submitted from several threads into batches for ``fn``, which takes a list of items
+  and returns the list of their outputs. A batch is run as soon as it holds ``max_batch_size`` items,
+  or ``max_wait`` seconds after its first item arrived.
+  """
+
+  def __init__(self, fn: Callable[[List[Any]], List[Any]], max_batch_size: int = 8, max_wait: float = 0.05):
+    if max_batch_size < 1:
+      raise ValueError(f'max_batch_size must be a positive integer, got {max_batch_size}.')
+    self.fn = fn
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait
+    self._queue: queue.Queue = queue.Queue()
+    self._stop = threading.Event()
+    self._lock = threading.Lock()
+    self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+    self._thread.start()
+
+  def submit(self, item) -> Future:
+    future = Future()
+    with self._lock:
+      if self._stop.is_set():
+        raise RuntimeError('The batcher is closed.')
+      self._queue.put((item, future))
+    return future
+
+  def close(self):
+    """Waits for the running batch, and fails the futures of the items that are still queued."""
+    with self._lock:
+      self._stop.set()
+    self._thread.join()
+    while True:
+      try:
+        _, future = self._queue.get_nowait()
+      except queue.Empty:
+        break
+      future.set_exception(RuntimeError('The batcher was closed before the item was processed.'))
+
+  def _run(self):
+    while not self._stop.is_set():
+      try:
+        batch = [self._queue.get(timeout=0.1)]
+      except queue.Empty:
+        continue
+      deadline = time.monotonic() + self.max_wait
+      while len(batch) < self.max_batch_size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          break
+        try:
+          batch.append(self._queue.get(timeout=remaining))
+        except queue.Empty:
+          break
+
+      items, futures = zip(*batch)
+      try:
+        outputs = self.fn(list(items))
+      except BaseException as e:
+        for future in futures:
+          future.set_exception(e)
+      else:
+        for future, output in zip(futures, outputs):
+          future.set_result(output)
+
+
+class AnalysisService:
+  """Analyzes tracks with a resident separator and model, running the model on micro-batches of tracks."""
+
+  def __init__(
+    self,
+    model: torch.nn.Module,
+    separator,
+    device: str,
+    frontend: Optional[SpectrogramFrontend] = None,
+    max_batch_size: int = 8,
+    max_wait: float = 0.05,
+    chunk_duration: Optional[float] = None,
+    demix_workers: int = 1,
+  ):
+    self.model = model
+    self.separator = separator
+    self.device = device
+    self.frontend = frontend or SpectrogramFrontend()
+    self.chunk_size = None if chunk_duration is None else int(chunk_duration * model.cfg.fps)
+    # Separation is the most memory-hungry stage, so only a few tracks are separated at a time.
+    self._prepare_pool = ThreadPoolExecutor(demix_workers, thread_name_prefix='demix')
+    self._closed = False
+    self.batcher = MicroBatcher(self._analyze_batch, max_batch_size, max_wait)
+
+  def submit(
+    self,
+    path: Path,
+    include_activations: bool = False,
+    include_embeddings: bool = False,
+  ) -> Future:
+    """
+    Returns the future of the result of a track right away. The track is separated and its spectrogram is
+    extracted by one of ``demix_workers`` threads, then it is queued for the model.
+    """
+    if not path.is_file():
+      raise FileNotFoundError(f'No such file: {path}')
+    future = Future()
+
+    def prepare():
+      try:
+        if self._closed:
+          raise RuntimeError('The service is closed.')
+        stems = self.separator.separate(path, clip='rescale')
+        spec = extract_spectrogram_from_stems(stems, self.frontend, self.separator.samplerate)
+        self.batcher.submit((path, spec, include_activations, include_embeddings)).add_done_callback(
+          lambda batched: _copy_future(batched, future)
+        )
+      except BaseException as e:
+        future.set_exception(e)
+
+    self._prepare_pool.submit(prepare)
+    return future
+
+  def analyze(self, path: Path, include_activations: bool = False, include_embeddings: bool = False):
+    return self.submit(path, include_activations, include_embeddings).result()
+
+  def close(self):
+    # Tracks waiting for separation fail right away, and the ones already queued for the model are analyzed.
+    self._closed = True
+    self._prepare_pool.shutdown()
+    self.batcher.close()
+
+  @torch.no_grad()
+  def _analyze_batch(self, jobs: List[Tuple[Path, NDArray, bool, bool]]) -> List[AnalysisResult]:
+    paths, specs, activations, embeddings = zip(*jobs)
+    # Padded tracks are masked, so that a result does not depend on the other requests.
+    results = run_batched_inference(
+      paths=list(paths),
+      specs=list(specs),
+      model=self.model,
+      device=self.device,
+      include_activations=any(activations),
+      include_embeddings=any(embeddings),
+      batch_size=len(jobs),
+      chunk_size=self.chunk_size,
+    )
+    for result, include_activations, include_embeddings in zip(results, activations, embeddings):
+      if not include_activations:
+        result.activations = None
+      if not include_embeddings:
+        result.embeddings = None
+    return results
+
+
+def _copy_future(source: Future, target: Future):
+  if source.exception() is not None:
+    target.set_exception(source.exception())
+  else:
+    target.set_result(source.result())
+
+
+def result_to_dict(result: AnalysisResult) -> Dict[str, Any]:
+  """Converts a result into JSON-serializable values, with the activations and embeddings as nested lists."""
+  data = asdict(result)
+  data['path'] = str(data['path'])
+  if data['activations'] is None:
+    del data['activations']
+  else:
+    data['activations'] = {key: value.tolist() for key, value in data['activations'].items()}
+  if data['embeddings'] is None:
+    del data['embeddings']
+  else:
+    data['embeddings'] = data['embeddings'].tolist()
+  return data
+
+
+def result_from_dict(data: Dict[str, Any]) -> AnalysisResult:
+  """Inverse of ``result_to_dict``."""
+  activations = data.get('activations')
+  embeddings = data.get('embeddings')
+  return AnalysisResult(
+    path=Path(data['path']),
+    bpm=data['bpm'],
+    beats=data['beats'],
+    downbeats=data['downbeats'],
+    beat_positions=data['beat_positions'],
+    segments=[Segment(**segment) for segment in data['segments']],
+    activations=None if activations is None else {
+      key: np.asarray(value, dtype=np.float32) for key, value in activations.items()
+    },
+    embeddings=None if embeddings is None else np.asarray(embeddings, dtype=np.float32),
+  )
+
+
+class AnalysisRequestHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  server: Union['AnalysisHTTPServer', 'AnalysisUnixServer']
+
+  def do_GET(self):
+    if urlparse(self.path).path != '/health':
+      return self.send_json(404, {'error': f'Unknown endpoint: {self.path}'})
+    self.send_json(200, {'status': 'ok', 'model': self.server.model_name})
+
+  def do_POST(self):
+    url = urlparse(self.path)
+    if url.path != '/analyze':
+      return self.send_json(404, {'error': f'Unknown endpoint: {self.path}'})
+
+    try:
+      length = int(self.headers.get('Content-Length', 0))
+      body = self.rfile.read(length)
+      if self.headers.get_content_type() == 'application/json':
+        request = json.loads(body or b'{}')
+        if 'paths' in request:
+          return self.stream_results(
+            [mkpath(path) for path in request['paths']],
+            bool(request.get('include_activations')),
+            bool(request.get('include_embeddings')),
+          )
+        if 'path' not in request:
+          return self.send_json(400, {'error': 'Either "path" or "paths" must be given.'})
+        path = mkpath(request['path'])
+        result = self.server.service.analyze(
+          path, bool(request.get('include_activations')), bool(request.get('include_embeddings')),
+        )
+      else:
+        query = parse_qs(url.query)
+        filename = Path(query.get('filename', ['upload.wav'])[0]).name
+        result = self.analyze_upload(
+          body, filename, query.get('activations') == ['1'], query.get('embeddings') == ['1'],
+        )
+    except (ValueError, FileNotFoundError) as e:
+      return self.send_json(400, {'error': str(e)})
+    except Exception as e:
+      return self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+    self.send_json(200, result_to_dict(result))
+
+  def analyze_upload(self, data: bytes, filename: str, include_activations: bool, include_embeddings: bool):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = Path(tmp_dir) / filename
+      path.write_bytes(data)
+      result = self.server.service.analyze(path, include_activations, include_embeddings)
+    result.path = Path(filename)
+    return result
+
+  def stream_results(self, paths: List[Path], include_activations: bool, include_embeddings: bool):
+    """
+    Sends one JSON line per track as soon as it is analyzed, using chunked transfer encoding.
+    All tracks are submitted at once, so that they are separated in parallel and batched together.
+    """
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/x-ndjson')
+    self.send_header('Transfer-Encoding', 'chunked')
+    self.end_headers()
+
+    futures = {}
+    for path in paths:
+      try:
+        futures[self.server.service.submit(path, include_activations, include_embeddings)] = path
+      except Exception as e:
+        self.write_chunk({'path': str(path), 'error': f'{type(e).__name__}: {e}'})
+    for future in as_completed(futures):
+      try:
+        self.write_chunk(result_to_dict(future.result()))
+      except Exception as e:
+        self.write_chunk({'path': str(futures[future]), 'error': f'{type(e).__name__}: {e}'})
+    self.wfile.write(b'0\r\n\r\n')
+
+  def write_chunk(self, data: Dict[str, Any]):
+    line = (json.dumps(data) + '\n').encode()
+    self.wfile.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+    self.wfile.flush()
+
+  def send_json(self, status: int, data: Dict[str, Any]):
+    body = json.dumps(data).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def address_string(self) -> str:
+    # Clients of a Unix socket have no address.
+    return self.client_address[0] if self.client_address else 'unix'
+
+
+class AnalysisHTTPServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address: Tuple[str, int], service: AnalysisService, model_name: str = ''):
+    super().__init__(address, AnalysisRequestHandler)
+    self.service = service
+    self.model_name = model_name
+
+
+class AnalysisUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, path: PathLike, service: AnalysisService, model_name: str = ''):
+    super().__init__(str(path), AnalysisRequestHandler)
+    self.service = service
+    self.model_name = model_name
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+  """``HTTPConnection`` to a server listening on a Unix socket."""
+
+  def __init__(self, path: PathLike, timeout: Optional[float] = None):
+    super().__init__('localhost', timeout=timeout)
+    self.socket_path = str(path)
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if self.timeout is not None:
+      self.sock.settimeout(self.timeout)
+    self.sock.connect(self.socket_path)
+
+
+class AnalysisClient:
+  """Client of the analysis server at ``address``, either ``(host, port)`` or the path of a Unix socket."""
+
+  def __init__(self, address: Union[Tuple[str, int], PathLike], timeout: Optional[float] = None):
+    self.address = address
+    self.timeout = timeout
+
+  def connect(self) -> http.client.HTTPConnection:
+    if isinstance(self.address, tuple):
+      return http.client.HTTPConnection(*self.address, timeout=self.timeout)
+    return UnixHTTPConnection(self.address, timeout=self.timeout)
+
+  def health(self) -> Dict[str, Any]:
+    return self._request('GET', '/health')
+
+  def analyze(
+    self,
+    path: PathLike,
+    include_activations: bool = False,
+    include_embeddings: bool = False,
+  ) -> AnalysisResult:
+    """Analyzes a file readable by the server."""
+    body = dict(path=str(path), include_activations=include_activations, include_embeddings=include_embeddings)
+    return result_from_dict(self._request('POST', '/analyze', body))
+
+  def analyze_many(
+    self,
+    paths: List[PathLike],
+    include_activations: bool = False,
+    include_embeddings: bool = False,
+  ) -> Iterator[AnalysisResult]:
+    """Yields the results of files readable by the server as they complete."""
+    body = dict(
+      paths=[str(path) for path in paths],
+      include_activations=include_activations,
+      include_embeddings=include_embeddings,
+    )
+    connection = self.connect()
+    try:
+      connection.request('POST', '/analyze', json.dumps(body), {'Content-Type': 'application/json'})
+      response = connection.getresponse()
+      if response.status != 200:
+        raise RuntimeError(json.loads(response.read())['error'])
+      for line in response:
+        data = json.loads(line)
+        if 'error' in data:
+          raise RuntimeError(f'Failed to analyze {data["path"]}: {data["error"]}')
+        yield result_from_dict(data)
+    finally:
+      connection.close()
+
+  def analyze_audio(
+    self,
+    data: bytes,
+    filename: str,
+    include_activations: bool = False,
+    include_embeddings: bool = False,
+  ) -> AnalysisResult:
+    """Uploads and analyzes the content of an audio file. ``filename`` tells its format, e.g. 'song.mp3'."""
+    query = urlencode(dict(
+      filename=filename, activations=int(include_activations), embeddings=int(include_embeddings),
+    ))
+    return result_from_dict(self._request('POST', f'/analyze?{query}', data))
+
+  def _request(self, method: str, url: str, body: Union[None, bytes, Dict[str, Any]] = None) -> Dict[str, Any]:
+    headers = {}
+    if isinstance(body, dict):
+      body = json.dumps(body)
+      headers['Content-Type'] = 'application/json'
+    elif body is not None:
+      headers['Content-Type'] = 'application/octet-stream'
+    connection = self.connect()
+    try:
+      connection.request(method, url, body, headers)
+      response = connection.getresponse()
+      data = json.loads(response.read())
+    finally:
+      connection.close()
+    if response.status != 200:
+      raise RuntimeError(data['error'])
+    return data
+
+
+def make_parser():
+  parser = argparse.ArgumentParser(prog='allin1 serve', description=__doc__.splitlines()[0])
+  parser.add_argument('--host', type=str, default='127.0.0.1',
+                      help='Host to listen on (default: 127.0.0.1)')
+  parser.add_argument('--port', type=int, default=8000,
+                      help='Port to listen on (default: 8000)')
+  parser.add_argument('--socket', type=Path, default=None,
+                      help='Listen on this Unix socket instead of a TCP port (default: none)')
+  parser.add_argument('-m', '--model', type=str, default='harmonix-all',
+                      help='Name of the pretrained model to use (default: harmonix-all)')
+  parser.add_argument('-d', '--device', type=str, default=None,
+                      help='Device to use (default: cuda if available else cpu)')
+  parser.add_argument('-b', '--max-batch-size', type=int, default=8,
+                      help='Maximum number of tracks per forward pass (default: 8)')
+  parser.add_argument('--max-wait', type=float, default=0.05,
+                      help='Seconds to wait for more tracks before running a batch that is not full (default: 0.05)')
+  parser.add_argument('--chunk-duration', type=float, default=None,
+                      help='Process tracks longer than this many seconds in overlapping windows to bound the memory '
+                           'usage (default: process each track at once)')
+  parser.add_argument('--demix-workers', type=int, default=1,
+                      help='Number of tracks separated at a time (default: 1)')
+  return parser
+
+
+def main(argv: Optional[List[str]] = None):
+  args = make_parser().parse_args(argv)
+
+  from .demix import get_separator
+  from .models import load_pretrained_model
+
+  device = args.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+  print(f'=> Loading {args.model} on {device}...')
+  service = AnalysisService(
+    model=load_pretrained_model(args.model, device=device),
+    separator=get_separator('htdemucs', 'cpu'),
+    device=device,
+    max_batch_size=args.max_batch_size,
+    max_wait=args.max_wait,
+    chunk_duration=args.chunk_duration,
+    demix_workers=args.demix_workers,
+  )
+
+  if args.socket is not None:
+    args.socket.unlink(missing_ok=True)
+    server = AnalysisUnixServer(args.socket, service, args.model)
+    print(f'=> Listening on {args.socket}')
+  else:
+    server = AnalysisHTTPServer((args.host, args.port), service, args.model)
+    print(f'=> Listening on http://{args.host}:{server.server_port}')
+
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    service.close()
+    if args.socket is not None:
+      args.socket.unlink(missing_ok=True)
@@ -1,15 +1,136 @@
 import numpy as np
+import torch
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Mapping, Optional, Tuple, Union
+from numpy.typing import NDArray
 from tqdm import tqdm
 from multiprocessing import Pool
+from madmom.audio.filters import LogarithmicFilterbank
 from madmom.audio.signal import FramedSignalProcessor, Signal
-from madmom.audio.stft import ShortTimeFourierTransformProcessor
+from madmom.audio.stft import ShortTimeFourierTransformProcessor, fft_frequencies
 from madmom.processors import SequentialProcessor
 from madmom.audio.spectrogram import FilteredSpectrogramProcessor, LogarithmicSpectrogramProcessor
 
+STEMS = ['bass', 'drums', 'other', 'vocals']
 
-def extract_spectrograms(demix_paths: List[Path], spec_dir: Path, multiprocess: bool = True, overwrite: bool = False):
+
+class SpectrogramFrontend:
+  """
+  Computes the same log-filtered spectrogram as the madmom chain of ``make_processor()``, but for all stems
+  (or tracks) at once, with one batched STFT and one matrix multiplication with the filterbank.
+  Unlike the madmom processors, it keeps no state between calls, so a single instance can be shared by threads.
+
+  Inputs are int16 waveforms, or float waveforms which are quantized to int16 first, as Demucs does
+  when writing the stems. The STFT runs over blocks of ``block_frames`` frames to bound the memory usage.
+  """
+
+  def __init__(
+    self,
+    sample_rate: int = 44100,
+    frame_size: int = 2048,
+    fps: int = 100,
+    num_bands: int = 12,
+    fmin: float = 30,
+    fmax: float = 17000,
+    block_frames: int = 6000,
+    device: Union[str, torch.device] = 'cpu',
+  ):
+    if sample_rate % fps:
+      raise ValueError(f'The sample rate ({sample_rate}) must be a multiple of fps ({fps}).')
+    self.sample_rate = sample_rate
+    self.frame_size = frame_size
+    self.num_bands = num_bands
+    self.fmin = fmin
+    self.fmax = fmax
+    self.hop_size = sample_rate // fps
+    self.block_frames = block_frames
+    self.device = torch.device(device)
+
+    filterbank = LogarithmicFilterbank(
+      fft_frequencies(frame_size // 2, sample_rate),
+      num_bands=num_bands,
+      fmin=fmin,
+      fmax=fmax,
+      norm_filters=True,
+    )
+    # Only the FFT bins covered by at least one filter are kept, e.g. the bins above fmax are skipped.
+    used_bins = np.flatnonzero(np.asarray(filterbank).any(axis=1))
+    self.bins = slice(int(used_bins[0]), int(used_bins[-1]) + 1)
+    self.filterbank = torch.from_numpy(np.asarray(filterbank)[self.bins]).to(self.device)
+
+    # madmom scales the window instead of the signal for integer signals. np.hanning is symmetric.
+    # madmom computes the STFT in double precision, but single precision stays within 1e-6 of its output.
+    window = torch.hann_window(frame_size, periodic=False, dtype=torch.float64) / np.iinfo(np.int16).max
+    self.window = window.to(self.device, torch.float32)
+
+  def num_frames(self, num_samples: int) -> int:
+    return -(-num_samples // self.hop_size)
+
+  def __call__(self, wav: Union[NDArray, torch.Tensor]) -> NDArray:
+    """Returns the spectrograms of waveforms with shape (..., samples) as an array of shape (..., frames, bins)."""
+    wav = _to_int16(wav)
+    batch_shape, num_samples = wav.shape[:-1], wav.shape[-1]
+    wav = torch.from_numpy(wav.reshape(-1, num_samples)).to(self.device, torch.float32)
+
+    # Frames are centered on multiples of the hop size and zero-padded at both ends, like FramedSignal.
+    pad = self.frame_size // 2
+    wav = torch.nn.functional.pad(wav, (pad, pad))
+    num_frames = self.num_frames(num_samples)
+    specs = []
+    for start in range(0, num_frames, self.block_frames):
+      stop = min(start + self.block_frames, num_frames)
+      block = wav[:, start * self.hop_size:(stop - 1) * self.hop_size + self.frame_size]
+      stft = torch.stft(
+        block,
+        n_fft=self.frame_size,
+        hop_length=self.hop_size,
+        window=self.window,
+        center=False,
+        return_complex=True,
+      )
+      magnitudes = stft[:, self.bins].abs().transpose(1, 2)
+      specs.append(torch.log10(torch.matmul(magnitudes, self.filterbank) + 1))
+
+    spec = torch.cat(specs, dim=1).cpu().numpy()
+    return spec.reshape(*batch_shape, num_frames, spec.shape[-1])
+
+  def batch(self, wavs: List[Union[NDArray, torch.Tensor]]) -> List[NDArray]:
+    """
+    Computes the spectrograms of waveforms of different lengths in one pass, by zero-padding them
+    to the longest one. Since frames are zero-padded past the end of the signal anyway,
+    the spectrograms are the same as computing them one by one.
+    """
+    wavs = [_to_int16(wav) for wav in wavs]
+    max_samples = max(wav.shape[-1] for wav in wavs)
+    padded = np.stack([
+      np.pad(wav, [(0, 0)] * (wav.ndim - 1) + [(0, max_samples - wav.shape[-1])])
+      for wav in wavs
+    ])
+    specs = self(padded)
+    return [spec[..., :self.num_frames(wav.shape[-1]), :] for spec, wav in zip(specs, wavs)]
+
+
+def _to_int16(wav: Union[NDArray, torch.Tensor]) -> NDArray:
+  if torch.is_tensor(wav):
+    wav = wav.cpu().numpy()
+  if np.issubdtype(wav.dtype, np.floating):
+    # Quantize the same way Demucs writes 16-bit WAVs, so that the spectrograms are identical to
+    # the ones extracted from the files (and to the ones the models were trained on).
+    wav = (np.clip(wav, -1, 1) * (2 ** 15 - 1)).astype(np.int16)
+  return wav
+
+
+def extract_spectrograms(
+  demix_paths: List[Path],
+  spec_dir: Path,
+  multiprocess: bool = True,
+  overwrite: bool = False,
+  processor: Optional[Union[SpectrogramFrontend, SequentialProcessor]] = None,
+):
+  """
+  Extracts the spectrograms of demixed tracks, with a ``SpectrogramFrontend`` by default.
+  The frontend is vectorized and runs in-process; ``multiprocess`` only applies to madmom processors.
+  """
   todos = []
   spec_paths = []
   for src in demix_paths:
@@ -23,23 +144,11 @@ def extract_spectrograms(demix_paths: List[Path], spec_dir: Path, multiprocess:
   print(f'=> Found {existing} spectrograms already extracted, {len(todos)} to extract.')
 
   if todos:
-    # Define a pre-processing chain, which is copied from madmom.
-    frames = FramedSignalProcessor(
-      frame_size=2048,
-      fps=int(44100 / 441)
-    )
-    stft = ShortTimeFourierTransformProcessor()  # caching FFT window
-    filt = FilteredSpectrogramProcessor(
-      num_bands=12,
-      fmin=30,
-      fmax=17000,
-      norm_filters=True
-    )
-    spec = LogarithmicSpectrogramProcessor(mul=1, add=1)
-    processor = SequentialProcessor([frames, stft, filt, spec])
+    if processor is None:
+      processor = SpectrogramFrontend()
 
     # Process all tracks using multiprocessing.
-    if multiprocess:
+    if multiprocess and not isinstance(processor, SpectrogramFrontend):
       pool = Pool()
       map_fn = pool.imap
     else:
@@ -60,7 +169,53 @@ def extract_spectrograms(demix_paths: List[Path], spec_dir: Path, multiprocess:
   return spec_paths
 
 
-def _extract_spectrogram(args: Tuple[Path, Path, SequentialProcessor]):
+def extract_spectrogram(
+  demix_path: Path,
+  spec_dir: Path,
+  processor: Union[SpectrogramFrontend, SequentialProcessor],
+  overwrite: bool = False,
+) -> Path:
+  """Extracts the spectrogram of a single demixed track, unless it already exists."""
+  spec_path = spec_dir / f'{demix_path.name}.npy'
+  if overwrite or not spec_path.is_file():
+    _extract_spectrogram((demix_path, spec_path, processor))
+  return spec_path
+
+
+def extract_spectrogram_from_stems(
+  stems: Mapping[str, Union[NDArray, torch.Tensor]],
+  processor: Union[SpectrogramFrontend, SequentialProcessor],
+  sample_rate: int = 44100,
+) -> NDArray:
+  """
+  Extracts the spectrogram from in-memory stems, e.g. the output of ``Separator.separate``.
+  Each stem is a waveform with shape (channels, samples) or (samples,).
+  """
+  # Down-mix to mono the same way madmom does when loading the WAV files.
+  wavs = [Signal(_to_int16(stems[stem]).T, sample_rate=sample_rate, num_channels=1) for stem in STEMS]
+  if isinstance(processor, SpectrogramFrontend):
+    return processor(np.stack(wavs))
+  return np.stack([processor(wav) for wav in wavs])  # instruments, frames, bins
+
+
+def make_processor() -> SequentialProcessor:
+  # Define a pre-processing chain, which is copied from madmom.
+  frames = FramedSignalProcessor(
+    frame_size=2048,
+    fps=int(44100 / 441)
+  )
+  stft = ShortTimeFourierTransformProcessor()  # caching FFT window
+  filt = FilteredSpectrogramProcessor(
+    num_bands=12,
+    fmin=30,
+    fmax=17000,
+    norm_filters=True
+  )
+  spec = LogarithmicSpectrogramProcessor(mul=1, add=1)
+  return SequentialProcessor([frames, stft, filt, spec])
+
+
+def _extract_spectrogram(args: Tuple[Path, Path, Union[SpectrogramFrontend, SequentialProcessor]]):
   src, dst, processor = args
 
   dst.parent.mkdir(parents=True, exist_ok=True)
@@ -70,6 +225,10 @@ def _extract_spectrogram(args: Tuple[Path, Path, SequentialProcessor]):
   sig_other = Signal(src / 'other.wav', num_channels=1)
   sig_vocals = Signal(src / 'vocals.wav', num_channels=1)
 
+  if isinstance(processor, SpectrogramFrontend):
+    np.save(str(dst), processor(np.stack([sig_bass, sig_drums, sig_other, sig_vocals])))
+    return
+
   spec_bass = processor(sig_bass)
   spec_drums = processor(sig_drums)
   spec_others = processor(sig_other)
@@ -0,0 +1,258 @@
+"""
+Columnar store of analysis results for large catalogues.
+
+A store is a directory of shards, each holding up to a few thousand tracks. Every column of a shard is one
+``.npy`` file with the values of all of its tracks concatenated, and ``index.json`` holds the paths of the tracks
+and their offsets into the columns. The columns are memory-mapped, so loading one track only reads its values,
+and catalogue-wide statistics can be computed on whole columns at once (see ``ResultStore.scan``).
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+import numpy as np
+
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple, Union
+from numpy.typing import NDArray
+from .typings import AnalysisResult, PathLike, Segment
+
+# Columns and their types on disk, keyed by the offsets that delimit the values of each track.
+# The activations and embeddings of all tracks are concatenated along their frames.
+COLUMNS = {
+  'tracks': {'bpm': np.float64},
+  'beats': {'beats': np.float64, 'beat_positions': np.int8},
+  'downbeats': {'downbeats': np.float64},
+  'segments': {'segment_start': np.float64, 'segment_end': np.float64, 'segment_label': np.uint16},
+  'frames': {
+    'activation_beat': np.float32,
+    'activation_downbeat': np.float32,
+    'activation_segment': np.float32,
+    'activation_label': np.float32,
+  },
+  'embedding_frames': {'embeddings': np.float32},
+}
+COLUMN_GROUPS = {column: group for group, columns in COLUMNS.items() for column in columns}
+
+# Number of tracks per shard written by ``ResultStoreWriter``.
+SHARD_SIZE = 1024
+
+
+class ResultShard:
+  """One shard of a ``ResultStore``, with its columns memory-mapped."""
+
+  def __init__(self, path: PathLike):
+    self.path = Path(path)
+    index = json.loads((self.path / 'index.json').read_text())
+    self.paths: List[str] = index['paths']
+    self.labels: List[str] = index['labels']
+    self.offsets = {group: np.asarray(offsets) for group, offsets in index['offsets'].items()}
+    self.offsets['tracks'] = np.arange(len(self.paths) + 1)
+    self._columns: Dict[str, NDArray] = {}
+
+  def __len__(self) -> int:
+    return len(self.paths)
+
+  def column(self, name: str) -> NDArray:
+    if name not in self._columns:
+      self._columns[name] = np.load(self.path / f'{name}.npy', mmap_mode='r')
+    return self._columns[name]
+
+  def values(self, name: str, i: int) -> NDArray:
+    offsets = self.offsets[COLUMN_GROUPS[name]]
+    return self.column(name)[offsets[i]:offsets[i + 1]]
+
+  def get(self, i: int, load_activations: bool = True, load_embeddings: bool = True) -> AnalysisResult:
+    bpm = self.column('bpm')[i]
+    labels = self.values('segment_label', i)
+    result = AnalysisResult(
+      path=Path(self.paths[i]),
+      bpm=None if np.isnan(bpm) else int(bpm),
+      beats=self.values('beats', i).tolist(),
+      downbeats=self.values('downbeats', i).tolist(),
+      beat_positions=self.values('beat_positions', i).astype(int).tolist(),
+      segments=[
+        Segment(start=start, end=end, label=self.labels[label])
+        for start, end, label in zip(self.values('segment_start', i), self.values('segment_end', i), labels)
+      ],
+    )
+    # The activations and embeddings are views of the memory-mapped columns, which are only read when used.
+    frames = self.offsets['frames']
+    if load_activations and frames[i + 1] > frames[i]:
+      result.activations = {key: self.values(f'activation_{key}', i) for key in ['beat', 'downbeat', 'segment']}
+      result.activations['label'] = self.values('activation_label', i).T
+    embedding_frames = self.offsets['embedding_frames']
+    if load_embeddings and embedding_frames[i + 1] > embedding_frames[i]:
+      result.embeddings = np.moveaxis(self.values('embeddings', i), 0, 1)
+    return result
+
+
+class ResultStore:
+  """
+  Reader of a directory of ``ResultShard``, written by ``ResultStoreWriter``.
+
+  Shards written after the store is opened are only seen after ``refresh``. If a track was stored several times,
+  ``get`` returns its last version, while ``scan`` and iteration return all of them.
+  """
+
+  def __init__(self, path: PathLike):
+    self.path = Path(path)
+    self.shards: List[ResultShard] = []
+    self._tracks: Dict[str, Tuple[int, int]] = {}
+    self.refresh()
+
+  def refresh(self):
+    """Opens the shards written since the store was opened."""
+    known = {shard.path.name for shard in self.shards}
+    # Shards are named after the time they were written, so they are sorted from the oldest to the newest.
+    for shard_path in sorted(self.path.glob('shard-*')):
+      if shard_path.name not in known:
+        shard = ResultShard(shard_path)
+        for i, path in enumerate(shard.paths):
+          self._tracks[path] = (len(self.shards), i)
+        self.shards.append(shard)
+
+  def __len__(self) -> int:
+    return len(self._tracks)
+
+  def __contains__(self, path: PathLike) -> bool:
+    return str(path) in self._tracks
+
+  @property
+  def paths(self) -> List[Path]:
+    return [Path(path) for path in self._tracks]
+
+  def get(self, path: PathLike, load_activations: bool = True, load_embeddings: bool = True) -> AnalysisResult:
+    if str(path) not in self._tracks:
+      raise KeyError(f'No result for {path} in {self.path}')
+    shard, i = self._tracks[str(path)]
+    return self.shards[shard].get(i, load_activations, load_embeddings)
+
+  def __iter__(self) -> Iterator[AnalysisResult]:
+    for shard in self.shards:
+      for i in range(len(shard)):
+        yield shard.get(i, load_activations=False, load_embeddings=False)
+
+  def scan(self, columns: List[str]) -> Dict[str, NDArray]:
+    """
+    Returns the given columns of all tracks, concatenated over the shards. For every group of the columns,
+    ``<group>_offsets`` delimits the values of each track, e.g. ``segment_start[offsets[i]:offsets[i + 1]]``
+    are the segments of the ``i``-th track, and ``<group>_track`` gives the track of every value.
+    ``path`` and ``segment_label`` are returned as strings.
+    """
+    unknown = set(columns) - set(COLUMN_GROUPS) - {'path'}
+    if unknown:
+      raise ValueError(f'Unknown columns: {sorted(unknown)} (expected some of {["path", *COLUMN_GROUPS]})')
+
+    scanned = {}
+    for name in columns:
+      if name == 'path':
+        scanned[name] = np.asarray([path for shard in self.shards for path in shard.paths], dtype=str)
+      elif name == 'segment_label':
+        scanned[name] = np.concatenate([np.asarray(shard.labels, dtype=str)[shard.column(name)]
+                                        for shard in self.shards] or [np.empty(0, dtype=str)])
+      else:
+        scanned[name] = np.concatenate([shard.column(name) for shard in self.shards]
+                                       or [np.empty(0, dtype=COLUMNS[COLUMN_GROUPS[name]][name])])
+
+    for group in {COLUMN_GROUPS[name] for name in columns if name != 'path'} - {'tracks'}:
+      counts = np.concatenate([np.diff(shard.offsets[group]) for shard in self.shards] or [np.empty(0, dtype=int)])
+      scanned[f'{group}_offsets'] = np.concatenate([[0], np.cumsum(counts)])
+      scanned[f'{group}_track'] = np.repeat(np.arange(len(counts)), counts)
+    return scanned
+
+  def writer(self, shard_size: int = SHARD_SIZE) -> 'ResultStoreWriter':
+    return ResultStoreWriter(self.path, shard_size)
+
+
+class ResultStoreWriter:
+  """
+  Appends results to the store in ``path``, writing a new shard every ``shard_size`` results and on ``flush``.
+  Shards are written to a temporary directory and renamed, so readers and other writers never see partial shards,
+  and several processes can append to the same store. Results that were not flushed are lost on a crash.
+  """
+
+  def __init__(self, path: PathLike, shard_size: int = SHARD_SIZE):
+    if shard_size < 1:
+      raise ValueError(f'shard_size must be a positive integer, got {shard_size}.')
+    self.path = Path(path)
+    self.shard_size = shard_size
+    self._pending: List[AnalysisResult] = []
+    self._lock = threading.Lock()
+
+  def add(self, results: Union[AnalysisResult, List[AnalysisResult]]):
+    if not isinstance(results, list):
+      results = [results]
+    with self._lock:
+      self._pending += results
+      while len(self._pending) >= self.shard_size:
+        write_shard(self.path, self._pending[:self.shard_size])
+        self._pending = self._pending[self.shard_size:]
+
+  def flush(self):
+    with self._lock:
+      if self._pending:
+        write_shard(self.path, self._pending)
+        self._pending = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.flush()
+
+
+def write_shard(path: PathLike, results: List[AnalysisResult]) -> Path:
+  """Writes results as a new shard of the store in ``path`` and returns the path of the shard."""
+  path = Path(path)
+  labels = sorted({segment.label for result in results for segment in result.segments})
+  label_codes = {label: code for code, label in enumerate(labels)}
+  embedding_shapes = {result.embeddings.shape[:1] + result.embeddings.shape[2:]
+                      for result in results if result.embeddings is not None}
+  if len(embedding_shapes) > 1:
+    raise ValueError(f'The embeddings of a shard must have the same shape but their frames, got {embedding_shapes}.')
+
+  columns = {name: [] for name in COLUMN_GROUPS}
+  counts = {group: [] for group in COLUMNS if group != 'tracks'}
+  for result in results:
+    columns['bpm'].append([np.nan if result.bpm is None else result.bpm])
+    columns['beats'].append(result.beats)
+    columns['beat_positions'].append(result.beat_positions)
+    counts['beats'].append(len(result.beats))
+    columns['downbeats'].append(result.downbeats)
+    counts['downbeats'].append(len(result.downbeats))
+    columns['segment_start'].append([segment.start for segment in result.segments])
+    columns['segment_end'].append([segment.end for segment in result.segments])
+    columns['segment_label'].append([label_codes[segment.label] for segment in result.segments])
+    counts['segments'].append(len(result.segments))
+
+    activations = result.activations or {}
+    for key in ['beat', 'downbeat', 'segment']:
+      columns[f'activation_{key}'].append(activations.get(key, []))
+    columns['activation_label'].append(activations['label'].T if activations else np.empty((0, 0)))
+    counts['frames'].append(len(activations['beat']) if activations else 0)
+    if result.embeddings is not None:
+      columns['embeddings'].append(np.moveaxis(result.embeddings, 1, 0))
+    counts['embedding_frames'].append(0 if result.embeddings is None else result.embeddings.shape[1])
+
+  # The shards of every writer are sorted by the time they were written.
+  shard_path = path / f'shard-{time.time_ns():020d}-{uuid.uuid4().hex[:8]}'
+  tmp_path = path / f'.tmp-{shard_path.name}'
+  tmp_path.mkdir(parents=True)
+  for name, values in columns.items():
+    dtype = COLUMNS[COLUMN_GROUPS[name]][name]
+    values = [np.asarray(v, dtype=dtype) for v in values if len(v)]
+    empty_shape = (0, 0) if name in ['activation_label', 'embeddings'] else (0,)
+    values = np.concatenate(values) if values else np.empty(empty_shape, dtype=dtype)
+    np.save(tmp_path / f'{name}.npy', values)
+
+  index = dict(
+    paths=[str(result.path) for result in results],
+    labels=labels,
+    offsets={group: np.concatenate([[0], np.cumsum(c)]).astype(int).tolist() for group, c in counts.items()},
+  )
+  (tmp_path / 'index.json').write_text(json.dumps(index))
+  os.rename(tmp_path, shard_path)
+  return shard_path
@@ -2,6 +2,11 @@ import numpy as np
 import torch
 from collections import defaultdict
 
+FRAME_KEYS = [
+  'true_beat', 'true_downbeat', 'true_section', 'true_function',
+  'widen_true_beat', 'widen_true_downbeat', 'widen_true_section',
+]
+
 
 def collate_fn(raw_batch):
   variable_length_batch = defaultdict(list)
@@ -9,34 +14,33 @@ def collate_fn(raw_batch):
     for key, value in list(row.items()):
       if isinstance(value, list):
         variable_length_batch[key].append(row.pop(key))
-  
+
+  # Items are padded with zeros to the longest spectrogram, and `mask` marks their actual frames.
+  # Padded targets are zero as well, and should be ignored using the mask.
   max_T = max(x['spec'].shape[1] for x in raw_batch)
+  spec = raw_batch[0]['spec']
+  specs = np.zeros((len(raw_batch), spec.shape[0], max_T, spec.shape[2]), dtype=spec.dtype)
+  masks = np.zeros((len(raw_batch), max_T))
   batch = []
-  for raw_data in raw_batch:
+  for i, raw_data in enumerate(raw_batch):
     data = {}
     for key, value in raw_data.items():
       if key in ['track_key', 'true_bpm', 'widen_true_bpm', 'true_bpm_int']:
         data[key] = value
-      elif key in [
-        'true_beat', 'true_downbeat', 'true_section', 'true_function',
-        'widen_true_beat', 'widen_true_downbeat', 'widen_true_section',
-      ]:
-        data[key] = value[:max_T]
+      elif key in FRAME_KEYS:
+        value = value[:max_T]
+        if len(value) < max_T:
+          value = np.pad(value, (0, max_T - len(value)), 'constant')
+        data[key] = value
       elif key in ['spec']:
-        T = raw_data[key].shape[1]
-        spec = raw_data[key]
-        if T < max_T:
-          spec = np.pad(spec, ((0, 0), (0, max_T - T), (0, 0)), 'constant')
-          mask = np.pad(np.ones(T), (0, max_T - T), 'constant')
-        else:
-          mask = np.ones(max_T)
-        data[key] = spec
-        data['mask'] = mask
+        T = value.shape[1]
+        specs[i, :, :T] = value
+        masks[i, :T] = 1
       else:
         raise ValueError(f'Unknown key: {key}')
     batch.append(data)
-  
+
   batch = torch.utils.data.default_collate(batch)
-  batch = {**batch, **variable_length_batch}
-  
+  batch = {**batch, 'spec': torch.from_numpy(specs), 'mask': torch.from_numpy(masks), **variable_length_batch}
+
   return batch
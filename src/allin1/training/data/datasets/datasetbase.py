@@ -1,11 +1,12 @@
 import numpy as np
 
 from abc import ABC, abstractmethod
-from typing import Literal, List, Union
+from functools import cached_property
+from typing import Literal, List, Optional, Union
 from numpy.typing import NDArray
 from torch.utils.data import Dataset
-from ..utils import widen_temporal_events
 from ..eventconverters import DatasetConverter
+from ..targets import TargetStore, compute_targets, time_to_frame
 from ....config import Config
 
 
@@ -24,9 +25,12 @@ class DatasetBase(Dataset, ABC):
     self.sample_rate = cfg.sample_rate
     self.hop = cfg.hop_size
     self.segment_size = cfg.segment_size if split == 'train' else None
+    # Precomputed targets, used instead of the converters for the tracks they contain.
+    self.targets: Optional[TargetStore] = None
 
   @abstractmethod
   def load_features(self, track_id: str) -> NDArray:
+    """Returns the features with shape (instruments, frames, bins), possibly as a read-only memory map."""
     pass
 
   @property
@@ -48,6 +52,15 @@ class DatasetBase(Dataset, ABC):
   def __len__(self):
     return len(self.track_ids)
 
+  @cached_property
+  def lengths(self) -> List[int]:
+    """The number of frames of the spectrogram of each item, used to batch items of similar length."""
+    lengths = [self.load_features(track_id).shape[1] for track_id in self.track_ids]
+    if self.segment_size is not None:
+      num_frames = int(self.segment_size * self.cfg.fps)
+      lengths = [min(length, num_frames) for length in lengths]
+    return lengths
+
   def __getitem__(self, idx):
     track_id = self.track_ids[idx]
     spec_full = self.load_features(track_id)
@@ -66,29 +79,23 @@ class DatasetBase(Dataset, ABC):
       start = None
       end = None
 
-    st = self.create_converter(idx, track_id, num_frames, start, end)
-    start_frame, end_frame = st.beat.get_start_end_frames()
-    spec = spec_full[:, start_frame:end_frame, :]
-
-    # Normalization should be done here, but it seems madmom does it for us.
+    if self.targets is not None and track_id in self.targets:
+      start_frame = time_to_frame(start, self.sample_rate, self.hop)
+      end_frame = start_frame + num_frames
+      targets = self.targets.get(track_id, start_frame, num_frames)
+    else:
+      st = self.create_converter(idx, track_id, num_frames, start, end)
+      start_frame, end_frame = st.beat.get_start_end_frames()
+      targets = compute_targets(st)
 
-    true_beat = st.beat.of_frames(encode=True)
-    true_downbeat = st.downbeat.of_frames(encode=True)
-    true_section = st.section.of_frames(encode=True, return_labels=False)
-    true_function = st.section.of_frames(encode=True, return_labels=True)
-    true_function_list = st.section.labels
+    # Copies only the selected frames into memory if the features are memory-mapped.
+    spec = np.ascontiguousarray(spec_full[:, start_frame:end_frame, :])
 
-    # widen the temporal activation
-    # region around the annotations to include two adjacent temporal
-    # frames on either side of each quantised beat location and
-    # weight them with a value of 0.5 during training.
-    widen_true_beat = widen_temporal_events(true_beat, num_neighbors=1)
-    widen_true_downbeat = widen_temporal_events(true_downbeat, num_neighbors=1)
-    widen_true_section = widen_temporal_events(true_section, num_neighbors=2)
+    # Normalization should be done here, but it seems madmom does it for us.
 
-    true_beat_times = st.beat.times
-    true_downbeat_times = st.downbeat.times
-    true_section_times = st.section.times
+    true_beat_times = targets['true_beat_times']
+    true_downbeat_times = targets['true_downbeat_times']
+    true_section_times = targets['true_section_times']
 
     if should_segment:
       end_time = start + self.segment_size
@@ -104,17 +111,17 @@ class DatasetBase(Dataset, ABC):
       track_key=track_id,
       spec=spec,
 
-      true_beat=true_beat,
-      true_downbeat=true_downbeat,
-      true_section=true_section,
-      true_function=true_function,
+      true_beat=targets['true_beat'],
+      true_downbeat=targets['true_downbeat'],
+      true_section=targets['true_section'],
+      true_function=targets['true_function'],
 
-      widen_true_beat=widen_true_beat,
-      widen_true_downbeat=widen_true_downbeat,
-      widen_true_section=widen_true_section,
+      widen_true_beat=targets['widen_true_beat'],
+      widen_true_downbeat=targets['widen_true_downbeat'],
+      widen_true_section=targets['widen_true_section'],
 
       true_beat_times=true_beat_times.tolist(),
       true_downbeat_times=true_downbeat_times.tolist(),
       true_section_times=true_section_times.tolist(),
-      true_function_list=true_function_list.tolist(),
+      true_function_list=targets['true_function_list'].tolist(),
     )
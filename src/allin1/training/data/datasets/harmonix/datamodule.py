@@ -1,7 +1,9 @@
+from typing import Optional
 from lightning import LightningDataModule
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 from .dataset import HarmonixDataset
 from ..collate import collate_fn
+from ...samplers import BucketBatchSampler
 from .....config import Config
 
 
@@ -37,31 +39,39 @@ class HarmonixDataModule(LightningDataModule):
       #   self.dataset_test = Subset(self.dataset_test, range(1))
   
   def train_dataloader(self):
-    return DataLoader(
-      self.dataset_train,
+    batch_sampler = BucketBatchSampler(
+      RandomSampler(self.dataset_train),
+      lengths=self.dataset_train.lengths,
       batch_size=self.cfg.batch_size,
+      pool_size=self.cfg.batch_size * self.cfg.bucket_pool_batches,
       shuffle=True,
-      num_workers=0 if self.cfg.debug else 2,
-      collate_fn=collate_fn,
     )
-  
-  def val_dataloader(self):
     return DataLoader(
-      self.dataset_val,
-      batch_size=1,
-      shuffle=False,
-      num_workers=0 if self.cfg.debug else 1,
+      self.dataset_train,
+      batch_sampler=batch_sampler,
+      num_workers=0 if self.cfg.debug else 2,
       collate_fn=collate_fn,
     )
   
-  def test_dataloader(self):
+  def val_dataloader(self, batch_size: Optional[int] = None):
+    return self.eval_dataloader(self.dataset_val, batch_size)
+  
+  def test_dataloader(self, batch_size: Optional[int] = None):
+    return self.eval_dataloader(self.dataset_test, batch_size)
+  
+  def predict_dataloader(self):
+    # Predictions are postprocessed track by track.
+    return self.test_dataloader(batch_size=1)
+  
+  def eval_dataloader(self, dataset: HarmonixDataset, batch_size: Optional[int] = None):
+    batch_sampler = BucketBatchSampler(
+      SequentialSampler(dataset),
+      lengths=dataset.lengths,
+      batch_size=batch_size or self.cfg.eval_batch_size,
+    )
     return DataLoader(
-      self.dataset_test,
-      batch_size=1,
-      shuffle=False,
+      dataset,
+      batch_sampler=batch_sampler,
       num_workers=0 if self.cfg.debug else 1,
       collate_fn=collate_fn,
     )
-  
-  def predict_dataloader(self):
-    return self.test_dataloader()
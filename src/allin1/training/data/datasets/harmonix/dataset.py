@@ -7,6 +7,7 @@ from numpy.typing import NDArray
 from ..datasetbase import DatasetBase
 from ...utils import widen_temporal_events
 from ...eventconverters import HarmonixConverter
+from ...targets import TargetStore
 from .....config import Config
 
 
@@ -44,13 +45,24 @@ class HarmonixDataset(DatasetBase):
       else Path(cfg.data.path_no_demixed_feature_dir)
     )
     self.df = df
+
+    target_dir = cfg.data.path_target_dir
+    if target_dir is not None and (Path(target_dir) / 'index.json').is_file():
+      self.targets = TargetStore(target_dir)
+      if (self.targets.sample_rate, self.targets.hop_size) != (self.sample_rate, self.hop):
+        raise ValueError(
+          f'The targets in {target_dir} were computed with a sample rate of {self.targets.sample_rate} '
+          f'and a hop size of {self.targets.hop_size}, but the config has {self.sample_rate} and {self.hop}. '
+          f'Please run allin1-preprocess again.'
+        )
   
   @property
   def track_ids(self):
     return self._track_ids
   
   def load_features(self, track_id: str) -> NDArray:
-    return np.load(self.feature_dir / f'{track_id}.npy')
+    # Memory-mapped, so that only the frames of the sampled segment are read from disk.
+    return np.load(self.feature_dir / f'{track_id}.npy', mmap_mode='r')
   
   def create_converter(
     self,
@@ -0,0 +1,53 @@
+import math
+import torch
+
+from typing import Iterator, List, Optional, Sequence
+from torch.utils.data import BatchSampler, Sampler
+
+
+class BucketBatchSampler(BatchSampler):
+  """
+  Batches indices of similar length, so that little compute is wasted on padding.
+
+  The indices drawn from ``sampler`` are split into pools of ``pool_size`` indices (all of them if None),
+  each pool is sorted by ``lengths`` and cut into batches, and with ``shuffle`` the order of the batches
+  is randomized. The indices still come from ``sampler``, which can therefore be replaced by a
+  distributed sampler.
+  """
+
+  def __init__(
+    self,
+    sampler: Sampler[int],
+    lengths: Sequence[int],
+    batch_size: int,
+    drop_last: bool = False,
+    pool_size: Optional[int] = None,
+    shuffle: bool = False,
+  ):
+    super().__init__(sampler, batch_size, drop_last)
+    if pool_size is not None and pool_size % batch_size != 0:
+      raise ValueError(f'The pool size ({pool_size}) must be a multiple of the batch size ({batch_size}).')
+    self.lengths = lengths
+    self.pool_size = pool_size
+    self.shuffle = shuffle
+
+  def __iter__(self) -> Iterator[List[int]]:
+    indices = list(self.sampler)
+    pool_size = self.pool_size or max(len(indices), 1)
+    batches = []
+    for i in range(0, len(indices), pool_size):
+      pool = sorted(indices[i:i + pool_size], key=lambda index: self.lengths[index], reverse=True)
+      for j in range(0, len(pool), self.batch_size):
+        batch = pool[j:j + self.batch_size]
+        if len(batch) == self.batch_size or not self.drop_last:
+          batches.append(batch)
+
+    if self.shuffle:
+      batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+    yield from batches
+
+  def __len__(self) -> int:
+    # Every pool but the last holds a whole number of batches.
+    if self.drop_last:
+      return len(self.sampler) // self.batch_size
+    return math.ceil(len(self.sampler) / self.batch_size)
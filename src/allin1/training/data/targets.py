@@ -0,0 +1,191 @@
+import json
+import numpy as np
+import librosa
+
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Tuple
+from numpy.typing import NDArray
+from tqdm import tqdm
+from .utils import widen_temporal_events
+from .eventconverters import DatasetConverter
+from ...typings import PathLike
+
+# Frame-level targets and their types on disk.
+FRAME_TARGETS = {
+  'true_beat': np.uint8,
+  'true_downbeat': np.uint8,
+  'true_section': np.uint8,
+  'true_function': np.uint8,
+  'widen_true_beat': np.float16,
+  'widen_true_downbeat': np.float16,
+  'widen_true_section': np.float16,
+}
+# Track-level targets, of variable length.
+TRACK_TARGETS = {
+  'true_beat_times': np.float64,
+  'true_downbeat_times': np.float64,
+  'true_section_times': np.float64,
+  'true_function_list': np.int64,
+}
+# Widened targets and the number of neighbors their events are widened to.
+WIDEN_NEIGHBORS = {
+  'widen_true_beat': ('true_beat', 1),
+  'widen_true_downbeat': ('true_downbeat', 1),
+  'widen_true_section': ('true_section', 2),
+}
+
+
+def compute_targets(st: DatasetConverter) -> Dict[str, NDArray]:
+  """Returns the targets of the frames spanned by a converter, and the annotations of the whole track."""
+  targets = dict(
+    true_beat=st.beat.of_frames(encode=True),
+    true_downbeat=st.downbeat.of_frames(encode=True),
+    true_section=st.section.of_frames(encode=True, return_labels=False),
+    true_function=st.section.of_frames(encode=True, return_labels=True),
+  )
+
+  # widen the temporal activation
+  # region around the annotations to include two adjacent temporal
+  # frames on either side of each quantised beat location and
+  # weight them with a value of 0.5 during training.
+  for key, (source, num_neighbors) in WIDEN_NEIGHBORS.items():
+    targets[key] = widen_temporal_events(targets[source], num_neighbors=num_neighbors)
+
+  targets.update(
+    true_beat_times=st.beat.times,
+    true_downbeat_times=st.downbeat.times,
+    true_section_times=st.section.times,
+    true_function_list=st.section.labels,
+  )
+  return targets
+
+
+def time_to_frame(time: Optional[float], sr: int, hop: int) -> int:
+  """Returns the first frame of a segment starting at ``time``, like ``EventConverter.get_start_end_frames``."""
+  return int(librosa.time_to_frames(time, sr=sr, hop_length=hop).item()) if time else 0
+
+
+class TargetStore:
+  """
+  Columnar store of precomputed training targets, written once by ``write_target_store``.
+
+  Each target is one ``.npy`` file with the values of all tracks concatenated, and ``index.json`` holds
+  the offsets of the tracks. The files are memory-mapped, so ``get`` only reads the frames it returns.
+  """
+
+  def __init__(self, path: PathLike):
+    self.path = Path(path)
+    index = json.loads((self.path / 'index.json').read_text())
+    self.sample_rate = index['sample_rate']
+    self.hop_size = index['hop_size']
+    self.tracks = {track_id: i for i, track_id in enumerate(index['track_ids'])}
+    self.frame_offsets = index['frame_offsets']
+    self.num_frames = index['num_frames']
+    self.track_offsets = index['track_offsets']
+    self.columns = {
+      key: np.load(self.path / f'{key}.npy', mmap_mode='r')
+      for key in [*FRAME_TARGETS, *TRACK_TARGETS]
+    }
+
+  def __contains__(self, track_id: str) -> bool:
+    return track_id in self.tracks
+
+  def get(self, track_id: str, start_frame: int, num_frames: int) -> Dict[str, NDArray]:
+    """
+    Returns the same targets as ``compute_targets`` for the converter of ``num_frames`` frames
+    starting at ``start_frame``.
+    """
+    i = self.tracks[track_id]
+    frame_offset, total_frames = self.frame_offsets[i], self.num_frames[i]
+
+    def window(key: str, pad_value) -> NDArray:
+      column = self.columns[key][frame_offset:frame_offset + total_frames]
+      values = np.asarray(column[start_frame:start_frame + num_frames], dtype=np.float32)
+      if len(values) < num_frames:
+        values = np.pad(values, (0, num_frames - len(values)), constant_values=pad_value)
+      return values
+
+    targets = {key: window(key, 0) for key in ['true_beat', 'true_downbeat', 'true_section']}
+    # Frames after the last boundary belong to the last section.
+    last_label = self.columns['true_function'][frame_offset + total_frames - 1]
+    targets['true_function'] = window('true_function', last_label).astype(np.int64)
+
+    for key, (source, num_neighbors) in WIDEN_NEIGHBORS.items():
+      k = num_neighbors
+      if num_frames <= 4 * k or start_frame + num_frames > total_frames:
+        targets[key] = widen_temporal_events(targets[source], num_neighbors=k)
+        continue
+      # Widening only reaches k frames, so the stored values are only wrong within k frames of the edges,
+      # where they may include events from outside of the window. These are recomputed from the window.
+      widened = window(key, 0)
+      widened[:k] = widen_temporal_events(targets[source][:2 * k], num_neighbors=k)[:k]
+      widened[-k:] = widen_temporal_events(targets[source][-2 * k:], num_neighbors=k)[-k:]
+      targets[key] = widened
+
+    for key in TRACK_TARGETS:
+      offsets = self.track_offsets[key]
+      targets[key] = np.array(self.columns[key][offsets[i]:offsets[i + 1]])
+    return targets
+
+
+def write_target_store(
+  path: PathLike,
+  track_ids: Iterable[str],
+  make_converter: Callable[[str, int], DatasetConverter],
+  num_frames: Callable[[str], int],
+  sample_rate: int,
+  hop_size: int,
+):
+  """
+  Computes the targets of whole tracks and writes them as a ``TargetStore`` to ``path``.
+  ``make_converter(track_id, num_frames)`` returns the converter of the first ``num_frames`` frames of a track,
+  and ``num_frames(track_id)`` the number of frames of its features.
+  """
+  path = Path(path)
+  path.mkdir(parents=True, exist_ok=True)
+  columns = {key: [] for key in [*FRAME_TARGETS, *TRACK_TARGETS]}
+  index = dict(
+    sample_rate=sample_rate, hop_size=hop_size,
+    track_ids=[], frame_offsets=[], num_frames=[], track_offsets={key: [0] for key in TRACK_TARGETS},
+  )
+  frame_offset = 0
+  for track_id in tqdm(list(track_ids), desc='Computing targets'):
+    total_frames, st = _track_converter(track_id, make_converter, num_frames(track_id), sample_rate, hop_size)
+    targets = compute_targets(st)
+    for key, dtype in FRAME_TARGETS.items():
+      values = np.asarray(targets[key]).astype(dtype)
+      if not np.array_equal(values, targets[key]):
+        raise ValueError(f'The values of {key} of {track_id} cannot be stored as {np.dtype(dtype).name}.')
+      columns[key].append(values)
+    for key, dtype in TRACK_TARGETS.items():
+      columns[key].append(np.asarray(targets[key], dtype=dtype))
+      offsets = index['track_offsets'][key]
+      offsets.append(offsets[-1] + len(targets[key]))
+
+    index['track_ids'].append(track_id)
+    index['frame_offsets'].append(frame_offset)
+    index['num_frames'].append(total_frames)
+    frame_offset += total_frames
+
+  for key, dtype in {**FRAME_TARGETS, **TRACK_TARGETS}.items():
+    np.save(path / f'{key}.npy', np.concatenate(columns[key]) if columns[key] else np.empty(0, dtype=dtype))
+  (path / 'index.json').write_text(json.dumps(index))
+
+
+def _track_converter(
+  track_id: str,
+  make_converter: Callable[[str, int], DatasetConverter],
+  num_frames: int,
+  sample_rate: int,
+  hop_size: int,
+) -> Tuple[int, DatasetConverter]:
+  # Annotations after the end of the features still fall into the segments sampled near the end,
+  # so the targets cover them as well.
+  st = make_converter(track_id, num_frames)
+  times = np.concatenate([st.beat.times, st.downbeat.times, st.section.times])
+  if len(times):
+    last_frame = int(librosa.time_to_frames(times, sr=sample_rate, hop_length=hop_size).max())
+    if last_frame >= num_frames:
+      num_frames = last_frame + 1
+      st = make_converter(track_id, num_frames)
+  return num_frames, st
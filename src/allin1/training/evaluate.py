@@ -71,7 +71,7 @@ def evaluate(
       or run.config['best_threshold_beat'] is None
     ):
       dm.setup('validate')
-      outputs_val = trainer.predict(model, dataloaders=dm.val_dataloader())
+      outputs_val = trainer.predict(model, dataloaders=dm.val_dataloader(batch_size=1))
       threshold_beat, threshold_downbeat = find_best_thresholds(outputs_val, cfg)
 
       if not cfg.debug:
@@ -1,15 +1,16 @@
 import numpy as np
 import torch.nn.functional as F
 
+import os
 import ast
 import torch
 import librosa
 
-from typing import Union
-from tqdm import tqdm
+from typing import Optional, Union
+from multiprocessing import Pool
 from omegaconf import DictConfig
 from numpy.typing import NDArray
-from madmom.evaluation.beats import BeatEvaluation, BeatMeanEvaluation
+from madmom.evaluation.beats import FMEASURE_WINDOW
 from ..config import Config
 from ..typings import AllInOnePrediction
 
@@ -120,20 +121,90 @@ def find_best_thresholds(predict_outputs, cfg: Config):
   return threshold_beat, threshold_downbeat
 
 
-def find_best_threshold(probs, trues, cfg: Config, filter_size: int):
-  results = {}
-  for threshold in tqdm(
-    np.linspace(0, 0.5, 51),
-    desc='Finding best threshold...',
-  ):
-    results[threshold] = []
-    for prob, true in zip(probs, trues):
-      lmprob_beats, _ = local_maxima(prob, filter_size=filter_size)
-      pred_beats = (lmprob_beats > threshold).numpy()
-      pred_beat_times = event_frames_to_time(pred_beats, cfg)
-      eval = BeatEvaluation(pred_beat_times, true)
-      results[threshold].append(eval)
-    results[threshold] = BeatMeanEvaluation(results[threshold])
-
-  best_threshold = max(results, key=lambda k: results[k].fmeasure)
-  return best_threshold, results[best_threshold]
+def find_best_threshold(
+  probs,
+  trues,
+  cfg: Config,
+  filter_size: int,
+  thresholds: NDArray = np.linspace(0, 0.5, 51),
+  num_workers: Optional[int] = None,
+):
+  """
+  Returns the threshold with the best mean F-measure over the tracks, and that F-measure.
+
+  Since the local maxima do not depend on the threshold, they are found once per track, and all thresholds
+  are evaluated at once by ``threshold_fmeasures``, which gives the same F-measures as madmom's
+  ``BeatEvaluation``. Tracks are evaluated by ``num_workers`` processes (all CPUs by default).
+  """
+  jobs = []
+  for prob, true in zip(probs, trues):
+    lmprob_beats, _ = local_maxima(prob, filter_size=filter_size)
+    lmprob_beats = lmprob_beats.cpu().numpy()
+    # Peaks must exceed the threshold, so the ones at zero are never detected.
+    frames = np.flatnonzero(lmprob_beats > 0)
+    times = librosa.frames_to_time(frames, sr=cfg.sample_rate, hop_length=cfg.hop_size)
+    jobs.append((times, lmprob_beats[frames], np.asarray(true, dtype=np.float64), thresholds))
+
+  num_workers = min(num_workers or os.cpu_count() or 1, len(jobs))
+  if num_workers > 1:
+    with Pool(num_workers) as pool:
+      fmeasures = pool.starmap(threshold_fmeasures, jobs)
+  else:
+    fmeasures = [threshold_fmeasures(*job) for job in jobs]
+
+  # Tracks on the last axis, so that the sums are done in the same order as madmom's mean over a list.
+  fmeasures = np.nanmean(np.stack(fmeasures, axis=-1), axis=-1)
+  best = int(np.argmax(fmeasures))
+  return thresholds[best], fmeasures[best]
+
+
+def threshold_fmeasures(
+  detections: NDArray,
+  values: NDArray,
+  annotations: NDArray,
+  thresholds: NDArray,
+  window: float = FMEASURE_WINDOW,
+) -> NDArray:
+  """
+  Returns the F-measure of the detections whose values exceed each threshold, as computed by madmom's
+  ``BeatEvaluation`` (without skipping the first seconds).
+
+  madmom matches the sorted detections and annotations greedily: each detection is matched to the first
+  remaining annotation within ``window`` seconds, and the annotations too early to be matched by it are missed.
+  The matching only depends on the previous detections through the index of the first remaining annotation,
+  so it runs once over the detections with one such index per threshold.
+  """
+  order = np.argsort(detections, kind='stable')
+  detections, values = detections[order], values[order]
+  annotations = np.sort(annotations)
+  # Compare in the precision of the probabilities, as ``values > threshold`` does with a float32 tensor.
+  selected = values[:, None] > np.asarray(thresholds).astype(values.dtype)[None, :]
+
+  num_detections = selected.sum(axis=0)
+  num_annotations = len(annotations)
+  num_tp = np.zeros(len(thresholds), dtype=np.int64)
+  if num_annotations and len(detections):
+    # Index of the first annotation that is not too early for each detection, i.e. not ``d - a > window``.
+    first = np.searchsorted(annotations, detections - window)
+    while True:
+      back = (first > 0) & ~(detections - annotations[np.maximum(first - 1, 0)] > window)
+      forward = (first < num_annotations) & (detections - annotations[np.minimum(first, num_annotations - 1)] > window)
+      if not back.any() and not forward.any():
+        break
+      first = first - back + forward
+
+    pointers = np.zeros(len(thresholds), dtype=np.int64)
+    for d, active, start in zip(detections, selected, first):
+      if not active.any():
+        continue
+      index = np.maximum(pointers, start)
+      candidate = annotations[np.minimum(index, num_annotations - 1)]
+      matched = active & (index < num_annotations) & (np.abs(d - candidate) <= window)
+      num_tp += matched
+      pointers = np.where(active, index + matched, pointers)
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    precision = np.where(num_detections > 0, num_tp / num_detections, 1.)
+    recall = num_tp / num_annotations if num_annotations else np.ones(len(thresholds))
+    numerator = 2. * precision * recall
+    return np.where(numerator > 0, numerator / (precision + recall), 0.)
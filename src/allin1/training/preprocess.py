@@ -1,10 +1,13 @@
 import hydra
+import numpy as np
 import torch
 
 from ..config import Config
 from ..spectrogram import extract_spectrograms
 from ..demix import demix
 from ..helpers import expand_paths, mkpath
+from .data.eventconverters import HarmonixConverter
+from .data.targets import write_target_store
 
 
 @hydra.main(version_base=None, config_name='config')
@@ -27,6 +30,24 @@ def main(cfg: Config):
 
   print(f'Preprocessing finished. {len(spec_paths)} spectrograms saved.')
 
+  if cfg.data.path_target_dir is not None:
+    # Frame-level targets are computed once here, so that the datasets only slice them.
+    write_target_store(
+      path=mkpath(cfg.data.path_target_dir),
+      track_ids=[path.stem for path in track_paths],
+      make_converter=lambda track_id, num_frames: HarmonixConverter(
+        track_id=track_id,
+        total_frames=num_frames,
+        sr=cfg.sample_rate,
+        hop=cfg.hop_size,
+        base_dir=cfg.data.path_base_dir,
+      ),
+      num_frames=lambda track_id: np.load(feature_dir / f'{track_id}.npy', mmap_mode='r').shape[1],
+      sample_rate=cfg.sample_rate,
+      hop_size=cfg.hop_size,
+    )
+    print(f'Targets of {len(track_paths)} tracks saved to {cfg.data.path_target_dir}.')
+
 
 if __name__ == '__main__':
   main()
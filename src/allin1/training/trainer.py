@@ -103,7 +103,7 @@ class AllInOneTrainer(LightningModule):
     batch_size = batch['spec'].shape[0]
     outputs: AllInOneOutput = self(batch['spec'])
     losses = self.compute_losses(outputs, batch, prefix)
-    predictions = self.compute_predictions(outputs)
+    predictions = self.compute_predictions(outputs, mask=batch['mask'])
     scores = self.compute_metrics(predictions, batch, prefix)
     self.log_dict(losses, sync_dist=True, batch_size=batch_size)
     self.log_dict(scores, sync_dist=True, batch_size=batch_size)
@@ -143,10 +143,13 @@ class AllInOneTrainer(LightningModule):
       reduction='none',
     )
 
-    loss_beat = torch.mean(batch['mask'] * loss_beat)
-    loss_downbeat = torch.mean(batch['mask'] * loss_downbeat)
-    loss_section = torch.mean(batch['mask'] * loss_section)
-    loss_function = torch.mean(batch['mask'] * loss_function)
+    # Averaged over the actual frames only, so that the losses do not depend on the padding of the batch.
+    mask = batch['mask']
+    num_frames = mask.sum()
+    loss_beat = torch.sum(mask * loss_beat) / num_frames
+    loss_downbeat = torch.sum(mask * loss_downbeat) / num_frames
+    loss_section = torch.sum(mask * loss_section) / num_frames
+    loss_function = torch.sum(mask * loss_function) / num_frames
 
     loss_beat *= self.cfg.loss_weight_beat
     loss_downbeat *= self.cfg.loss_weight_downbeat
@@ -243,19 +246,18 @@ class AllInOneTrainer(LightningModule):
     score_downbeat = BeatMeanEvaluation(eval_downbeat)
     score_section = BeatMeanEvaluation(eval_section)
 
-    mask = batch['mask'].cpu().numpy()
+    # The function scores are averaged over the tracks, like the other scores.
+    mask = batch['mask'].cpu().numpy().astype(bool)
     true_functions = batch['true_function'].cpu().numpy()
-    true_functions = np.where(mask, true_functions, -1)
-    true_functions = true_functions.flatten()
-    true_functions = true_functions[true_functions != -1]
-
     pred_functions = p.pred_functions
-    pred_functions = np.where(mask, pred_functions, -1)
-    pred_functions = pred_functions.flatten()
-    pred_functions = pred_functions[pred_functions != -1]
-
-    function_f1 = f1_score(true_functions, pred_functions, average='macro')
-    function_accuracy = accuracy_score(true_functions, pred_functions)
+    function_f1 = np.mean([
+      f1_score(true[m], pred[m], average='macro')
+      for true, pred, m in zip(true_functions, pred_functions, mask)
+    ])
+    function_accuracy = np.mean([
+      accuracy_score(true[m], pred[m])
+      for true, pred, m in zip(true_functions, pred_functions, mask)
+    ])
 
     d = dict(
       beat_f1=score_beat.fmeasure,
@@ -1,23 +1,29 @@
 import numpy as np
-import torch
 import json
+import struct
+import zipfile
 
+from collections.abc import Mapping
 from os import PathLike
 from pathlib import Path
-from typing import List, Dict, Optional, Union
+from typing import TYPE_CHECKING, Iterator, List, Dict, Optional, Union
 from dataclasses import dataclass
 from numpy.typing import NDArray
 
+if TYPE_CHECKING:
+  # Only used in annotations, so that reading results does not load PyTorch.
+  import torch
+
 PathLike = Union[str, PathLike]
 
 
 @dataclass
 class AllInOneOutput:
-  logits_beat: torch.FloatTensor = None
-  logits_downbeat: torch.FloatTensor = None
-  logits_section: torch.FloatTensor = None
-  logits_function: torch.FloatTensor = None
-  embeddings: torch.FloatTensor = None
+  logits_beat: 'torch.FloatTensor' = None
+  logits_downbeat: 'torch.FloatTensor' = None
+  logits_section: 'torch.FloatTensor' = None
+  logits_function: 'torch.FloatTensor' = None
+  embeddings: 'torch.FloatTensor' = None
 
 
 @dataclass
@@ -59,30 +65,82 @@ class AnalysisResult:
       segments=[Segment(**seg) for seg in data['segments']],
     )
 
+    # The arrays are memory-mapped, so that loading many results only reads the parts that are used.
     if load_activations:
       activ_path = path.with_suffix('.activ.npz')
       if activ_path.is_file():
-        activs = np.load(activ_path)
-        result.activations = {key: activs[key] for key in activs.files}
+        result.activations = LazyArrays(activ_path)
 
     if load_embeddings:
       embed_path = path.with_suffix('.embed.npy')
       if embed_path.is_file():
-        result.embeddings = np.load(embed_path)
+        result.embeddings = np.load(embed_path, mmap_mode='r')
 
     return result
 
 
+class LazyArrays(Mapping):
+  """
+  Read-only mapping of the arrays in an ``.npz`` file, which are only read on first access.
+  Arrays stored without compression, as written by ``np.savez``, are memory-mapped instead of read.
+  """
+
+  def __init__(self, path: PathLike):
+    self.path = Path(path)
+    with zipfile.ZipFile(self.path) as zip_file:
+      self._members = {
+        info.filename[:-len('.npy')]: info for info in zip_file.infolist() if info.filename.endswith('.npy')
+      }
+    self._arrays: Dict[str, NDArray] = {}
+
+  def __getitem__(self, key: str) -> NDArray:
+    if key not in self._arrays:
+      self._arrays[key] = self._load(self._members[key])
+    return self._arrays[key]
+
+  def __iter__(self) -> Iterator[str]:
+    return iter(self._members)
+
+  def __len__(self) -> int:
+    return len(self._members)
+
+  def __repr__(self) -> str:
+    return f'{type(self).__name__}({str(self.path)!r}, keys={list(self)})'
+
+  def __deepcopy__(self, memo) -> Dict[str, NDArray]:
+    # ``dataclasses.asdict`` deep-copies the fields of results, which reads all arrays.
+    return {key: np.array(value) for key, value in self.items()}
+
+  def _load(self, info: zipfile.ZipInfo) -> NDArray:
+    if info.compress_type == zipfile.ZIP_STORED:
+      with open(self.path, 'rb') as f:
+        # The data of a member follows its local header, whose size depends on its name and extra field.
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', f.read(4))
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        read_header = {
+          (1, 0): np.lib.format.read_array_header_1_0,
+          (2, 0): np.lib.format.read_array_header_2_0,
+        }.get(np.lib.format.read_magic(f))
+        if read_header is not None:
+          shape, fortran_order, dtype = read_header(f)
+          if not dtype.hasobject and np.prod(shape) > 0:
+            order = 'F' if fortran_order else 'C'
+            return np.memmap(self.path, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order=order)
+    with np.load(self.path) as npz:
+      return npz[info.filename[:-len('.npy')]]
+
+
 @dataclass
 class AllInOnePrediction:
-  raw_prob_beats: torch.FloatTensor
-  raw_prob_downbeats: torch.FloatTensor
-  raw_prob_sections: torch.FloatTensor
-  raw_prob_functions: torch.FloatTensor
-
-  prob_beats: torch.FloatTensor
-  prob_downbeats: torch.FloatTensor
-  prob_sections: torch.FloatTensor
+  raw_prob_beats: 'torch.FloatTensor'
+  raw_prob_downbeats: 'torch.FloatTensor'
+  raw_prob_sections: 'torch.FloatTensor'
+  raw_prob_functions: 'torch.FloatTensor'
+
+  prob_beats: 'torch.FloatTensor'
+  prob_downbeats: 'torch.FloatTensor'
+  prob_sections: 'torch.FloatTensor'
   prob_functions: NDArray[np.float32]
 
   pred_beats: NDArray[np.float32]
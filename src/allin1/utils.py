@@ -1,6 +1,9 @@
 import re
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import List, Optional
+from tqdm import tqdm
 from .typings import PathLike, AnalysisResult
 
 
@@ -29,3 +32,24 @@ def load_result(
     load_embeddings=load_embeddings,
   )
   return result
+
+
+def load_results(
+  paths: List[PathLike],
+  load_activations: bool = True,
+  load_embeddings: bool = True,
+  num_workers: Optional[int] = None,
+  progress: bool = False,
+) -> List[AnalysisResult]:
+  """
+  Loads many results at once, in the order of ``paths``. The files are read by ``num_workers`` threads
+  (by default, as many as ``ThreadPoolExecutor`` uses), since loading them mostly waits for the disk.
+  """
+  def load(path: PathLike) -> AnalysisResult:
+    return load_result(path, load_activations=load_activations, load_embeddings=load_embeddings)
+
+  with ThreadPoolExecutor(num_workers) as pool:
+    results = pool.map(load, paths)
+    if progress:
+      results = tqdm(results, total=len(paths), desc='Loading existing results')
+    return list(results)
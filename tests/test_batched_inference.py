@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+import torch
+
+from omegaconf import OmegaConf
+from allin1.config import Config, HarmonixConfig
+from allin1.helpers import run_batched_inference, group_by_length, forward_chunked
+from allin1.models.allinone import AllInOne
+from allin1.models.dinat import PADDING_MASK
+from allin1.models.utils import get_receptive_field
+from allin1.typings import AllInOneOutput
+
+
+class FrameWiseModel(torch.nn.Module):
+  """A fast stand-in for AllInOne whose outputs only depend on the current frame."""
+
+  def __init__(self):
+    super().__init__()
+    self.cfg = OmegaConf.structured(Config(data=HarmonixConfig()))
+    self.cfg.best_threshold_beat = 0.2
+    self.cfg.best_threshold_downbeat = 0.2
+    self.linear = torch.nn.Linear(4 * 81, 3 + 10 + 4 * 24)
+
+  def forward(self, x, lengths=None):
+    N, K, T, F = x.shape
+    h = self.linear(x.permute(0, 2, 1, 3).reshape(N, T, K * F))
+    return AllInOneOutput(
+      logits_beat=h[..., 0],
+      logits_downbeat=h[..., 1],
+      logits_section=h[..., 2],
+      logits_function=h[..., 3:13].permute(0, 2, 1),
+      embeddings=h[..., 13:].reshape(N, T, K, 24).permute(0, 2, 1, 3),
+    )
+
+
+def make_model(depth: int) -> AllInOne:
+  torch.manual_seed(0)
+  cfg = OmegaConf.structured(Config(data=HarmonixConfig()))
+  cfg.depth = depth
+  cfg.best_threshold_beat = 0.2
+  cfg.best_threshold_downbeat = 0.2
+  model = AllInOne(cfg).eval()
+  for param in model.parameters():
+    param.data.normal_(0, 0.1)
+  return model
+
+
+def test_group_by_length():
+  assert group_by_length([500, 800, 300, 500, 500], 2) == [[2, 0], [3, 4], [1]]
+  assert group_by_length([500, 800, 300, 500, 500], 2, equal=True) == [[2], [0, 3], [4], [1]]
+
+
+def test_run_batched_inference():
+  model = make_model(depth=3)
+  # The output of every frame depends on its neighbors, so the padding of a track must be masked.
+  specs = [np.random.rand(4, T, 81).astype('float32') for T in [300, 360, 200, 310]]
+  paths = [f'track{i}.mp3' for i in range(len(specs))]
+
+  with torch.no_grad():
+    batched = run_batched_inference(paths, specs, model, 'cpu', True, True, batch_size=3)
+    single = run_batched_inference(paths, specs, model, 'cpu', True, True, batch_size=1)
+
+  for result_batched, result_single, spec in zip(batched, single, specs):
+    assert result_batched.path == result_single.path
+    assert result_batched.beats == result_single.beats
+    assert result_batched.segments == result_single.segments
+    assert result_batched.embeddings.shape == (4, spec.shape[1], 24)
+    for key in ['beat', 'downbeat', 'segment', 'label']:
+      np.testing.assert_allclose(result_batched.activations[key], result_single.activations[key], atol=1e-5)
+    np.testing.assert_allclose(result_batched.embeddings, result_single.embeddings, atol=1e-5)
+
+
+def test_forward_chunked():
+  model = make_model(depth=3)
+  margin = get_receptive_field(model.cfg)
+  spec = torch.rand(2, 4, 500, 81)
+
+  with torch.no_grad():
+    full = model(spec)
+    stitched = forward_chunked(model, spec, chunk_size=150)
+    # The overlap beyond twice the receptive field is cross-faded.
+    faded = forward_chunked(model, spec, chunk_size=150, overlap=2 * margin + 20)
+    with pytest.raises(ValueError, match='twice the receptive field'):
+      forward_chunked(model, spec, chunk_size=150, overlap=margin)
+
+  for chunked in [stitched, faded]:
+    for field in ['logits_beat', 'logits_downbeat', 'logits_section', 'logits_function', 'embeddings']:
+      assert getattr(chunked, field).shape == getattr(full, field).shape
+      assert torch.allclose(getattr(chunked, field), getattr(full, field), atol=1e-4)
+
+
+@pytest.mark.skipif(not PADDING_MASK, reason='padded batches are only masked with NATTEN_API=torch')
+def test_forward_chunked_padded():
+  model = make_model(depth=3)
+  # The track of 30 frames is shorter than the attention windows, which pad it further.
+  lengths = [500, 260, 30]
+  spec = torch.zeros(3, 4, 500, 81)
+  for i, length in enumerate(lengths):
+    spec[i, :, :length] = torch.rand(4, length, 81)
+
+  with torch.no_grad():
+    batched = model(spec, lengths=lengths)
+    chunked = forward_chunked(model, spec, chunk_size=150, lengths=lengths)
+    for i, length in enumerate(lengths):
+      alone = model(spec[i:i + 1, :, :length])
+      for output in [batched, chunked]:
+        assert torch.allclose(output.logits_beat[i, :length], alone.logits_beat[0], atol=1e-4)
+        assert torch.allclose(output.logits_function[i, :, :length], alone.logits_function[0], atol=1e-4)
+        assert torch.allclose(output.embeddings[i, :, :length], alone.embeddings[0], atol=1e-4)
+
+
+def test_get_receptive_field():
+  cfg = OmegaConf.structured(Config(data=HarmonixConfig()))
+  # 11 layers of dilated attention with dilations of 2 ** i, doubled for the double attention.
+  assert get_receptive_field(cfg) == 2 + sum(2 * 2 ** i * 2 + 2 for i in range(11))
@@ -0,0 +1,25 @@
+import numpy as np
+
+from omegaconf import OmegaConf
+from allin1.bench import BENCHMARK_STAGES, run_benchmark, synthetic_stems
+from allin1.config import Config, HarmonixConfig
+from allin1.spectrogram import STEMS
+
+
+def test_synthetic_stems():
+  stems = synthetic_stems(3.5, block_duration=1.)
+  assert list(stems) == STEMS
+  assert all(wav.shape == (3 * 44100 + 22050,) and wav.dtype == np.int16 for wav in stems.values())
+  assert all(np.abs(wav).max() > 1000 for wav in stems.values())
+  assert all(np.array_equal(stems[stem], synthetic_stems(3.5)[stem]) for stem in STEMS)
+
+
+def test_run_benchmark():
+  cfg = OmegaConf.structured(Config(data=HarmonixConfig()))
+  cfg.depth = 3
+  cfg.best_threshold_beat = 0.2
+  cfg.best_threshold_downbeat = 0.2
+
+  results = run_benchmark([4., 8.], num_folds=2, cfg=cfg, include_activations=True)
+  assert [(r.duration, r.stage) for r in results] == [(d, s) for d in [4., 8.] for s in BENCHMARK_STAGES]
+  assert all(r.wall_time > 0 and r.throughput > 0 for r in results)
@@ -0,0 +1,91 @@
+import os
+import pytest
+
+from allin1.analyze import analyze
+from allin1.cache import ContentCache, make_key, load_cached_result, save_cached_result
+from allin1.typings import AnalysisResult, Segment
+from allin1.utils import load_result
+
+
+def write_bytes(data: bytes):
+  return lambda path: path.write_bytes(data)
+
+
+def test_content_cache_keys_by_content(tmp_path):
+  cache = ContentCache(tmp_path / 'cache')
+  (tmp_path / 'a').mkdir()
+  (tmp_path / 'b').mkdir()
+  (tmp_path / 'a' / 'track.mp3').write_bytes(b'first')
+  (tmp_path / 'b' / 'track.mp3').write_bytes(b'second')
+  (tmp_path / 'copy.mp3').write_bytes(b'first')
+
+  hashes = [cache.audio_hash(tmp_path / name) for name in ['a/track.mp3', 'b/track.mp3', 'copy.mp3']]
+  assert hashes[0] != hashes[1]
+  assert hashes[0] == hashes[2]
+  assert make_key(hashes[0], 'spec', 1) != make_key(hashes[0], 'spec', 2)
+
+  key = make_key(hashes[0], 'spec', 1)
+  assert cache.get('spec', key) is None
+  path = cache.put('spec', key, write_bytes(b'data'))
+  assert cache.get('spec', key) == path
+  assert path.read_bytes() == b'data'
+
+
+def test_content_cache_evicts_least_recently_used(tmp_path):
+  cache = ContentCache(tmp_path, max_size=300)
+  for i, key in enumerate(['aa', 'bb', 'cc']):
+    path = cache.put('spec', key, write_bytes(b'x' * 100))
+    os.utime(path, (i, i))
+  cache.get('spec', 'aa')  # Now the most recently used one.
+
+  cache.put('spec', 'dd', write_bytes(b'x' * 100))
+  assert cache.get('spec', 'bb') is None
+  assert all(cache.get('spec', key) is not None for key in ['aa', 'cc', 'dd'])
+  assert cache.size() == 300
+
+
+def test_cached_result(tmp_path):
+  cache = ContentCache(tmp_path / 'cache')
+  track = tmp_path / 'track.wav'
+  track.write_bytes(b'audio')
+  duplicate = tmp_path / 'duplicate.wav'
+  duplicate.write_bytes(b'audio')
+  result = AnalysisResult(
+    path=track,
+    bpm=120,
+    beats=[0.5, 1.0],
+    downbeats=[0.5],
+    beat_positions=[1, 2],
+    segments=[Segment(start=0., end=1., label='intro')],
+  )
+
+  assert load_cached_result(cache, track, 'harmonix-all', None, False, False) is None
+  save_cached_result(cache, result, 'harmonix-all', None)
+  assert load_cached_result(cache, track, 'harmonix-fold0', None, False, False) is None
+  assert load_cached_result(cache, track, 'harmonix-all', None, True, False) is None
+
+  cached = load_cached_result(cache, duplicate, 'harmonix-all', None, False, False)
+  assert cached.path == duplicate
+  assert cached.beats == result.beats
+  assert cached.segments == result.segments
+
+
+def test_analyze_matches_results_by_content(tmp_path):
+  (tmp_path / 'a').mkdir()
+  (tmp_path / 'b').mkdir()
+  first, second = tmp_path / 'a' / 'track.wav', tmp_path / 'b' / 'track.wav'
+  first.write_bytes(b'first')
+  second.write_bytes(b'second')
+  with pytest.raises(ValueError, match='same name'):
+    analyze([first, second], out_dir=tmp_path / 'struct')
+
+  cache = ContentCache(tmp_path / 'cache')
+  for path, bpm in [(first, 100), (second, 120)]:
+    result = AnalysisResult(path=path, bpm=bpm, beats=[0.5], downbeats=[0.5], beat_positions=[1], segments=[])
+    save_cached_result(cache, result, 'harmonix-all', None)
+  analyze(first, out_dir=tmp_path / 'struct', cache_dir=tmp_path / 'cache')
+
+  # The result of the other track with the same name is not mistaken for the one of this track.
+  result = analyze(second, out_dir=tmp_path / 'struct', cache_dir=tmp_path / 'cache')
+  assert result.bpm == 120
+  assert load_result(tmp_path / 'struct' / 'track.json').bpm == 120
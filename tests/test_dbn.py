@@ -0,0 +1,37 @@
+import numpy as np
+
+from madmom.features.downbeats import DBNDownBeatTrackingProcessor
+from allin1.postprocessing.dbn import DBNDownBeatDecoder
+
+
+def make_activations(rng, num_frames, period, beats_per_bar, noise):
+  beat = rng.uniform(0, noise, num_frames) + 0.02
+  downbeat = rng.uniform(0, noise / 2, num_frames) + 0.01
+  for i, t in enumerate(range(rng.integers(period), num_frames, period)):
+    t = min(t + rng.integers(-2, 3), num_frames - 1)
+    beat[t] = 0.9
+    downbeat[t] = 0.7 if i % beats_per_bar == 0 else downbeat[t]
+  xbeat = np.maximum(1e-8, beat - downbeat)
+  no = (2. - beat - downbeat) / 2.
+  activations = np.stack([xbeat, downbeat, no], axis=-1)
+  activations /= activations.sum(axis=-1, keepdims=True)
+  return activations[:, :2]
+
+
+def test_dbn_downbeat_decoder_matches_madmom():
+  rng = np.random.default_rng(0)
+  activations = [
+    make_activations(rng, 1500, 50, 4, 0.1),
+    make_activations(rng, 1200, 43, 3, 0.1),
+    make_activations(rng, 900, 60, 4, 0.3),
+    np.full((300, 2), 0.01),
+  ]
+  madmom_processor = DBNDownBeatTrackingProcessor(beats_per_bar=[3, 4], threshold=0.2, fps=100)
+  decoder = DBNDownBeatDecoder(beats_per_bar=[3, 4], fps=100, threshold=0.2)
+
+  outputs = decoder.decode(activations)
+  assert len(outputs) == len(activations)
+  for act, output in zip(activations, outputs):
+    expected = madmom_processor(act)
+    np.testing.assert_array_equal(output, expected)
+    np.testing.assert_array_equal(decoder(act), expected)
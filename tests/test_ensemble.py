@@ -0,0 +1,55 @@
+import pytest
+import torch
+
+from omegaconf import OmegaConf
+from allin1.config import Config, HarmonixConfig
+from allin1.models.allinone import AllInOne
+from allin1.models.ensemble import Ensemble
+
+
+def test_fused_ensemble():
+  torch.manual_seed(0)
+  cfg = OmegaConf.structured(Config(data=HarmonixConfig()))
+  cfg.depth = 3
+  cfg.best_threshold_beat = 0.2
+  cfg.best_threshold_downbeat = 0.2
+  models = [AllInOne(cfg).eval() for _ in range(3)]
+  for model in models:
+    for param in model.parameters():
+      param.data.normal_(0, 0.1)
+
+  ensemble = Ensemble(models).eval()
+  x = torch.rand(2, 4, 200, 81)
+  with torch.no_grad():
+    looped = ensemble(x)
+    fused = ensemble.forward_fused(x)
+
+  for field in ['logits_beat', 'logits_downbeat', 'logits_section', 'logits_function', 'embeddings']:
+    assert getattr(fused, field).shape == getattr(looped, field).shape
+    assert torch.allclose(getattr(fused, field), getattr(looped, field), atol=1e-5)
+
+
+def test_fused_ensemble_falls_back_only_on_vmap_errors(monkeypatch):
+  torch.manual_seed(0)
+  cfg = OmegaConf.structured(Config(data=HarmonixConfig()))
+  cfg.depth = 1
+  cfg.best_threshold_beat = 0.2
+  cfg.best_threshold_downbeat = 0.2
+  ensemble = Ensemble([AllInOne(cfg).eval() for _ in range(2)], fused=True).eval()
+  x = torch.rand(1, 4, 50, 81)
+
+  def out_of_memory(x, lengths=None):
+    raise RuntimeError('CUDA error: out of memory')
+
+  monkeypatch.setattr(ensemble, 'forward_fused', out_of_memory)
+  with torch.no_grad(), pytest.raises(RuntimeError, match='out of memory'):
+    ensemble(x)
+  assert ensemble.fused
+
+  def unsupported(x, lengths=None):
+    raise RuntimeError('Batching rule not implemented for natten::na1d_qk')
+
+  monkeypatch.setattr(ensemble, 'forward_fused', unsupported)
+  with torch.no_grad(), pytest.warns(UserWarning, match='Batching rule'):
+    ensemble(x)
+  assert not ensemble.fused
@@ -0,0 +1,43 @@
+import numpy as np
+import torch
+
+from numpy.lib.stride_tricks import sliding_window_view
+from omegaconf import OmegaConf
+from allin1.config import Config, HarmonixConfig
+from allin1.postprocessing import postprocess_functional_structure, postprocess_functional_structures
+from allin1.postprocessing.helpers import running_max, running_mean
+from allin1.typings import AllInOneOutput
+
+
+def test_running_filters():
+  arr = np.random.default_rng(0).random((3, 100)).astype('float32')
+  for before, after in [(0, 0), (5, 5), (12, 3), (60, 60)]:
+    padded = np.pad(arr, ((0, 0), (before, after)), constant_values=-np.inf)
+    expected = sliding_window_view(padded, before + after + 1, axis=-1).max(axis=-1)
+    np.testing.assert_array_equal(running_max(arr, before, after), expected)
+
+  padded = np.pad(arr, ((0, 0), (12, 0)))
+  expected = sliding_window_view(padded[:, :-1], 12, axis=-1).mean(axis=-1)
+  np.testing.assert_allclose(running_mean(arr, -12, 0), expected, rtol=1e-6)
+
+
+def test_postprocess_functional_structures():
+  cfg = OmegaConf.structured(Config(data=HarmonixConfig()))
+  torch.manual_seed(0)
+  logits_list = [
+    AllInOneOutput(
+      logits_beat=torch.randn(1, T),
+      logits_downbeat=torch.randn(1, T),
+      logits_section=3 * torch.randn(1, T),
+      logits_function=torch.randn(1, 10, T),
+      embeddings=torch.randn(1, 4, T, 24),
+    )
+    for T in [3000, 5000, 1234]
+  ]
+
+  batched = postprocess_functional_structures(logits_list, cfg)
+  for segments, logits in zip(batched, logits_list):
+    assert segments == postprocess_functional_structure(logits, cfg)
+    assert segments[0].start == 0
+    assert segments[-1].end == logits.logits_section.shape[-1] * cfg.hop_size / cfg.sample_rate
+    assert all(a.end == b.start for a, b in zip(segments, segments[1:]))
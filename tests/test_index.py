@@ -0,0 +1,39 @@
+import json
+
+from pathlib import Path
+from allin1.helpers import save_results
+from allin1.index import ResultIndex, main
+from test_store import make_result
+
+
+def test_result_index(tmp_path):
+  index_path = tmp_path / 'index.sqlite'
+  results = [make_result(i, T=100, activations=i == 1) for i in range(5)]
+  save_results(results, tmp_path, index=index_path)
+
+  with ResultIndex(index_path) as index:
+    assert len(index) == 5
+    # Chorus of 41 and 43 seconds.
+    assert index.query(label='chorus', min_label_duration=30) == [Path('/music/track1.mp3'), Path('/music/track3.mp3')]
+    assert index.query(bpm=(102, 104), label='chorus') == [Path('/music/track3.mp3')]
+    assert index.query(duration=(41, 42), limit=1) == [Path('/music/track1.mp3')]
+    assert index.execute('SELECT activations_path FROM tracks WHERE path = ?', ('/music/track1.mp3',)) == [
+      (str(tmp_path / 'track1.activ.npz'),)
+    ]
+
+    # Saving a track again replaces its rows.
+    results[3].segments[1].label = 'verse'
+    save_results(results[3], tmp_path, index=index)
+    assert len(index) == 5
+    assert index.query(label='chorus') == [Path('/music/track1.mp3')]
+    assert index.execute('SELECT COUNT(*) FROM segments') == [(10,)]
+
+
+def test_query_command(tmp_path, capsys):
+  save_results([make_result(i, T=100, activations=False) for i in range(3)], tmp_path)
+  main(['-i', str(tmp_path / 'index.sqlite'), '--reindex', '--bpm', '101', '102'])
+  assert capsys.readouterr().out.split() == ['/music/track1.mp3', '/music/track2.mp3']
+
+  main(['-i', str(tmp_path / 'index.sqlite'), '--label', 'chorus', '--json'])
+  row = json.loads(capsys.readouterr().out)
+  assert row['path'] == '/music/track1.mp3' and row['num_segments'] == 2 and row['duration'] == 41
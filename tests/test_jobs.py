@@ -0,0 +1,129 @@
+import json
+import multiprocessing
+import os
+import time
+import pytest
+
+from pathlib import Path
+from allin1 import jobs
+from allin1.helpers import save_results, select_shard
+from allin1.jobs import JobBoard, read_manifest, run_worker
+from test_store import make_result
+
+
+def fake_analyze(paths, out_dir, **kwargs):
+  """Stands in for the analysis, logging the tracks it was given, and failing on the ones named 'broken'."""
+  time.sleep(0.02)
+  with open(out_dir.parent / 'analyzed.log', 'a') as f:
+    f.write(''.join(f'{path.name}\n' for path in paths))
+  if any('broken' in path.name for path in paths):
+    raise RuntimeError('cannot decode')
+  results = []
+  for path in paths:
+    result = make_result(1, T=10, activations=False)
+    result.path = path
+    results.append(result)
+  save_results(results, out_dir)
+
+
+def worker(manifest, out_dir, worker_id):
+  counts = run_worker(read_manifest(manifest), out_dir, claim_size=2, worker_id=worker_id)
+  (out_dir.parent / f'{worker_id}.json').write_text(json.dumps(counts))
+
+
+def make_tracks(tmp_path, num_tracks):
+  audio_dir = tmp_path / 'audio'
+  audio_dir.mkdir()
+  names = [f'track{i:02d}.mp3' for i in range(num_tracks)] + ['broken.mp3']
+  for name in names:
+    (audio_dir / name).touch()
+  manifest = tmp_path / 'manifest.txt'
+  manifest.write_text('# tracks\n' + ''.join(f'{audio_dir / name}\n' for name in names))
+  return manifest
+
+
+def test_workers_analyze_each_track_once(tmp_path, monkeypatch):
+  monkeypatch.setattr(jobs, 'analyze', fake_analyze)
+  manifest = make_tracks(tmp_path, 30)
+  out_dir = tmp_path / 'struct'
+  context = multiprocessing.get_context('fork')
+  processes = [context.Process(target=worker, args=(manifest, out_dir, f'worker{i}')) for i in range(4)]
+  for process in processes:
+    process.start()
+  for process in processes:
+    process.join()
+    assert process.exitcode == 0
+
+  analyzed = (tmp_path / 'analyzed.log').read_text().split()
+  assert len(analyzed) == 31 + 2 and analyzed.count('broken.mp3') == 2
+  assert sorted(set(analyzed)) == sorted(path.name for path in read_manifest(manifest))
+  counts = [json.loads((tmp_path / f'worker{i}.json').read_text()) for i in range(4)]
+  assert sum(c['done'] for c in counts) == 30 and sum(c['failed'] for c in counts) == 1
+  assert sum(c['done'] + c['failed'] + c['skipped'] for c in counts) == 4 * 31
+
+  board = JobBoard(out_dir)
+  status = board.status(tmp_path / 'audio' / 'track07.mp3')
+  assert status['status'] == 'done' and status['worker'].startswith('worker') and 'stages' in status
+  # broken.mp3 was claimed with another track, which was analyzed again on its own.
+  assert board.summary(read_manifest(manifest)) == {'done': 30, 'failed': 1}
+  assert board.status(tmp_path / 'audio' / 'broken.mp3')['error'] == 'RuntimeError: cannot decode'
+  assert not list(board.dir.glob('*.lock'))
+
+  # A restarted worker has nothing left to do, unless it retries the failed tracks.
+  os.remove(tmp_path / 'analyzed.log')
+  worker(manifest, out_dir, 'restarted')
+  assert not (tmp_path / 'analyzed.log').exists()
+  assert run_worker(read_manifest(manifest), out_dir, retry_failed=True)['failed'] == 1
+
+
+def test_worker_takes_over_stale_claims(tmp_path, monkeypatch):
+  monkeypatch.setattr(jobs, 'analyze', fake_analyze)
+  paths = read_manifest(make_tracks(tmp_path, 3))[:3]
+  out_dir = tmp_path / 'struct'
+  board = JobBoard(out_dir, stale_after=60)
+
+  # A crashed worker on this machine, and a live worker on another one.
+  crashed = multiprocessing.get_context('fork').Process(target=board.claim, args=(paths[0],))
+  crashed.start()
+  crashed.join()
+  board.lock_path(paths[1]).write_text(json.dumps(dict(worker='other', host='elsewhere', pid=1, claimed_at=0)))
+
+  assert run_worker(paths, out_dir) == {'done': 2, 'failed': 0, 'skipped': 1}
+  assert board.status(paths[0])['status'] == 'done' and board.status(paths[1]) is None
+
+  # Claims on other machines are taken over once they are stale.
+  os.utime(board.lock_path(paths[1]), (time.time() - 120, time.time() - 120))
+  assert run_worker(paths, out_dir, stale_after=60) == {'done': 1, 'failed': 0, 'skipped': 2}
+
+
+def test_tracks_with_the_same_name_have_their_own_claims(tmp_path):
+  (tmp_path / 'a').mkdir()
+  (tmp_path / 'b').mkdir()
+  board = JobBoard(tmp_path / 'struct')
+  assert board.claim(tmp_path / 'a' / '01.mp3')
+  assert board.claim(tmp_path / 'b' / '01.mp3')
+  board.finish(tmp_path / 'a' / '01.mp3', 'done')
+  assert board.status(tmp_path / 'a' / '01.mp3')['path'] == str(tmp_path / 'a' / '01.mp3')
+  assert board.status(tmp_path / 'b' / '01.mp3') is None
+
+
+def test_held_claims_do_not_become_stale(tmp_path):
+  path = tmp_path / 'track.mp3'
+  board = JobBoard(tmp_path, stale_after=0.4)
+  other = JobBoard(tmp_path, 'other', stale_after=0.4)
+  other.host = 'elsewhere'
+  assert board.claim(path)
+  with board.holding([path]):
+    time.sleep(0.6)
+    assert not other.claim(path)
+  time.sleep(0.6)
+  assert other.claim(path)
+
+
+def test_select_shard():
+  paths = [Path(f'track{i}.mp3') for i in range(10)]
+  shards = [select_shard(paths, (i, 3)) for i in range(3)]
+  assert [len(shard) for shard in shards] == [4, 3, 3]
+  assert sorted(sum(shards, [])) == paths
+  with pytest.raises(ValueError):
+    select_shard(paths, (3, 3))
@@ -0,0 +1,65 @@
+import pytest
+import torch
+
+from omegaconf import OmegaConf
+from allin1.config import Config, HarmonixConfig
+from allin1.models import loaders
+from allin1.models.allinone import AllInOne
+from allin1.models.ensemble import Ensemble
+
+
+@pytest.fixture
+def checkpoint(tmp_path, monkeypatch):
+  torch.manual_seed(0)
+  cfg = OmegaConf.structured(Config(data=HarmonixConfig()))
+  cfg.depth = 3
+  cfg.best_threshold_beat = 0.2
+  cfg.best_threshold_downbeat = 0.2
+  model = AllInOne(cfg).eval()
+  checkpoint_path = tmp_path / 'checkpoint.pth'
+  torch.save({'config': OmegaConf.to_container(cfg), 'state_dict': model.state_dict()}, checkpoint_path)
+
+  downloads = []
+
+  def hf_hub_download(repo_id, filename, cache_dir=None):
+    downloads.append(filename)
+    return str(checkpoint_path)
+
+  monkeypatch.setattr(loaders, 'hf_hub_download', hf_hub_download)
+  monkeypatch.setattr(loaders, 'try_to_load_from_cache', lambda repo_id, filename, cache_dir=None: None)
+  loaders.clear_model_cache()
+  yield model, downloads
+  loaders.clear_model_cache()
+
+
+def test_load_pretrained_model(checkpoint, tmp_path):
+  expected, downloads = checkpoint
+  model = loaders.load_pretrained_model('harmonix-fold0', cache_dir=tmp_path / 'cache', device='cpu')
+  assert downloads == ['harmonix-fold0-0vra4ys2.pth']
+  assert (tmp_path / 'cache' / 'allin1' / 'harmonix-fold0-0vra4ys2.pt').is_file()
+  for name, param in expected.state_dict().items():
+    assert torch.equal(model.state_dict()[name], param)
+
+  x = torch.rand(1, 4, 300, 81)
+  with torch.no_grad():
+    assert torch.equal(model(x).logits_beat, expected(x).logits_beat)
+
+  # Kept in memory for the same device and dtype.
+  assert loaders.load_pretrained_model('harmonix-fold0', cache_dir=tmp_path / 'cache', device='cpu') is model
+  half = loaders.load_pretrained_model('harmonix-fold0', cache_dir=tmp_path / 'cache', device='cpu', dtype=torch.half)
+  assert half is not model and next(half.parameters()).dtype == torch.half
+
+  # Converted checkpoints are loaded without the hub.
+  loaders.clear_model_cache()
+  reloaded = loaders.load_pretrained_model('harmonix-fold0', cache_dir=tmp_path / 'cache', device='cpu')
+  assert reloaded is not model
+  assert downloads == ['harmonix-fold0-0vra4ys2.pth']
+
+
+def test_load_ensemble_model(checkpoint, tmp_path):
+  _, downloads = checkpoint
+  ensemble = loaders.load_pretrained_model('harmonix-all', cache_dir=tmp_path / 'cache', device='cpu')
+  assert isinstance(ensemble, Ensemble) and len(ensemble.models) == 8
+  assert sorted(downloads) == sorted(loaders.NAME_TO_FILE.values())
+  assert loaders.load_pretrained_model('harmonix-all', cache_dir=tmp_path / 'cache', device='cpu') is ensemble
+  assert loaders.load_pretrained_model('harmonix-fold3', cache_dir=tmp_path / 'cache', device='cpu') is ensemble.models[3]
@@ -0,0 +1,155 @@
+import pytest
+import torch
+
+from allin1.models.natten_torch import natten1d, natten2d
+
+
+# Ported from the index rules of the NATTEN kernels (see natten_mps/csrc/mps/kernels/helpers.metal).
+def get_window_start(index, length, kernel_size, neighborhood_size, dilation):
+  if dilation <= 1:
+    return max(index - neighborhood_size, 0) + (index + neighborhood_size >= length) * (
+      length - index - neighborhood_size - 1)
+  ni = index - neighborhood_size * dilation
+  if ni < 0:
+    return index % dilation
+  if index + neighborhood_size * dilation >= length:
+    imodd = index % dilation
+    a = (length // dilation) * dilation
+    b = length - a
+    if imodd < b:
+      return length - b + imodd - 2 * neighborhood_size * dilation
+    return a + imodd - kernel_size * dilation
+  return ni
+
+
+def get_pb_start(index, length, kernel_size, neighborhood_size, dilation):
+  if dilation <= 1:
+    return neighborhood_size + (index < neighborhood_size) * (neighborhood_size - index) + (
+      index + neighborhood_size >= length) * (length - index - 1 - neighborhood_size)
+  if index - neighborhood_size * dilation < 0:
+    return kernel_size - 1 - index // dilation
+  if index + neighborhood_size * dilation >= length:
+    return (length - index - 1) // dilation
+  return neighborhood_size
+
+
+def reference_natten1d(query, key, value, rpb, kernel_size, dilation, original_length):
+  B, H, L, D = query.shape
+  output = torch.zeros(B, H, L, D)
+  for i in range(L):
+    start = get_window_start(i, L, kernel_size, kernel_size // 2, dilation)
+    pb_start = get_pb_start(i, L, kernel_size, kernel_size // 2, dilation)
+    neighbors = [start + j * dilation for j in range(kernel_size)]
+    scores = torch.einsum('bhd,bhkd->bhk', query[:, :, i], key[:, :, neighbors])
+    scores = scores + rpb[:, pb_start:pb_start + kernel_size]
+    output[:, :, i] = torch.einsum('bhk,bhkd->bhd', scores.softmax(-1), value[:, :, neighbors])
+  return output[:, :, :original_length].permute(0, 2, 1, 3).reshape(B, original_length, H * D)
+
+
+def reference_natten2d(query, key, value, rpb, kernel_size, dilation, original_height, original_width):
+  B, H, X, Y, D = query.shape
+  output = torch.zeros(B, H, X, Y, D)
+  for x in range(X):
+    for y in range(Y):
+      start_x = get_window_start(x, X, kernel_size, kernel_size // 2, dilation)
+      start_y = get_window_start(y, Y, kernel_size, kernel_size // 2, dilation)
+      pb_x = get_pb_start(x, X, kernel_size, kernel_size // 2, dilation)
+      pb_y = get_pb_start(y, Y, kernel_size, kernel_size // 2, dilation)
+      neighbors_x = [start_x + i * dilation for i in range(kernel_size)]
+      neighbors_y = [start_y + j * dilation for j in range(kernel_size)]
+      keys = key[:, :, neighbors_x][:, :, :, neighbors_y]
+      values = value[:, :, neighbors_x][:, :, :, neighbors_y]
+      scores = torch.einsum('bhd,bhijd->bhij', query[:, :, x, y], keys)
+      scores = scores + rpb[:, pb_x:pb_x + kernel_size, pb_y:pb_y + kernel_size]
+      probs = scores.reshape(B, H, -1).softmax(-1).reshape(scores.shape)
+      output[:, :, x, y] = torch.einsum('bhij,bhijd->bhd', probs, values)
+  output = output[:, :, :original_height, :original_width].permute(0, 2, 3, 1, 4)
+  return output.reshape(B, original_height, original_width, H * D)
+
+
+@pytest.mark.parametrize('length, kernel_size, dilation', [
+  (20, 5, 1),
+  (40, 5, 4),
+  (43, 5, 4),
+  (50, 3, 8),
+  (80, 5, 16),
+])
+def test_natten1d(length, kernel_size, dilation):
+  torch.manual_seed(0)
+  q, k, v = torch.randn(3, 2, 3, length, 8)
+  rpb = torch.randn(3, 2 * kernel_size - 1)
+  original_length = length - 3
+
+  expected = reference_natten1d(q, k, v, rpb, kernel_size, dilation, original_length)
+  actual = natten1d(q, k, v, rpb, kernel_size, dilation, original_length)
+  assert actual.shape == (2, original_length, 3 * 8)
+  assert torch.allclose(actual, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('height, width, kernel_size, dilation', [
+  (5, 30, 5, 1),
+  (7, 23, 3, 2),
+])
+def test_natten2d(height, width, kernel_size, dilation):
+  torch.manual_seed(0)
+  q, k, v = torch.randn(3, 2, 3, height, width, 8)
+  rpb = torch.randn(3, 2 * kernel_size - 1, 2 * kernel_size - 1)
+
+  expected = reference_natten2d(q, k, v, rpb, kernel_size, dilation, height - 1, width)
+  actual = natten2d(q, k, v, rpb, kernel_size, dilation, height - 1, width)
+  assert actual.shape == (2, height - 1, width, 3 * 8)
+  assert torch.allclose(actual, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('kernel_size, dilation', [(5, 1), (5, 4), (3, 8)])
+def test_natten1d_padded(kernel_size, dilation):
+  torch.manual_seed(0)
+  lengths = [70, 45, 40]
+  q, k, v = torch.randn(3, 3, 2, 70, 8)
+  rpb = torch.randn(2, 2 * kernel_size - 1)
+  actual = natten1d(q, k, v, rpb, kernel_size, dilation, 70, lengths)
+  for i, length in enumerate(lengths):
+    item = [x[i:i + 1, :, :length] for x in [q, k, v]]
+    expected = natten1d(*item, rpb, kernel_size, dilation, length)
+    assert torch.allclose(actual[i:i + 1, :length], expected, atol=1e-6)
+
+
+def test_natten2d_padded():
+  torch.manual_seed(0)
+  lengths = [30, 12, 7]
+  q, k, v = torch.randn(3, 3, 2, 5, 30, 8)
+  rpb = torch.randn(2, 9, 9)
+  actual = natten2d(q, k, v, rpb, 5, 1, 5, 30, lengths)
+  for i, length in enumerate(lengths):
+    item = [x[i:i + 1, :, :, :length] for x in [q, k, v]]
+    expected = natten2d(*item, rpb, 5, 1, 5, length)
+    assert torch.allclose(actual[i:i + 1, :, :length], expected, atol=1e-6)
+
+
+def upstream_functional():
+  functional = pytest.importorskip('natten.functional')
+  if not hasattr(functional, 'natten1dqkrpb'):
+    pytest.skip('The upstream NATTEN operators are not installed.')
+  return functional
+
+
+def test_natten1d_matches_upstream():
+  functional = upstream_functional()
+
+  torch.manual_seed(0)
+  q, k, v = torch.randn(3, 2, 3, 64, 8)
+  rpb = torch.randn(3, 9)
+  attn = functional.natten1dqkrpb(q, k, rpb, 5, 4).softmax(-1)
+  expected = functional.natten1dav(attn, v, 5, 4).permute(0, 2, 1, 3).reshape(2, 64, 24)
+  assert torch.allclose(natten1d(q, k, v, rpb, 5, 4, 64), expected, atol=1e-5)
+
+
+def test_natten2d_matches_upstream():
+  functional = upstream_functional()
+
+  torch.manual_seed(0)
+  q, k, v = torch.randn(3, 2, 3, 12, 40, 8)
+  rpb = torch.randn(3, 9, 9)
+  attn = functional.natten2dqkrpb(q, k, rpb, 5, 2).softmax(-1)
+  expected = functional.natten2dav(attn, v, 5, 2).permute(0, 2, 3, 1, 4).reshape(2, 12, 40, 24)
+  assert torch.allclose(natten2d(q, k, v, rpb, 5, 2, 12, 40), expected, atol=1e-5)
@@ -0,0 +1,49 @@
+import time
+import pytest
+
+from allin1.pipeline import Stage, run_pipeline
+
+
+def test_run_pipeline():
+  stages = [
+    Stage('double', lambda x: x * 2, num_workers=3),
+    Stage('increment', lambda x: x + 1, num_workers=2),
+  ]
+  outputs = dict(run_pipeline(range(20), stages))
+  assert outputs == {i: i * 2 + 1 for i in range(20)}
+
+
+def test_run_pipeline_overlaps_stages():
+  first_calls, second_calls = [], []
+
+  def slow(x):
+    time.sleep(0.05)
+    first_calls.append(time.perf_counter())
+    return x
+
+  def record(x):
+    second_calls.append(time.perf_counter())
+    return x
+
+  list(run_pipeline(range(10), [Stage('slow', slow), Stage('record', record)], queue_size=1))
+  # The second stage starts on the first track long before the first stage is done with the whole batch.
+  assert second_calls[0] < first_calls[-1]
+
+
+def test_run_pipeline_raises():
+  def fail(x):
+    if x == 3:
+      raise ValueError('boom')
+    return x
+
+  with pytest.raises(RuntimeError, match='boom'):
+    list(run_pipeline(range(10), [Stage('fail', fail, num_workers=2)]))
+
+
+def test_run_pipeline_raises_errors_of_the_items():
+  def items():
+    yield 1
+    raise ValueError('unreadable manifest')
+
+  with pytest.raises(RuntimeError, match='"input" failed: unreadable manifest'):
+    list(run_pipeline(items(), [Stage('identity', lambda x: x)]))
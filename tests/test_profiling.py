@@ -0,0 +1,29 @@
+import numpy as np
+import torch
+
+from allin1.helpers import run_batched_inference
+from allin1.profiling import JsonLinesWriter, Profiler, load_metrics
+from test_batched_inference import FrameWiseModel
+
+
+def test_profiler_measures_batched_inference(tmp_path):
+  torch.manual_seed(0)
+  model = FrameWiseModel().eval()
+  specs = [np.random.rand(4, T, 81).astype('float32') for T in [500, 800, 500]]
+  paths = [f'track{i}.mp3' for i in range(len(specs))]
+
+  metrics = []
+  profiler = Profiler([metrics.append, JsonLinesWriter(tmp_path / 'metrics.jsonl')])
+  with torch.no_grad():
+    run_batched_inference(paths, specs, model, 'cpu', False, False, batch_size=2, profiler=profiler)
+
+  assert [(m.stage, m.paths) for m in metrics] == [
+    ('inference', ['track0.mp3', 'track2.mp3']),
+    ('metrical', ['track0.mp3', 'track2.mp3']),
+    ('functional', ['track0.mp3', 'track2.mp3']),
+    ('inference', ['track1.mp3']),
+    ('metrical', ['track1.mp3']),
+    ('functional', ['track1.mp3']),
+  ]
+  assert all(m.wall_time >= 0 and m.cpu_time >= 0 for m in metrics)
+  assert load_metrics(tmp_path / 'metrics.jsonl') == metrics
@@ -0,0 +1,55 @@
+import numpy as np
+
+from dataclasses import asdict
+from allin1.analyze import analyze
+from allin1.helpers import save_result, save_results
+from allin1.typings import LazyArrays
+from allin1.utils import load_result, load_results
+from test_store import make_result
+
+
+def test_load_result_is_lazy(tmp_path):
+  expected = make_result(1, T=1000)
+  save_result(expected, tmp_path / 'track1.json')
+  result = load_result(tmp_path / 'track1.json')
+
+  assert isinstance(result.activations, LazyArrays)
+  assert sorted(result.activations) == ['beat', 'downbeat', 'label', 'segment']
+  for key, value in expected.activations.items():
+    assert isinstance(result.activations[key], np.memmap)
+    np.testing.assert_array_equal(result.activations[key], value)
+  assert isinstance(result.embeddings, np.memmap)
+  np.testing.assert_array_equal(result.embeddings, expected.embeddings)
+
+  # Results loaded lazily can be converted and saved again.
+  assert asdict(result)['activations'].keys() == expected.activations.keys()
+  save_result(result, tmp_path / 'copy.json')
+  np.testing.assert_array_equal(load_result(tmp_path / 'copy.json').activations['label'], expected.activations['label'])
+
+
+def test_lazy_arrays_of_compressed_files(tmp_path):
+  np.savez_compressed(tmp_path / 'arrays.npz', a=np.arange(10), empty=np.zeros(0))
+  arrays = LazyArrays(tmp_path / 'arrays.npz')
+  assert not isinstance(arrays['a'], np.memmap)
+  np.testing.assert_array_equal(arrays['a'], np.arange(10))
+  assert arrays['empty'].shape == (0,)
+
+
+def test_analyze_loads_existing_results(tmp_path):
+  paths = []
+  for i in range(20):
+    path = tmp_path / 'audio' / f'track{i:02d}.mp3'
+    path.parent.mkdir(exist_ok=True)
+    path.touch()
+    paths.append(path)
+  expected = [make_result(i, T=100, activations=False) for i in range(20)]
+  for result, path in zip(expected, paths):
+    result.path = path
+  save_results(expected[::-1], tmp_path / 'struct')
+
+  # Nothing is left to analyze, so no model is loaded.
+  results = analyze(paths[::-1], out_dir=tmp_path / 'struct')
+  assert results == expected
+  assert load_results([tmp_path / 'struct' / 'track03.json'], num_workers=2) == expected[3:4]
+  assert analyze(paths, out_dir=tmp_path / 'struct', load_existing=False) == []
+  assert analyze(paths[0], out_dir=tmp_path / 'struct', load_existing=False) is None
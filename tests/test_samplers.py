@@ -0,0 +1,44 @@
+import numpy as np
+import torch
+
+from torch.utils.data import RandomSampler, SequentialSampler
+from allin1.training.data.datasets.collate import collate_fn
+from allin1.training.data.samplers import BucketBatchSampler
+
+
+def test_bucket_batch_sampler():
+  lengths = np.random.default_rng(0).integers(100, 66000, 103).tolist()
+
+  batches = list(BucketBatchSampler(SequentialSampler(lengths), lengths, batch_size=4))
+  assert len(batches) == 26
+  assert sorted(i for batch in batches for i in batch) == list(range(103))
+  # Without pools, the batches follow the lengths in decreasing order.
+  flat = [lengths[i] for batch in batches for i in batch]
+  assert flat == sorted(lengths, reverse=True)
+
+  sampler = BucketBatchSampler(
+    RandomSampler(lengths), lengths, batch_size=4, drop_last=True, pool_size=20, shuffle=True,
+  )
+  batches = list(sampler)
+  assert len(batches) == len(sampler) == 25
+  assert all(len(batch) == 4 for batch in batches)
+  assert len(set(i for batch in batches for i in batch)) == 100
+
+
+def test_collate_pads_to_longest():
+  def item(T):
+    return dict(
+      track_key=str(T),
+      spec=np.ones((4, T, 81), dtype=np.float32),
+      true_beat=np.ones(T, dtype=np.float32),
+      true_function=np.full(T, 3),
+      true_beat_times=[0.5],
+    )
+
+  batch = collate_fn([item(7), item(5)])
+  assert batch['spec'].shape == (2, 4, 7, 81)
+  assert torch.equal(batch['mask'].sum(1), torch.tensor([7., 5.], dtype=torch.float64))
+  assert torch.equal(batch['spec'].sum((1, 3)) / (4 * 81), batch['mask'].float())
+  assert torch.equal(batch['true_beat'][1], torch.tensor([1., 1., 1., 1., 1., 0., 0.]))
+  assert batch['true_function'].shape == (2, 7)
+  assert batch['true_beat_times'] == [[0.5], [0.5]]
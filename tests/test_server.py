@@ -0,0 +1,190 @@
+import threading
+import numpy as np
+import pytest
+import torch
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from allin1.bench import synthetic_stems
+from allin1.models.dinat import PADDING_MASK
+from allin1.server import AnalysisClient, AnalysisHTTPServer, AnalysisService, AnalysisUnixServer, MicroBatcher
+from test_batched_inference import FrameWiseModel, make_model
+
+DURATIONS = [5, 6, 5, 7]
+
+
+class FakeSeparator:
+  """Separates "audio files" holding their duration in seconds into synthetic stems."""
+  samplerate = 44100
+
+  def separate(self, path, clip=None):
+    return synthetic_stems(float(Path(path).read_text()), self.samplerate)
+
+
+class RecordingModel(torch.nn.Module):
+  def __init__(self, model):
+    super().__init__()
+    self.model = model
+    self.cfg = model.cfg
+    self.batch_sizes = []
+
+  def forward(self, x, lengths=None):
+    self.batch_sizes.append(x.shape[0])
+    return self.model(x, lengths=lengths)
+
+
+def serve(server):
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return thread
+
+
+@pytest.fixture
+def service():
+  service = AnalysisService(RecordingModel(FrameWiseModel()).eval(), FakeSeparator(), 'cpu', max_batch_size=4, max_wait=1.0,
+                            demix_workers=4)
+  yield service
+  service.close()
+
+
+@pytest.fixture
+def tracks(tmp_path):
+  paths = []
+  for i, duration in enumerate(DURATIONS):
+    path = tmp_path / f'track{i}.wav'
+    path.write_text(str(duration))
+    paths.append(path)
+  return paths
+
+
+def test_micro_batcher():
+  batches = []
+
+  def fn(items):
+    batches.append(items)
+    return [item * 2 for item in items]
+
+  batcher = MicroBatcher(fn, max_batch_size=3, max_wait=0.5)
+  futures = [batcher.submit(i) for i in range(5)]
+  assert [future.result() for future in futures] == [0, 2, 4, 6, 8]
+  assert batches == [[0, 1, 2], [3, 4]]
+  batcher.close()
+
+
+def test_micro_batcher_fails_queued_items_on_close():
+  started, release = threading.Event(), threading.Event()
+
+  def fn(items):
+    started.set()
+    release.wait(5)
+    return items
+
+  batcher = MicroBatcher(fn, max_batch_size=1, max_wait=0)
+  running = batcher.submit(0)
+  started.wait(5)
+  queued = batcher.submit(1)
+  closing = threading.Thread(target=batcher.close)
+  closing.start()
+  release.set()
+  closing.join()
+  assert running.result() == 0
+  with pytest.raises(RuntimeError, match='closed'):
+    queued.result(timeout=5)
+  with pytest.raises(RuntimeError, match='closed'):
+    batcher.submit(2)
+
+
+def test_http_server(service, tracks):
+  server = AnalysisHTTPServer(('127.0.0.1', 0), service, 'fake')
+  serve(server)
+  try:
+    client = AnalysisClient(('127.0.0.1', server.server_port))
+    assert client.health() == {'status': 'ok', 'model': 'fake'}
+
+    # Concurrent requests are run through the model together, even with different durations.
+    with ThreadPoolExecutor(4) as pool:
+      results = list(pool.map(lambda path: client.analyze(path, include_activations=True), tracks))
+    # The NATTEN kernels cannot mask padding, so only the tracks of equal duration are batched with them.
+    assert service.model.batch_sizes == ([4] if PADDING_MASK else [2, 1, 1])
+    for path, duration, result in zip(tracks, DURATIONS, results):
+      assert result.path == path
+      assert result.activations['beat'].shape == (duration * 100,)
+      assert result.embeddings is None
+
+    streamed = list(client.analyze_many(tracks))
+    assert sorted(result.path for result in streamed) == tracks
+    assert [result.beats for result in sorted(streamed, key=lambda r: r.path)] == [result.beats for result in results]
+
+    uploaded = client.analyze_audio(b'5', 'upload.mp3', include_embeddings=True)
+    assert uploaded.path == Path('upload.mp3')
+    assert uploaded.beats == results[0].beats
+    assert uploaded.embeddings.shape == (4, 500, 24)
+
+    uploaded = client.analyze_audio(b'5', 'a & b #1 ?é.mp3')
+    assert uploaded.path == Path('a & b #1 ?é.mp3')
+
+    with pytest.raises(RuntimeError, match='No such file'):
+      client.analyze(tracks[0].with_name('missing.wav'))
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.skipif(not PADDING_MASK, reason='padded batches are only masked with NATTEN_API=torch')
+def test_results_do_not_depend_on_concurrent_requests(tracks):
+  # Unlike the frame-wise stand-in, the outputs of the real model would change if the padding leaked into them.
+  service = AnalysisService(RecordingModel(make_model(depth=3)).eval(), FakeSeparator(), 'cpu',
+                            max_batch_size=4, max_wait=1.0, demix_workers=4)
+  try:
+    alone = [service.analyze(path, include_activations=True) for path in tracks]
+    service.model.batch_sizes.clear()
+    with ThreadPoolExecutor(4) as pool:
+      together = list(pool.map(lambda path: service.analyze(path, include_activations=True), tracks))
+  finally:
+    service.close()
+  # The tracks of 5 and 6 seconds are padded to 7 seconds in one batch.
+  assert service.model.batch_sizes == [4]
+  for result_alone, result_together in zip(alone, together):
+    assert result_together.beats == result_alone.beats
+    assert result_together.segments == result_alone.segments
+    for key in ['beat', 'downbeat', 'segment', 'label']:
+      np.testing.assert_allclose(result_together.activations[key], result_alone.activations[key], atol=1e-5)
+
+
+def test_results_are_streamed_as_they_complete(tracks):
+  release, timed_out = threading.Event(), []
+
+  class BlockingSeparator(FakeSeparator):
+    def separate(self, path, clip=None):
+      if path == tracks[0]:
+        timed_out.append(not release.wait(5))
+      return super().separate(path, clip)
+
+  service = AnalysisService(FrameWiseModel().eval(), BlockingSeparator(), 'cpu', max_wait=0.01, demix_workers=2)
+  server = AnalysisHTTPServer(('127.0.0.1', 0), service)
+  serve(server)
+  try:
+    results = AnalysisClient(('127.0.0.1', server.server_port)).analyze_many(tracks)
+    # The other tracks are analyzed while the first one is still being separated.
+    first = next(results)
+    assert first.path != tracks[0] and not release.is_set()
+    release.set()
+    assert sorted(result.path for result in [first, *results]) == tracks
+    assert timed_out == [False]
+  finally:
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+def test_unix_server(service, tracks, tmp_path):
+  socket_path = tmp_path / 'allin1.sock'
+  server = AnalysisUnixServer(socket_path, service, 'fake')
+  serve(server)
+  try:
+    result = AnalysisClient(socket_path).analyze(tracks[0])
+    assert result.path == tracks[0]
+    assert len(result.beats) > 0
+  finally:
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,28 @@
+import numpy as np
+import torch
+
+from allin1.spectrogram import SpectrogramFrontend, extract_spectrogram_from_stems, make_processor, STEMS
+
+
+def test_frontend_matches_madmom():
+  rng = np.random.default_rng(0)
+  stems = {
+    stem: torch.from_numpy(rng.uniform(-0.5, 0.5, (2, 44100 * 3 + 123)).astype(np.float32))
+    for stem in STEMS
+  }
+
+  expected = extract_spectrogram_from_stems(stems, make_processor())
+  actual = extract_spectrogram_from_stems(stems, SpectrogramFrontend(block_frames=100))
+  assert actual.shape == expected.shape == (4, 301, 81)
+  assert actual.dtype == expected.dtype
+  assert np.allclose(actual, expected, atol=1e-5)
+
+
+def test_frontend_batch():
+  rng = np.random.default_rng(0)
+  wavs = [rng.integers(-2 ** 15, 2 ** 15, (4, length), dtype=np.int16) for length in [44100, 30000, 44100 * 2 + 1]]
+  frontend = SpectrogramFrontend()
+
+  for spec, wav in zip(frontend.batch(wavs), wavs):
+    assert spec.shape == (4, -(-wav.shape[-1] // 441), 81)
+    assert np.allclose(spec, frontend(wav), atol=1e-5)
@@ -0,0 +1,39 @@
+import json
+import os
+import subprocess
+import sys
+
+from pathlib import Path
+
+# Dependencies that take seconds to import and are only needed to analyze, visualize or sonify tracks.
+HEAVY_MODULES = ['torch', 'matplotlib', 'demucs', 'madmom', 'librosa', 'huggingface_hub', 'omegaconf', 'hydra']
+
+SRC_DIR = Path(__file__).resolve().parents[1] / 'src'
+
+
+def imported_heavy_modules(code: str):
+  """Runs ``code`` in a fresh interpreter and returns the heavy modules it imported."""
+  check = f'import sys; print(sorted({{m.split(".")[0] for m in sys.modules}} & {set(HEAVY_MODULES)!r}))'
+  env = {**os.environ, 'PYTHONPATH': os.pathsep.join([str(SRC_DIR), os.environ.get('PYTHONPATH', '')])}
+  output = subprocess.run(
+    [sys.executable, '-c', f'{code}\n{check}'], env=env, capture_output=True, text=True, check=True,
+  ).stdout
+  return json.loads(output.splitlines()[-1].replace("'", '"'))
+
+
+def test_import_is_light():
+  assert imported_heavy_modules('import allin1') == []
+
+
+def test_load_result_is_light(tmp_path):
+  path = tmp_path / 'track.json'
+  path.write_text(json.dumps(dict(
+    path='track.wav', bpm=120, beats=[0.5, 1.0], downbeats=[0.5], beat_positions=[1, 2],
+    segments=[dict(start=0.0, end=1.0, label='intro')],
+  )))
+  code = f'import allin1; result = allin1.load_result({str(path)!r}); assert result.bpm == 120'
+  assert imported_heavy_modules(code) == []
+
+
+def test_cli_parser_is_light():
+  assert imported_heavy_modules('from allin1.cli import make_parser; make_parser().parse_args(["a.wav"])') == []
@@ -0,0 +1,62 @@
+import numpy as np
+
+from pathlib import Path
+from allin1.store import ResultStore, ResultStoreWriter
+from allin1.typings import AnalysisResult, Segment
+
+
+def make_result(i: int, T: int, activations: bool = True) -> AnalysisResult:
+  rng = np.random.default_rng(i)
+  result = AnalysisResult(
+    path=Path(f'/music/track{i}.mp3'),
+    bpm=None if i == 0 else 100 + i,
+    beats=[0.5 * b for b in range(i + 2)],
+    downbeats=[0.5 * b for b in range(0, i + 2, 4)],
+    beat_positions=[b % 4 + 1 for b in range(i + 2)],
+    segments=[Segment(0.0, 1.5, 'intro'), Segment(1.5, 40.0 + i, 'chorus' if i % 2 else 'verse')],
+  )
+  if activations:
+    result.activations = {
+      'beat': rng.random(T, dtype=np.float32),
+      'downbeat': rng.random(T, dtype=np.float32),
+      'segment': rng.random(T, dtype=np.float32),
+      'label': rng.random((10, T), dtype=np.float32),
+    }
+    result.embeddings = rng.random((4, T, 24), dtype=np.float32)
+  return result
+
+
+def test_result_store(tmp_path):
+  results = [make_result(i, T=100 + 10 * i, activations=i != 3) for i in range(5)]
+  with ResultStoreWriter(tmp_path, shard_size=2) as writer:
+    writer.add(results[:3])
+    writer.add(results[3:])
+  store = ResultStore(tmp_path)
+  assert len(store.shards) == 3 and len(store) == 5
+
+  for expected in results:
+    result = store.get(expected.path)
+    assert result.activations is None if expected.activations is None else result.activations.keys()
+    for key, value in (expected.activations or {}).items():
+      np.testing.assert_array_equal(result.activations[key], value)
+    if expected.embeddings is not None:
+      np.testing.assert_array_equal(result.embeddings, expected.embeddings)
+    result.activations, result.embeddings = expected.activations, expected.embeddings
+    assert result == expected
+  assert store.get(results[1].path, load_activations=False, load_embeddings=False).activations is None
+
+  # Tracks with a chorus longer than 30 seconds, without loading the tracks one by one.
+  scanned = store.scan(['path', 'bpm', 'segment_start', 'segment_end', 'segment_label'])
+  duration = scanned['segment_end'] - scanned['segment_start']
+  long_chorus = scanned['segments_track'][(scanned['segment_label'] == 'chorus') & (duration > 30)]
+  assert scanned['path'][long_chorus].tolist() == ['/music/track1.mp3', '/music/track3.mp3']
+  assert np.isnan(scanned['bpm'][0]) and scanned['bpm'][1:].tolist() == [101, 102, 103, 104]
+  assert scanned['segments_offsets'].tolist() == [0, 2, 4, 6, 8, 10]
+
+  # Later versions of a track take precedence.
+  updated = make_result(2, T=50, activations=False)
+  updated.bpm = 90
+  with ResultStoreWriter(tmp_path) as writer:
+    writer.add(updated)
+  store.refresh()
+  assert len(store) == 5 and store.get(updated.path).bpm == 90
@@ -0,0 +1,50 @@
+import numpy as np
+
+from allin1.training.data.eventconverters import HarmonixConverter
+from allin1.training.data.targets import TargetStore, compute_targets, write_target_store
+
+
+def write_annotations(base_dir, track_id, duration, rng):
+  (base_dir / 'beats').mkdir(parents=True, exist_ok=True)
+  (base_dir / 'segments').mkdir(parents=True, exist_ok=True)
+  beats = np.cumsum(rng.uniform(0.3, 0.7, int(duration / 0.3)))
+  beats = beats[beats < duration]
+  (base_dir / 'beats' / f'{track_id}.txt').write_text(
+    ''.join(f'{t:.6f}\t{i % 4 + 1}\n' for i, t in enumerate(beats))
+  )
+  boundaries = np.sort(rng.uniform(0, duration, 6))
+  labels = ['intro', 'verse', 'chorus', 'verse', 'outro', 'end']
+  (base_dir / 'segments' / f'{track_id}.txt').write_text(
+    ''.join(f'{t:.6f}\t{label}\n' for t, label in zip(boundaries, labels))
+  )
+
+
+def test_target_store_matches_converters(tmp_path):
+  rng = np.random.default_rng(0)
+  # The annotations of the second track go past the end of its features.
+  durations = {'0001': (40., 4000), '0002': (30., 2500)}
+  for track_id, (duration, _) in durations.items():
+    write_annotations(tmp_path, track_id, duration, rng)
+
+  def make_converter(track_id, total_frames, start=None):
+    return HarmonixConverter(track_id, total_frames, sr=44100, hop=441, start=start, base_dir=tmp_path)
+
+  write_target_store(
+    tmp_path / 'targets',
+    track_ids=list(durations),
+    make_converter=make_converter,
+    num_frames=lambda track_id: durations[track_id][1],
+    sample_rate=44100,
+    hop_size=441,
+  )
+  store = TargetStore(tmp_path / 'targets')
+
+  for track_id, (duration, num_features) in durations.items():
+    for start, num_frames in [(None, num_features), (0, 1000), (3.217, 1000), (12.345, 2000), (28.1, 1000)]:
+      start_frame = int(start * 100) if start else 0
+      expected = compute_targets(make_converter(track_id, num_frames, start))
+      actual = store.get(track_id, start_frame, num_frames)
+      assert expected.keys() == actual.keys()
+      for key in expected:
+        np.testing.assert_array_equal(actual[key], expected[key], err_msg=key)
+        assert actual[key].dtype == np.asarray(expected[key]).dtype, key
@@ -0,0 +1,19 @@
+import numpy as np
+
+from madmom.evaluation.beats import BeatEvaluation
+from allin1.training.helpers import threshold_fmeasures
+
+
+def test_threshold_fmeasures_matches_madmom():
+  rng = np.random.default_rng(0)
+  thresholds = np.linspace(0, 0.5, 51)
+  annotations = np.sort(rng.uniform(0, 60, 100))
+  # Detections close to each other and to the annotations, so that the greedy matching has to make choices.
+  detections = np.sort(np.concatenate([annotations + rng.normal(0, 0.05, 100), rng.uniform(0, 60, 50)]))
+  values = rng.uniform(0, 1, len(detections)).astype('float32')
+
+  for true in [annotations, np.empty(0)]:
+    fmeasures = threshold_fmeasures(detections, values, true, thresholds)
+    for threshold, fmeasure in zip(thresholds, fmeasures):
+      expected = BeatEvaluation(detections[values > np.float32(threshold)], true).fmeasure
+      assert fmeasure == expected